@@ -16,14 +16,73 @@ __author__ = 'Kalle Westerling'
 
 cfg = {
 	'level_reporting': 10,
-	'downloads_wait_min': 1,
-	'downloads_wait_max': 3,
 	'cache_folder': '/Users/kallewesterling/Dropbox/dev/instagram-hashtags/instagramanalysis/__cache__/',
 
 	'hashtags_datasets': '/Users/kallewesterling/Dropbox/datasets/instagram-hashtags',
 	'users_datasets': '/Users/kallewesterling/Dropbox/datasets/instagram-users',
 
 	'max_attempts': 5,
+	'instagram_base_url': 'https://www.instagram.com', # Point this at an InstagramStandIn to work offline
+
+	'dataset_io_threads': 16, # Threads that read cache records when a dataset is loaded with workers
+	'dataset_load_chunk': 2000, # Posts read ahead at a time when a dataset is loaded with workers
+	'dataset_snapshot_compression': 'gzip', # Compression of dataset snapshots (see InstagramDataset.save): None, 'gzip' or 'lzma'
+	'dataset_snapshot_level': 1,
+	'prefetch_concurrency': 8, # Requests in flight at once when prefetching (and when running jobs)
+	'media_folder': None, # Where download_media saves photos. Defaults to __media in the cache folder
+	'media_concurrency': 8, # Photos downloaded at once by download_media
+	'media_perceptual_hashes': True, # Hash downloaded photos for repost detection (needs Pillow; see index_media)
+	'media_repost_distance': 6, # Bits (of 64) in which the perceptual hashes of two photos may differ for one to count as a repost of the other
+	'job_queue_path': None, # Defaults to jobs.sqlite in the cache folder
+	'job_lease_seconds': 600, # Jobs leased by a worker that stops reporting go back to the queue after this long
+
+	'rate_limits': { # Starting rate and bounds (requests per second) of the adaptive rate limiter of each service, and the requests that may be sent at once after a quiet spell
+		'instagram': {'rate': 0.5, 'min_rate': 0.02, 'max_rate': 5.0, 'burst': 3},
+		'twitter': {'rate': 1.0, 'min_rate': 0.01, 'max_rate': 1.0, 'burst': 1},
+		'media': {'rate': 5.0, 'min_rate': 0.1, 'max_rate': 50.0, 'burst': 10}, # Instagram's media servers (photos)
+	},
+	'rate_limit_increase': 0.01, # Requests per second added for every second's worth of healthy responses
+	'rate_limit_decrease': 0.5, # Rate multiplier on throttling
+	'retry_backoff_base': 2, # Seconds before the first retry of a transient error, doubling with every attempt (see also max_attempts)
+	'retry_backoff_max': 300,
+	'circuit_breaker_threshold': 5, # Transient failures in a row after which all requests to a service pause
+	'circuit_breaker_cooldown': 120, # Seconds to pause before probing the service again (doubles while it stays down)
+	'circuit_breaker_max_cooldown': 3600,
+
+	'http_connect_timeout': 10, # Seconds to wait for a connection to Instagram
+	'http_read_timeout': 30, # Seconds to wait for the next bytes of a response before giving up on a stalled connection
+	'http_pool_size': 10, # Kept-alive connections per host (per thread)
+	'http_chunk_size': 64 * 1024, # Bytes per chunk when streaming downloads to disk
+	'http_user_agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1 Safari/605.1.15',
+
+	'cache_layout': 'sharded', # 'flat' (one directory per type) or 'sharded' (__posts/ab/cd/{shortcode}.json)
+	'cache_migration_workers': 8,
+	'cache_backend': 'filesystem', # 'filesystem' (one JSON file per record), 'sqlite' (one database file) or 'segments' (packed segment files)
+	'cache_sqlite_path': None, # Defaults to cache.sqlite in the cache folder
+	'cache_sqlite_batch_size': 100,
+	'cache_segments_folder': None, # Defaults to __segments in the cache folder
+	'cache_segment_size': 256 * 1024 * 1024,
+	'cache_compression': None, # None, 'zlib' or 'lzma'
+	'cache_compression_level': 6,
+	'cache_compression_dictionary': True, # Compress with the dictionary from train_compression_dictionary (zlib only)
+	'cache_compression_min_size': 64,
+	'cache_manifest_path': None, # Defaults to manifest.sqlite in the cache folder
+	'cache_manifest_batch_size': 100,
+	'negative_cache_retry_days': 30, # How long an empty post, user or place is trusted before it is downloaded again
+	'negative_cache_max_retry_days': 365, # The wait doubles every time a re-check is still empty, up to this
+	'cache_budgets': {'post': None, 'user': None, 'place': None, 'tweet': None, 'tweeter': None, 'twitter-place': None}, # Maximum bytes per type (None for no limit)
+	'cache_eviction_policy': 'lru', # 'lru' (least recently read first) or 'age' (oldest download first)
+	'cache_max_idle_days': None, # Evict records that have not been read for this many days, whatever the budget
+	'cache_eviction_batch': 200, # Records evicted per step, so eviction never holds up anything else for long
+	'cache_protection_lease': 7 * 86400, # Records protected by the datasets of a process on another machine (which cannot be checked for being alive) stay protected this long after it last published them
+	'cache_json_codec': 'auto', # 'auto' (the fastest installed one), 'orjson', 'msgspec' or 'json' (the standard library)
+	'cache_record_format': 'json', # Format of new cache records: 'json' or 'msgpack' (needs msgspec or msgpack). Both are always readable.
+	'html_archive': False, # Keep the raw pages that records are extracted from (see reextract_from_archive)
+	'html_archive_folder': None, # Defaults to __html in the cache folder
+	'html_archive_level': 6, # gzip level of archived pages
+	'cache_fsync': None, # None (leave it to the OS), 'batch' (fsync written records at the end of every batch) or 'always' (fsync every write)
+	'cache_fsync_batch_size': 100,
+	'cache_lock_stripes': 256, # Number of lock files that records are spread over for per-record locking between processes
 
 	'TWITTER_datasets': '/Users/kallewesterling/Dropbox/datasets/twitter-boylesque',
 	'TWITTER_consumer_key': 'PAKAd5cDFEvhlaMClRetKuX52',
@@ -48,13 +107,62 @@ import glob
 import shutil
 import collections
 import random
+import hashlib
+import argparse
+import asyncio
+import socket
+import sqlite3
+import threading
+import contextlib
+import atexit
+import fnmatch
+import mmap
+import struct
+import weakref
+import zlib
+import pickle
+import lzma
+import gzip
+import math
+import functools
+import mimetypes
+import warnings
 
 from pathlib import Path
 from pprint import pprint
 from operator import itemgetter
 from datetime import datetime as dt
 from datetime import timezone
-from random import randrange
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # Windows: locks are only shared between the threads of one process
+
+# Optional faster codecs for cache records (see get_record_codec)
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import msgspec
+except ImportError:
+	msgspec = None
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# Optional image decoding for perceptual hashes of media (see _perceptual_hash)
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
 
 
 import progressbar
@@ -97,10 +205,13 @@ class InstagramDataset(object):
 
 	Keywords:
 	hashtags -- a list of Instagram hashtags (default empty list)
+	download_concurrently -- download all posts, users and places that are not in the cache concurrently first (see prefetch()) (default False)
+	workers -- read and parse the cached posts, users and places with this many processes, while the posts are set up in order (default None: one post at a time)
+	lazy -- build posts only when they are used (see LazyPosts), and the summary counts, captions, geo and network only when they are first asked for (default False)
 
 	"""
 
-	def __init__(self, hashtags=[], users=[], shortcodes=[], limited=False, download_all_nodes=False, exclude_users=[]):
+	def __init__(self, hashtags=[], users=[], shortcodes=[], limited=False, download_all_nodes=False, exclude_users=[], download_concurrently=False, workers=None, lazy=False):
 		# Raise init errors
 		if len(hashtags) == 0 and len(shortcodes) == 0 and len(users) == 0:
 			raise SyntaxError("Error: You have to provide a list of hashtags (with at least one hashtag) or a list of shortcodes (with at least one shortcode).")
@@ -115,11 +226,10 @@ class InstagramDataset(object):
 		self._users = users
 		self.limited = limited
 		self.exclude_users = exclude_users
-		self._all_hashtags = None
-		self._all_mentions = None
-		self._all_tagged = None
-		self._all_countries = None
+		self._summary = None
 		self._all_nodes = download_all_nodes
+		self.lazy = lazy
+		self._params = {"hashtags": list(hashtags), "users": list(users), "shortcodes": [], "limited": limited, "download_all_nodes": download_all_nodes, "exclude_users": list(exclude_users), "lazy": lazy} # For building it again (see load())
 
 		# Get all shortcodes for Dataset
 		if len(hashtags) > 0:
@@ -129,14 +239,36 @@ class InstagramDataset(object):
 		elif len(shortcodes) > 0:
 			self.shortcodes = shortcodes
 
-		if not self.limited:
+		# Protect the records of this dataset from cache eviction while it is alive
+		_active_datasets.add(self)
+
+		if not self.limited and not self.lazy:
 			# Set up external objects in Dataset
 			self.captions = self.Captions()
 			self.geo = self.Geo()
 			self.network = self.Network()
 
+		# Download all missing posts, users and places concurrently before they are loaded one by one
+		if download_concurrently: prefetch(self.shortcodes, expand=True)
+
 		# Set up posts in Dataset
-		self.posts = self._setup_posts()
+		if self.lazy:
+			negative_cache = get_negative_cache()
+			self.posts = LazyPosts(self, [s for s in self.shortcodes if len(s) > 0 and not negative_cache.is_known_empty("post", s)], workers=workers)
+		else:
+			self.posts = self._setup_posts(workers=workers)
+		_protect_dataset(self)
+
+	def __getattr__(self, name):
+		""" Sets up the summary counts, captions, geo, network and aggregates of a lazy dataset the first time they are used. """
+		if self.__dict__.get('lazy') and 'posts' in self.__dict__:
+			if name in self._SUMMARY_FIELDS:
+				self._summarize()
+				return(self.__dict__[name])
+			if (name in ["captions", "geo", "network"] and not self.limited) or name == "aggregates":
+				self._aggregate(name)
+				return(self.__dict__[name])
+		raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
 	def __str__(self):
 		if len(self.hashtags) > 0:
@@ -150,82 +282,326 @@ class InstagramDataset(object):
 	def __len__(self):
 		return len(self.posts)
 
-	def _setup_posts(self):
+	def download_media(self, folder=None, concurrency=None, force=False):
+		""" Downloads the photos of all the posts in the dataset (see download_media()). """
+		return(download_media(self.shortcodes, folder=folder, concurrency=concurrency, force=force))
+
+	def _load_chunks(self, workers=None, shortcodes=None):
+		""" Yields (shortcodes, records) for setting up the posts of the dataset (or the given `shortcodes`).
+
+		Without `workers`, all shortcodes come in one go and records is None: every post reads its own records. With `workers`, the shortcodes come in chunks of cfg['dataset_load_chunk'], and the cache records of each chunk's posts, and of their users, places and mentioned users, are read by a pool of cfg['dataset_io_threads'] threads and parsed by a pool of `workers` processes (see load_records) while the chunk before it is being set up. records then holds the post records of the chunk, and the user and place records read so far (posts share them across chunks). The post records of a chunk are let go once it has been set up.
+		"""
+		if shortcodes is None: shortcodes = self.shortcodes
+		if workers is None:
+			yield(shortcodes, None)
+			return
+
+		size = cfg['dataset_load_chunk']
+		chunks = [shortcodes[i:i+size] for i in range(0, len(shortcodes), size)]
+		records = {}
+		with ThreadPoolExecutor(max_workers=cfg['dataset_io_threads']) as readers, ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dict(cfg),)) as parsers, ThreadPoolExecutor(max_workers=1) as loader:
+			loaded = set()
+			future = loader.submit(_load_post_records, chunks[0], readers, parsers, loaded, not self.limited) if len(chunks) > 0 else None
+			for n, chunk in enumerate(chunks):
+				chunk_records = future.result()
+				records.update(chunk_records)
+				if n + 1 < len(chunks): future = loader.submit(_load_post_records, chunks[n + 1], readers, parsers, loaded, not self.limited)
+				yield(chunk, records)
+				for key in chunk_records:
+					if key[0] == "post": del records[key]
+				del chunk_records
+
+	_SUMMARY_FIELDS = ["no_captions", "ads", "sponsored_users", "edited_captions", "videos", "sidecars", "images", "users_businesses", "users_joined_recently", "are_private", "are_verified", "have_locations"]
+
+	def _count_post(self, post, users_counted, sign=1):
+		""" Adds a post (and its user, if it is the user's first post in `users_counted`) to the summary counts. With sign=-1, takes it out again (and its user, with the user's last post). """
+		# Summarize post
+		if post.caption is None or post.caption == "": self.no_captions += sign
+		if post.is_ad: self.ads += sign
+		if post.sponsored_users: self.sponsored_users += sign
+		if post.caption_is_edited: self.edited_captions += sign
+		if post.type == "GraphVideo": self.videos += sign
+		if post.type == "GraphSidecar": self.sidecars += sign
+		if post.type == "GraphImage": self.images += sign
+
+		# Make sure users are not counted twice
+		username = post.user.username
+		if sign < 0: users_counted[username] -= 1
+		if users_counted[username] <= 0:
+			# Summarize user
+			if post.user.is_business_account: self.users_businesses += sign
+			if post.user.is_joined_recently: self.users_joined_recently += sign
+			if post.user.is_private: self.are_private += sign
+			if post.user.is_verified: self.are_verified += sign
+			if sign < 0: del users_counted[username]
+		if sign > 0: users_counted[username] += 1
+
+		# Summarize location
+		if post.location is not None: self.have_locations += sign
+
+	def _setup_posts(self, workers=None, shortcodes=None):
+		""" Sets up the posts of the dataset, and its summary counts, captions, geo and network. With `shortcodes`, sets up only those posts and adds them to the existing counts, captions, geo and network (see update()). """
 		_log(f"Loading list of posts based on hashtags {self.hashtags}...", 0)
 
 		# Standard variables
-		_r, users_counted = [], []
-		i, self.no_captions, self.ads, self.sponsored_users, self.edited_captions, self.videos, self.sidecars, self.images, self.users_businesses, self.users_joined_recently, self.are_private, self.are_verified, self.have_locations = 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+		_r, i = [], 0
+		if shortcodes is None:
+			shortcodes = self.shortcodes
+			self._users_counted, self._excluded_posts = collections.Counter(), {}
+			self.aggregates = self.Aggregates()
+			self.no_captions, self.ads, self.sponsored_users, self.edited_captions, self.videos, self.sidecars, self.images, self.users_businesses, self.users_joined_recently, self.are_private, self.are_verified, self.have_locations = 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+
+		negative_cache = get_negative_cache()
 
 		# Start a progressbar
-		bar = progressbar.ProgressBar(max_value=len(self.shortcodes)).start()
+		bar = progressbar.ProgressBar(max_value=len(shortcodes)).start()
 
-		for s in self.shortcodes:
-			_break = False
-			attempts = 1
-			post = None
-			
-			if len(s) == 0:
-				_log(f"Debug warning: Length 0 shortcode found in the dataset using hashtags {self.hashtags}.")
-				continue
+		failed = 0
+
+		for chunk, records in self._load_chunks(workers, shortcodes):
+			with _preloaded_records(records):
+				for s in chunk:
+					post = None
 			
-			while _break == False:
-				try:
-					post = InstagramPost(s, expand=True)
-					_break = True
-				except Exception as e:
-					wait_for_download()
-					attempts += 1
-					_log(f"Debug warning: Download attempt failed. Attempt number {attempts} commences.")
-					if attempts == cfg["max_attempts"]+1: _break = True
+					if len(s) == 0:
+						_log(f"Debug warning: Length 0 shortcode found in the dataset using hashtags {self.hashtags}.")
+						continue
+
+					if negative_cache.is_known_empty("post", s):
+						# Known to be deleted or unavailable: it would not end up in the dataset anyway
+						i+=1
+						bar.update(i)
+						continue
 			
-			if post is None: raise RuntimeError(f"Error downloading post {s}.")
-			if not post.ok: continue # Make sure only posts that were found are in the dataset.. This is not always what one might want, however.
-
-			if not post.user.username in self.exclude_users: _r.append(post)
-
-			# Summarize post
-			if post.caption is None or post.caption == "": self.no_captions += 1
-			if post.is_ad: self.ads += 1
-			if post.sponsored_users: self.sponsored_users += 1
-			if post.caption_is_edited: self.edited_captions += 1
-			if post.type == "GraphVideo": self.videos +=1
-			if post.type == "GraphSidecar": self.sidecars +=1
-			if post.type == "GraphImage": self.images +=1
-
-			if post.user.username not in users_counted:
-				# Summarize user
-				if post.user.is_business_account: self.users_businesses += 1
-				if post.user.is_joined_recently: self.users_joined_recently += 1
-				if post.user.is_private: self.are_private += 1
-				if post.user.is_verified: self.are_verified += 1
-
-				# Make sure users are not counted twice
-				users_counted.append(post.user.username)
+					try:
+						# Downloads are retried with backoff in _get_instagram_data
+						post = InstagramPost(s, expand=True)
+					except _DOWNLOAD_ERRORS as e:
+						# Left out of the dataset and kept in the failure records, so retry_failed() can download it later
+						_log(f"Warning: Could not load post {s} ({e.__class__.__name__}: {e}). Leaving it out.", 10)
+						failed += 1
+						i+=1
+						bar.update(i)
+						continue
 
-			if not self.limited:
-				# Captions updates
-				self.captions.update(post)
+					if not post.ok: continue # Make sure only posts that were found are in the dataset.. This is not always what one might want, however.
 
-			# Summarize location
-			if post.location is not None:
-				self.have_locations +=1
-				if not self.limited: self.geo.update_coordinates(post.location)
+					if not post.user.username in self.exclude_users:
+						_r.append(post)
+						self.aggregates.add(post)
+					else: self._excluded_posts[s] = post # Kept for update(), as they are part of the counts
 
-			if not self.limited:
-				# Create network
-				self.network.update_edges(post)
-				self.network.update_nodes(post, download=self._all_nodes)
+					self._count_post(post, self._users_counted)
 
-			# Update progressbar
-			i+=1
-			bar.update(i)
+					if not self.limited:
+						# Captions updates
+						self.captions.update(post)
+
+					# Summarize location
+					if post.location is not None and not self.limited: self.geo.update_coordinates(post.location)
+
+					if not self.limited:
+						# Create network
+						self.network.update_edges(post)
+						self.network.update_nodes(post, download=self._all_nodes)
+
+					# Update progressbar
+					i+=1
+					bar.update(i)
 
 		# Finish progressbar
 		bar.finish()
 
+		if failed > 0: _log(f"Warning: {failed} posts could not be loaded and were left out of the dataset. Run retry_failed() and load the dataset again to include them.", 10)
+
 		return(_r)
 
+	def _summarize(self):
+		""" Computes the summary counts of a lazy dataset (building all its posts). """
+		counts, users_counted = dict.fromkeys(self._SUMMARY_FIELDS, 0), collections.Counter()
+		self.__dict__.update(counts)
+		for post in self.posts._iter(include_excluded=True): self._count_post(post, users_counted)
+		self._users_counted = users_counted
+
+	def _aggregate(self, name):
+		""" Sets up the captions, geo, network or aggregates of a lazy dataset (building all its posts). """
+		if name == "aggregates":
+			aggregates = self.Aggregates()
+			for post in self.posts: aggregates.add(post)
+			self.aggregates = aggregates
+		elif name == "captions":
+			captions = self.Captions()
+			for post in self.posts._iter(include_excluded=True): captions.update(post)
+			self.captions = captions
+		elif name == "geo":
+			geo = self.Geo()
+			for post in self.posts._iter(include_excluded=True):
+				if post.location is not None: geo.update_coordinates(post.location)
+			self.geo = geo
+		elif name == "network":
+			network = self.Network()
+			for post in self.posts._iter(include_excluded=True):
+				network.update_edges(post)
+				network.update_nodes(post, download=self._all_nodes)
+			self.network = network
+
+	def _cache_keys(self):
+		""" Returns the (type, shortcode) keys of all cache records used by the dataset. Posts of a lazy dataset that have not been built yet are not built for this. """
+		keys = set(("post", s) for s in self.shortcodes)
+		posts = self.__dict__.get("posts", [])
+		if isinstance(posts, LazyPosts): posts = posts.built()
+		for post in list(posts) + list(self.__dict__.get("_excluded_posts", {}).values()):
+			if getattr(post, "user", None) is not None: keys.add(("user", post.user.username))
+			if getattr(post, "location", None) is not None and post.location.shortcode is not None: keys.add(("place", post.location.shortcode))
+		if "network" in self.__dict__:
+			keys.update(("user", username) for username in self.network.nodes)
+		return(keys)
+
+	def update(self, shortcodes=None, workers=None):
+		""" Brings the dataset up to date without building it again: looks up the shortcodes of its hashtags or users again (or adds the given `shortcodes`), loads only the new posts, and adds them to the summary counts, captions, geo, network and aggregates (the rankings of hashtags, mentions, users, etc.). Posts that have gone from the hashtags or users, or have been downloaded again as empty since, are taken out of them again.
+
+		A lazy dataset adds the new shortcodes to its posts, and builds the new posts only if its counts, captions, geo, network or aggregates have been set up.
+
+		Keywords:
+		shortcodes -- a list of shortcodes to add to the dataset (default None: look up the dataset's hashtags or users again)
+		workers -- read and parse the new posts with this many processes (see InstagramDataset) (default None)
+
+		Returns a dictionary with the number of new shortcodes ("added") and of posts taken out ("removed").
+		"""
+		if shortcodes is not None: current = list(self.shortcodes) + list(shortcodes)
+		elif len(self.hashtags) > 0: current = get_shortcodes_from_hashtags(self.hashtags)
+		elif len(self._users) > 0: current = get_shortcodes_from_users(self._users)
+		else: current = list(self.shortcodes)
+		current = list(dict.fromkeys(current))
+		known, keep = set(self.shortcodes), set(current)
+		added = [s for s in current if s not in known]
+
+		# Posts that have gone from the hashtags or users, or have turned out empty since they were loaded
+		loaded = self._loaded_posts()
+		entries = get_cache_manifest().get_many("post", list(loaded))
+		removed = [post for s, post in loaded.items() if s not in keep or entries.get(s, {}).get('status') == "empty"]
+		gone = set(s for s in known if s not in keep) | set(post.shortcode for post in removed)
+		self.shortcodes = current
+		self._summary, self._posts_per_day = None, None
+		_log(f"Updating dataset: {len(added)} new shortcodes, {len(removed)} posts to take out.", 0)
+
+		# Take the posts out
+		self._fold_posts(removed, sign=-1)
+		if self.lazy:
+			self.posts._update([], gone)
+			remaining = [post for post in self.posts._built.values() if self.posts._keep(post, include_excluded=True)]
+		else:
+			self.posts = [post for post in self.posts if post.shortcode not in gone]
+			for s in gone: self._excluded_posts.pop(s, None)
+			remaining = self.posts + list(self._excluded_posts.values())
+		if "network" in self.__dict__ and len(removed) > 0: self.network.remove_nodes(removed, remaining)
+
+		# Add the new posts
+		if self.lazy:
+			negative_cache = get_negative_cache()
+			candidates = [s for s in added if len(s) > 0 and not negative_cache.is_known_empty("post", s)]
+			self.posts._update(candidates, [])
+			if any(name in self.__dict__ for name in ["no_captions", "captions", "geo", "network", "aggregates"]):
+				candidates = set(candidates)
+				self._fold_posts([post for post in self.posts._iter(include_excluded=True) if post.shortcode in candidates])
+		else:
+			self.posts.extend(self._setup_posts(workers=workers, shortcodes=added))
+
+		_protect_dataset(self)
+		return({"added": len(added), "removed": len(removed)})
+
+	def _loaded_posts(self):
+		""" Returns the posts that have been set up (built, for a lazy dataset), including the posts of excluded users, by shortcode. """
+		if self.lazy: return({s: post for s, post in self.posts._built.items() if self.posts._keep(post, include_excluded=True)})
+		return(dict(self._excluded_posts, **{post.shortcode: post for post in self.posts}))
+
+	def save(self, path):
+		""" Saves the dataset, with its posts, summary counts, captions, geo, network and rankings, to a snapshot file that load() reads back without reading any cache records.
+
+		The snapshot also keeps the manifest state of the cache records that the dataset was built from (and the files in its hashtag or user folders), so load() can tell when it is out of date.
+		"""
+		keys = self._cache_keys()
+		if self.lazy:
+			unbuilt = set(self.posts._order) - set(self.posts._built)
+			keys = set(key for key in keys if key[0] != "post" or key[1] not in unbuilt) # Posts that have not been built do not go into the snapshot
+		loaded = self._loaded_posts()
+		params = dict(self._params, shortcodes=[] if len(self.hashtags) > 0 or len(self._users) > 0 else list(self.shortcodes))
+		header = {
+			"version": DATASET_SNAPSHOT_VERSION,
+			"saved": time.time(),
+			"params": params,
+			"records": _snapshot_records(keys),
+			"pending": [shortcode for type, shortcode in keys if type == "post" and shortcode not in loaded],
+			"folders": {folder: _folder_fingerprint(folder) for folder in _dataset_folders(self.hashtags, self._users)},
+			"compression": cfg['dataset_snapshot_compression'],
+		}
+		_write_snapshot(path, header, self)
+		_log(f"Saved dataset snapshot {path}.", 0)
+		return(path)
+
+	@classmethod
+	def load(cls, path, workers=None, rebuild=True):
+		""" Loads a dataset from a snapshot made with save().
+
+		If cache records that the dataset was built from have changed since, or the files in its hashtag or user folders, the snapshot is out of date. When the changes are new posts in the folders, or posts that could not be loaded before, or posts that have turned out empty, the dataset is brought up to date with update(). Otherwise it is built again. Either way, the snapshot is saved again.
+
+		Keywords:
+		path -- the snapshot file
+		workers -- processes for reading and parsing posts, if the dataset has to be brought up to date or built again (see InstagramDataset) (default None)
+		rebuild -- if False, raise a RuntimeError for a snapshot that is out of date instead (default True)
+
+		Snapshots are pickles: only load snapshots that you saved yourself.
+		"""
+		path = Path(path)
+		if not path.is_file(): raise RuntimeError(f"There is no dataset snapshot {path}")
+		header, offset = _read_snapshot_header(path)
+		params, pending = header['params'], set(header['pending'])
+
+		# Compare the records and folders with the snapshot
+		current = _snapshot_records((type, shortcode) for type, records in header['records'].items() for shortcode in records)
+		changed = [(type, shortcode) for type, records in header['records'].items() for shortcode, state in records.items() if current[type][shortcode] != state]
+		retry = [shortcode for type, shortcode in changed if type == "post" and shortcode in pending]
+		emptied = [shortcode for type, shortcode in changed if type == "post" and shortcode not in pending and current[type][shortcode] is not None and current[type][shortcode][1] == "empty"]
+		folders_changed = any(_folder_fingerprint(folder) != fingerprint for folder, fingerprint in header['folders'].items())
+		dataset = None
+		if len(changed) == len(retry) + len(emptied): dataset = _read_snapshot_dataset(path, header, offset)
+
+		if dataset is not None and len(changed) == 0 and not folders_changed:
+			_protect_dataset(dataset)
+			return(dataset)
+		if not rebuild: raise RuntimeError(f"The dataset snapshot {path} is out of date.")
+
+		if dataset is not None:
+			_log(f"Bringing dataset snapshot {path} up to date ({len(retry)} posts to load again, {len(emptied)} posts turned out empty)...", 0)
+			_active_datasets.add(dataset)
+			dataset.shortcodes = [shortcode for shortcode in dataset.shortcodes if shortcode not in set(retry)] # So update() loads them again
+			if len(params['hashtags']) > 0 or len(params['users']) > 0: dataset.update(workers=workers)
+			else: dataset.update(shortcodes=retry, workers=workers)
+		else:
+			if len(changed) > 0: _log(f"Warning: The dataset snapshot {path} is out of date ({len(changed)} cache records have changed). Building the dataset again...", 10)
+			else: _log(f"Warning: The dataset in snapshot {path} cannot be read with this version. Building the dataset again...", 10)
+			dataset = cls(workers=workers, **params)
+		dataset.save(path)
+		return(dataset)
+
+	def _fold_posts(self, posts, sign=1):
+		""" Adds posts to (or with sign=-1, takes them out of) the summary counts, captions, geo, network and aggregates that have been set up. """
+		for post in posts:
+			if "no_captions" in self.__dict__: self._count_post(post, self._users_counted, sign)
+			if "aggregates" in self.__dict__ and post.user.username not in self.exclude_users: self.aggregates.add(post, sign)
+			if "captions" in self.__dict__:
+				if sign > 0: self.captions.update(post)
+				else: self.captions.remove(post)
+			if "geo" in self.__dict__ and post.location is not None:
+				if sign > 0: self.geo.update_coordinates(post.location)
+				else: self.geo.remove_coordinates(post.location)
+			if "network" in self.__dict__:
+				if sign > 0:
+					self.network.update_edges(post)
+					self.network.update_nodes(post, download=self._all_nodes)
+				else:
+					self.network.remove_edges(post)
+
 	def setup_network(self):
 		self.network = self.Network()
 
@@ -247,72 +623,47 @@ class InstagramDataset(object):
 		bar.finish()
 
 
+	def add_aggregator(self, name, aggregator):
+		""" Adds an aggregator to the dataset, and counts the posts for it (in one pass). An aggregator is a function that takes an InstagramPost and returns a list of the keys to count the post under; see register_aggregator() for adding one to all datasets that are set up from now on.
+
+		Returns the keys with their counts, most counted first (see aggregate()).
+		"""
+		self.aggregates.register(name, aggregator, posts=self.posts)
+		return(self.aggregate(name))
+
+	def aggregate(self, name):
+		""" Returns the keys that an aggregator (see DATASET_AGGREGATORS) counted with their counts, most counted first. The ranking is kept until the dataset changes. """
+		return(self.aggregates.ranking(name))
+
 	def get_all_tagged(self):
-		if self._all_tagged == None:
-			self._all_tagged = {}
-			for post in self.posts:
-				for t in post.tagged_users:
-					if t['username'] not in self._all_tagged: self._all_tagged[t['username']] = 0
-					self._all_tagged[t['username']] += 1
-			self._all_tagged = sorted(self._all_tagged.items(), key=itemgetter(1), reverse=True)
-		return(self._all_tagged)
+		return(self.aggregate("tagged"))
 
 
 	def get_all_mentions(self):
-		if self._all_mentions == None:
-			self._all_mentions = {}
-			for post in self.posts:
-				if post.caption:
-					for h in get_mentions(post.caption, lower=True):
-						if h not in self._all_mentions: self._all_mentions[h] = 0
-						self._all_mentions[h] += 1
-			self._all_mentions = sorted(self._all_mentions.items(), key=itemgetter(1), reverse=True)
-		return(self._all_mentions)
+		return(self.aggregate("mentions"))
 
 
 	def get_all_hashtags(self):
-		if self._all_hashtags == None:
-			self._all_hashtags = {}
-			for post in self.posts:
-				if post.caption:
-					for h in get_hashtags(post.caption, lower=True):
-						if h not in self._all_hashtags: self._all_hashtags[h] = 0
-						self._all_hashtags[h] += 1
-			self._all_hashtags = sorted(self._all_hashtags.items(), key=itemgetter(1), reverse=True)
-		return(self._all_hashtags)
+		return(self.aggregate("hashtags"))
 
 
 	def get_all_countries(self, suppress_warning=False):
-		errors = []
-		if self._all_countries == None:
-			self._all_countries = {}
-			for post in self.posts:
-				if post.location is not None:
-					if post.location.country not in self._all_countries: self._all_countries[post.location.country] = 1
-					else: self._all_countries[post.location.country] += 1
-				else:
-					errors.append(post.shortcode)
-			if not suppress_warning: _log(f"Warning: {len(errors)} locations did not have locations assigned. {errors}", 10)
-			self._all_countries = sorted(self._all_countries.items(), key=itemgetter(1), reverse=True)
-		return(self._all_countries)
+		if not suppress_warning:
+			errors = list(self.aggregates.counts("no-location"))
+			_log(f"Warning: {len(errors)} locations did not have locations assigned. {errors}", 10)
+		return(self.aggregate("countries"))
 
 	@property
 	def all_tagged(self):
-		if self._all_tagged is not None: return(self._all_tagged)
-		else:
-			return(self.get_all_tagged())
+		return(self.get_all_tagged())
 
 	@property
 	def all_hashtags(self):
-		if self._all_hashtags is not None: return(self._all_hashtags)
-		else:
-			return(self.get_all_hashtags())
+		return(self.get_all_hashtags())
 
 	@property
 	def all_mentions(self):
-		if self._all_mentions is not None: return(self._all_mentions)
-		else:
-			return(self.get_all_mentions())
+		return(self.get_all_mentions())
 
 	@property
 	def users(self):
@@ -488,13 +839,13 @@ class InstagramDataset(object):
 		except: self._posts_per_day = None
 
 		if self._posts_per_day is None:
-			for date, posts in self.reorganize(by="date", dateformat="%Y-%m-%d").items():
+			for date, count in self.aggregates.counts("days").items():
 				year, month, day = date.split("-")
 				year, month, day = int(year), int(month), int(day)
 				if year not in _posts: _posts[year] = {}
 				if month not in _posts[year]: _posts[year][month] = {}
 				if day not in _posts[year][month]: _posts[year][month][day] = 0
-				_posts[year][month][day] += len(posts)
+				_posts[year][month][day] += count
 
 			df = pd.DataFrame.from_dict(_posts)
 			for c in df.columns:
@@ -518,15 +869,15 @@ class InstagramDataset(object):
 			return(self._posts_per_day)
 
 
-	def posts_per_month(self, **kwargs): # todo: redo as the posts_per_day above so we don't have to loop over dataset.reorganize every time we run the script
+	def posts_per_month(self, **kwargs):
 		_posts, _dfs = {}, {}
 
-		for date, posts in self.reorganize(by="date", dateformat="%Y-%m").items():
-			year, month = date.split("-")
+		for date, count in self.aggregates.counts("days").items():
+			year, month, _ = date.split("-")
 			year, month = int(year), int(month)
 			if year not in _posts: _posts[year] = {}
 			if month not in _posts[year]: _posts[year][month] = 0
-			_posts[year][month] += len(posts)
+			_posts[year][month] += count
 
 		df = pd.DataFrame.from_dict(_posts).T.fillna(0).astype(int).sort_index()
 		_all = df.T
@@ -561,43 +912,11 @@ class InstagramDataset(object):
 			what == "top-mentioned" or
 			what == "top-likes"):
 
-			users_in_dataset = {}
-
-			for post in self.posts:
-
-				if not post.ok: continue
-
-				if what == "top-users":
-					# top-users creates a list of all the usernames who have posted within the hashtag and a count value for each username
-					if post.user.ok:
-						if post.user.username not in users_in_dataset: users_in_dataset[post.user.username] = 1
-						else: users_in_dataset[post.user.username] += 1
-
-				elif what == "top-tagged":
-					# top-tagged creates a list of all the usernames who have been tagged in a hashtag
-					if post.tagged_users is not None and len(post.tagged_users) > 0:
-						for t in post.tagged_users:
-							if t['username'] not in users_in_dataset: users_in_dataset[t['username']] = 1
-							else: users_in_dataset[t['username']] += 1
-
-				elif what == "top-mentioned":
-					# top-mentioned creates a list of all the usernames who have been mentioned in a hashtag
-					if post.caption is not None and len(get_mentions(post.caption)) > 0:
-						for m in get_mentions(post.caption):
-							m = m.lower()
-							if m not in users_in_dataset: users_in_dataset[m] = 1
-							else: users_in_dataset[m] += 1
-
-				elif what == "top-likes":
-					# top-likes creates a list of the amount of likes each post have received in a hashtag
-					if post.num_likes not in users_in_dataset: users_in_dataset[post.num_likes] = 1
-					else: users_in_dataset[post.num_likes] += 1
-
-			users_in_dataset = sorted(users_in_dataset.items(), key=itemgetter(1), reverse=True)
-
-			return(users_in_dataset)
+			# top-users: the usernames who have posted within the hashtag, top-tagged: the usernames who have been tagged, top-mentioned: the usernames who have been mentioned, top-likes: the amounts of likes the posts have received, each with a count value
+			return(self.aggregate({"top-users": "users", "top-tagged": "tagged", "top-mentioned": "mentions", "top-likes": "likes"}[what]))
 
 		elif what == "summary":
+			if self._summary is not None: return(self._summary)
 			return_value = {
 				'num_shortcodes': len(self.shortcodes),
 				'num_posts': len(self.posts),
@@ -625,6 +944,7 @@ class InstagramDataset(object):
 				return_value['20_top_tagged'] = self.all_tagged[:20]
 				return_value['20_top_mentioned'] = self.all_mentions[:20]
 
+			self._summary = return_value
 			return(return_value)
 
 
@@ -633,6 +953,56 @@ class InstagramDataset(object):
 			print(post.include[0]) #TODO
 
 
+	class Aggregates(object):
+		""" Counts keys across the posts of a dataset, with a hash-based counter for each aggregator (see DATASET_AGGREGATORS), so all of them are counted in the one pass that sets up the posts. Rankings are kept until the counts change. """
+		def __init__(self, aggregators=None):
+			self._aggregators = dict(DATASET_AGGREGATORS if aggregators is None else aggregators)
+			self._counters = {name: collections.Counter() for name in self._aggregators}
+			self._rankings = {}
+
+		def __contains__(self, name):
+			return(name in self._counters)
+
+		def __getstate__(self):
+			# Aggregators need not be picklable: they are looked up by name when a snapshot is loaded
+			state = dict(self.__dict__)
+			state['_aggregators'] = list(self._aggregators)
+			return(state)
+
+		def __setstate__(self, state):
+			names = state.pop('_aggregators')
+			self.__dict__.update(state)
+			self._aggregators = {name: DATASET_AGGREGATORS[name] for name in names if name in DATASET_AGGREGATORS}
+			for name in names:
+				if name not in self._aggregators: _log(f"Warning: Aggregator {name} is not registered (see register_aggregator), so its counts will not change with the dataset.", 10)
+
+		def add(self, post, sign=1):
+			""" Counts a post (or with sign=-1, takes it out of the counts again). """
+			for name, aggregator in self._aggregators.items():
+				counter = self._counters[name]
+				for key in aggregator(post):
+					counter[key] += sign
+					if counter[key] <= 0: del counter[key]
+			if len(self._rankings) > 0: self._rankings = {}
+
+		def register(self, name, aggregator, posts=[]):
+			""" Adds an aggregator, and counts `posts` for it. """
+			self._aggregators[name] = aggregator
+			self._counters[name] = collections.Counter()
+			for post in posts: self._counters[name].update(aggregator(post))
+			self._rankings.pop(name, None)
+
+		def counts(self, name):
+			""" Returns the counter of an aggregator (key: count). """
+			if name not in self._counters: raise RuntimeError(f"There is no aggregator {name}. Add one with add_aggregator() or register_aggregator().")
+			return(self._counters[name])
+
+		def ranking(self, name):
+			""" Returns the keys of an aggregator with their counts, most counted first. """
+			if name not in self._rankings: self._rankings[name] = sorted(self.counts(name).items(), key=itemgetter(1), reverse=True)
+			return(self._rankings[name])
+
+
 	class Captions(object):
 		def __init__(self):
 			self.captured = []
@@ -665,17 +1035,7 @@ class InstagramDataset(object):
 							else: self.all_emojis[character] += 1
 
 					# Now clean text
-					caption = clean_text(
-							caption,
-							expand_contractions=True,
-							lower=True,
-							no_at=True,
-							no_digits=False,
-							no_hash=True,
-							no_links=True,
-							no_punc=True,
-							strip_emoji=True,
-							strip_spaces=True) # Clean the caption but keep digits as they may differ from post to post
+					caption = self._clean(caption)
 
 					if caption != "":
 						if caption not in self.captions: self.captions[caption] = 0
@@ -683,9 +1043,50 @@ class InstagramDataset(object):
 
 						if caption not in self.captions_data: self.captions_data[caption] = []
 						if shortcode not in self.captions_data[caption]: self.captions_data[caption].append(shortcode)
+				self._word_counts = {}
 			else:
 				_log(f"{shortcode} already processed.", 0)
 
+		def remove(self, post): # post = InstagramPost object here
+			""" Takes a post that was added with update() out of the captions again. """
+			caption = post.caption
+			shortcode = post.shortcode
+
+			if shortcode in self.captured:
+				self.captured.remove(shortcode)
+
+				if caption is not None:
+					for character in caption:
+						try:
+							character.encode("ascii")
+						except UnicodeEncodeError:
+							self.all_emojis[character] -= 1
+							if self.all_emojis[character] <= 0: del self.all_emojis[character]
+
+					caption = self._clean(caption)
+
+					if caption != "":
+						self.captions[caption] -= 1
+						if self.captions[caption] <= 0: del self.captions[caption]
+
+						if shortcode in self.captions_data.get(caption, []): self.captions_data[caption].remove(shortcode)
+						if caption in self.captions_data and len(self.captions_data[caption]) == 0: del self.captions_data[caption]
+				self._word_counts = {}
+
+		@staticmethod
+		def _clean(caption):
+			return(clean_text(
+					caption,
+					expand_contractions=True,
+					lower=True,
+					no_at=True,
+					no_digits=False,
+					no_hash=True,
+					no_links=True,
+					no_punc=True,
+					strip_emoji=True,
+					strip_spaces=True)) # Clean the caption but keep digits as they may differ from post to post
+
 
 		def words(self, stop_words = []):
 			if len(self._word_counts) <= 0:
@@ -813,6 +1214,18 @@ class InstagramDataset(object):
 					if not pos in self.details:
 						self.details[pos] = location_object
 
+		def remove_coordinates(self, location_object):
+			""" Takes a location that was added with update_coordinates() out again. """
+			if location_object is not None:
+				if location_object.lat is not None and location_object.lng is not None:
+					pos = f"{location_object.lat}, {location_object.lng}"
+
+					if pos in self.coordinates:
+						self.coordinates[pos] -= 1
+						if self.coordinates[pos] <= 0:
+							del self.coordinates[pos]
+							self.details.pop(pos, None)
+
 		@property
 		def coordinates_sorted(self):
 			return(sorted(self.coordinates.items(), key=itemgetter(1), reverse=True))
@@ -948,6 +1361,32 @@ class InstagramDataset(object):
 			for node in post_object.tagged_users:
 				self.update_edge(post_object.user.username, node['username'], 1, category="tag")
 
+		def remove_edges(self, post_object):
+			""" Takes the edges of a post that was added with update_edges() out again. """
+			edges = []
+			if post_object.caption is not None:
+				edges.extend((mention, "caption-mention") for mention in get_mentions(post_object.caption))
+			edges.extend((node['username'], "tag") for node in post_object.tagged_users)
+
+			source = post_object.user.username.lower()
+			for target, category in edges:
+				target = target.lower()
+				self.update_edge(source, target, -1, category=category)
+
+				# Drop the edges that are left without any posts
+				if self._edges[source][target][category] <= 0: del self._edges[source][target][category]
+				if len(self._edges[source][target]) == 0: del self._edges[source][target]
+				if len(self._edges[source]) == 0: del self._edges[source]
+
+		def remove_nodes(self, post_objects, remaining):
+			""" Drops the nodes of the given posts that none of the `remaining` posts (the ones still in the network) refer to. """
+			def names(post_object):
+				return([post_object.user.username] + (get_mentions(post_object.caption) if post_object.caption is not None else []))
+			candidates = set(name.lower() for post_object in post_objects for name in names(post_object))
+			if len(candidates) == 0: return
+			referred = set(name.lower() for post_object in remaining for name in names(post_object))
+			for node in [node for node in self._nodes if node.lower() in candidates and node.lower() not in referred]: del self._nodes[node]
+
 		def all(self, category=False):
 			""" Shows all edges. If category=True return list with edges by category """
 			_category = category
@@ -1018,6 +1457,87 @@ class InstagramDataset(object):
 
 ##### SET UP INSTAGRAM OBJECTS #########
 
+class LazyPosts(object):
+	""" The posts of a lazy InstagramDataset: a sequence that builds each InstagramPost the first time it is used, and keeps it.
+
+	It holds the shortcodes that can still turn out to be posts of the dataset (all but the ones known to be empty). A post that turns out to be unavailable, cannot be loaded, or belongs to an excluded user is dropped when it is built, so len() can go down as posts are built. It is exact once all posts have been built, and from the start for a cache that holds all posts when there are no excluded users.
+
+	Iterating builds the posts in order, reading ahead with the dataset's `workers` if it has them (see InstagramDataset._load_chunks).
+	"""
+
+	def __init__(self, dataset, shortcodes, workers=None):
+		self._dataset = dataset
+		self._order = list(shortcodes) # All candidates, including the posts of excluded users
+		self._shortcodes = list(shortcodes)
+		self._workers = workers
+		self._built = {} # shortcode: InstagramPost, or None if it could not be loaded
+
+	def __len__(self):
+		return(len(self._shortcodes))
+
+	def __repr__(self):
+		return(f"LazyPosts({len(self._built)} of {len(self._shortcodes)} posts built)")
+
+	def _build(self, shortcode):
+		""" Returns the post of a shortcode, building it on first use, or None if it could not be loaded. """
+		if shortcode not in self._built:
+			try:
+				self._built[shortcode] = InstagramPost(shortcode, expand=True)
+			except _DOWNLOAD_ERRORS as e:
+				# Left out of the dataset and kept in the failure records, so retry_failed() can download it later
+				_log(f"Warning: Could not load post {shortcode} ({e.__class__.__name__}: {e}). Leaving it out.", 10)
+				self._built[shortcode] = None
+		return(self._built[shortcode])
+
+	def _keep(self, post, include_excluded=False):
+		""" Returns True if a built post is part of the dataset. """
+		return(post is not None and post.ok and (include_excluded or post.user.username not in self._dataset.exclude_users))
+
+	def _drop(self):
+		""" Drops the shortcodes of the built posts that are not part of the dataset. """
+		self._shortcodes = [shortcode for shortcode in self._shortcodes if shortcode not in self._built or self._keep(self._built[shortcode])]
+
+	def __getitem__(self, position):
+		while True:
+			if isinstance(position, slice): shortcodes = [self._shortcodes[i] for i in range(*position.indices(len(self._shortcodes)))]
+			else: shortcodes = [self._shortcodes[position]]
+			posts = [self._build(shortcode) for shortcode in shortcodes]
+			if all(self._keep(post) for post in posts): return(posts if isinstance(position, slice) else posts[0])
+			self._drop()
+
+	def __iter__(self):
+		return(self._iter())
+
+	def _iter(self, include_excluded=False):
+		""" Yields the posts in order, building them as needed. With `include_excluded`, the posts of excluded users are included (for the summary counts, which count them too). """
+		snapshot, kept = list(self._order if include_excluded else self._shortcodes), []
+		chunks, records, loaded = None, None, set()
+		if self._workers is not None: chunks = self._dataset._load_chunks(self._workers, [shortcode for shortcode in snapshot if shortcode not in self._built])
+		try:
+			for shortcode in snapshot:
+				if chunks is not None and shortcode not in self._built and shortcode not in loaded:
+					chunk, records = next(chunks)
+					loaded.update(chunk)
+				with _preloaded_records(records): post = self._build(shortcode)
+				if self._keep(post): kept.append(shortcode)
+				if self._keep(post, include_excluded=include_excluded): yield(post)
+			if not include_excluded and self._shortcodes == snapshot: self._shortcodes = kept
+			elif include_excluded: self._drop()
+		finally:
+			if chunks is not None: chunks.close()
+
+	def _update(self, added, removed):
+		""" Adds the shortcodes `added` at the end, and takes the shortcodes `removed` (and their posts) out (see InstagramDataset.update()). """
+		removed = set(removed) | set(added)
+		self._order = [shortcode for shortcode in self._order if shortcode not in removed] + list(added)
+		self._shortcodes = [shortcode for shortcode in self._shortcodes if shortcode not in removed] + list(added)
+		for shortcode in removed: self._built.pop(shortcode, None)
+
+	def built(self):
+		""" Returns the posts that have been built so far (without building any). """
+		return([post for shortcode, post in self._built.items() if self._keep(post)])
+
+
 class InstagramPost(object):
 
 	def __init__(self, s, expand=False):
@@ -1229,247 +1749,3499 @@ def expand_filepaths(filepaths):
 
 
 
-def get_shortcodes_from_hashtags(hashtags=None):
-	if hashtags == None: raise SyntaxError("You have to provide at least one hashtag (as a string) or a list of hashtags containing at least one element.")
-	if isinstance(hashtags, str): hashtags = [hashtags]
-	_ = []
-	for hashtag in hashtags:
-		path = cfg["hashtags_datasets"] / hashtag
-		shortcodes = get_shortcodes_from_path(path)
-		_.extend(shortcodes)
+def get_shortcodes_from_hashtags(hashtags=None):
+	if hashtags == None: raise SyntaxError("You have to provide at least one hashtag (as a string) or a list of hashtags containing at least one element.")
+	if isinstance(hashtags, str): hashtags = [hashtags]
+	_ = []
+	for hashtag in hashtags:
+		path = cfg["hashtags_datasets"] / hashtag
+		shortcodes = get_shortcodes_from_path(path)
+		_.extend(shortcodes)
+
+	return(list(set(_)))
+
+def get_shortcodes_from_users(users=None):
+	if users == None: raise SyntaxError("You have to provide at least one username (as a string) or a list of usernames containing at least one element.")
+	if isinstance(users, str): users = [users]
+	_ = []
+	for user in users:
+		path = cfg["users_datasets"] / user / 'feed'
+		shortcodes = get_shortcodes_from_path(path)
+		_.extend(shortcodes)
+
+	return(list(set(_)))
+
+
+def get_shortcodes_from_path(path):
+	p = Path(path)
+	files = listdir_nohidden(p)
+	shortcodes = []
+	
+	for file in files:
+		fp = Path(file).name
+
+		if fp[0:1] == ".": pass # Found a hidden file
+
+		elif fp[0:1] == "_": # Found a cache file!
+			with open(f"{p}/{fp}", "r") as f: shortcodes.extend(f.read().split("\n"))
+
+		else: # Found another file, try to open it and read
+			try:
+				with open(f"{p}/_{fp}", "r") as f: pass # Trying to check whether we have a cache'd version of this one (if so, it takes priority!)
+			except:
+				try:
+					with open(file, "r") as f:
+						content = f.read()
+						g = re.findall(pattern='a href="\/p\/(\S*)\/', string=content) # Sear for "/p/________/"
+						if len(g) > 0:
+							_log(f"Debug: Found {len(g)} shortcodes in {file}.")
+						else:
+							g = re.findall(pattern='a href="\/p\/(\S*)">|\?=\S+"', string=content) # We're now searching for "/p/______"
+							if len(g) > 0:
+								_log(f"Debug: Found {len(g)} shortcodes in {file}.")
+							else:
+								_log(f"Warning: RegEx found no shortcodes ({g}) in file {file}.", 10)
+						
+					with open(f"{p}/_{fp}", "w+") as f:
+						f.write("\n".join(g))
+					shortcodes.extend(g)
+				except Exception as e:
+					print(e)
+					exit()
+					
+	# shortcodes = list(filter(None, shortcodes))
+	
+	return(list(set(shortcodes)))
+
+
+def listdir_fullpath(d):
+	return [os.path.join(d, f) for f in os.listdir(d)]
+
+
+def listdir_nohidden(path):
+	return glob.glob(os.path.join(path, '*'))
+
+
+
+
+### NEW VERSION
+
+def _is_legacy_path(value):
+	""" Returns True if an argument that is now a record type is a file path, as passed to _save_json and _save_empty_json before they saved to the cache backend. """
+	return(isinstance(value, os.PathLike) or (isinstance(value, str) and (os.sep in value or value.endswith(".json"))))
+
+
+def _save_empty_json(type=None, shortcode=None, path=None):
+	""" Save an empty record in the cache
+
+	The old form _save_empty_json(path) is deprecated: it still writes an empty JSON file to the path, but that file is not in the cache manifest and is not seen by other cache backends.
+	"""
+	if path is None and shortcode is None and _is_legacy_path(type): path, type = type, None
+	if path is not None:
+		warnings.warn("_save_empty_json(path) is deprecated. Use _save_empty_json(type, shortcode) to save to the cache.", DeprecationWarning, stacklevel=2)
+		with open(path, 'w+') as outfile: json.dump("", outfile)
+		return
+
+	# Verify all settings
+	if type == None: raise SyntaxError('A type must be provided.')
+	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
+
+	_json = ""
+	_cache_put(type, shortcode, _json)
+
+
+def wait_for_download(min=None, max=None, randomize=None):
+	""" Waits until the shared Instagram rate limiter allows the next request (see get_rate_limiter). `min`, `max` and `randomize` are deprecated and have no effect: the wait follows how Instagram responds, and is set with cfg['rate_limits']['instagram']. """
+	if min is not None or max is not None or randomize is not None:
+		warnings.warn("The min, max and randomize arguments of wait_for_download() have no effect. Set the Instagram rate limits with cfg['rate_limits']['instagram'].", DeprecationWarning, stacklevel=2)
+	waited = get_rate_limiter("instagram").acquire()
+	if waited > 0: _log(f"Waited {round(waited, 2)} seconds for the rate limiter.", 0)
+
+
+# Rate limiting
+
+class AdaptiveRateLimiter(object):
+	""" A token bucket shared by all threads that send requests to one service, whose rate adapts to how the service responds.
+
+	Every request takes a token first (acquire()). Tokens come back at `rate` per second, up to `burst`. The rate grows additively while responses are healthy (by cfg['rate_limit_increase'] requests per second for every second's worth of healthy responses) and is cut multiplicatively (times cfg['rate_limit_decrease']) on every throttling signal, such as HTTP 429 or an Instagram "something went wrong" page, staying between `min_rate` and `max_rate`.
+	"""
+
+	def __init__(self, name, rate, min_rate, max_rate, burst=1):
+		self.name = name
+		self.rate = rate
+		self.min_rate = min_rate
+		self.max_rate = max_rate
+		self.burst = burst
+		self._tokens = burst
+		self._updated = time.monotonic()
+		self._last_cut = 0
+		self._waiting = 0
+		self._lock = threading.Lock()
+
+	def _reserve(self):
+		""" Takes a token, going into debt if there is none, and returns how long the caller has to wait for it. """
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+			self._updated = now
+			self._tokens -= 1
+			if self._tokens >= 0: return(0)
+			return(-self._tokens / self.rate)
+
+	def acquire(self):
+		""" Blocks until the next request may be sent. Returns the number of seconds waited. """
+		wait = self._reserve()
+		if wait > 0:
+			with self._lock: self._waiting += 1
+			try:
+				time.sleep(wait)
+			finally:
+				with self._lock: self._waiting -= 1
+		return(wait)
+
+	def success(self):
+		""" Reports a healthy response: the rate grows a little. """
+		with self._lock:
+			self.rate = min(self.max_rate, self.rate + cfg['rate_limit_increase'] / self.rate)
+
+	def throttled(self):
+		""" Reports a throttling signal: the rate is cut and saved-up tokens are dropped. Signals that arrive together (from requests that were in flight at the same time) only cut the rate once. """
+		with self._lock:
+			now = time.monotonic()
+			if now - self._last_cut < 1 / self.rate: return
+			self._last_cut = now
+			self.rate = max(self.min_rate, self.rate * cfg['rate_limit_decrease'])
+			self._tokens = min(self._tokens, 0)
+		_log(f"Warning: {self.name} is throttling requests. Slowing down to {round(self.rate, 3)} requests per second.", 10)
+
+	def report(self, throttled):
+		""" Reports a response as healthy or throttled. """
+		if throttled: self.throttled()
+		else: self.success()
+
+	@property
+	def queue_depth(self):
+		""" Number of callers currently waiting for a token. """
+		return(self._waiting)
+
+	def status(self):
+		""" Returns the current rate (requests per second), the tokens available (negative when callers are queued up) and the queue depth. """
+		with self._lock:
+			tokens = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+			return({'name': self.name, 'rate': self.rate, 'tokens': tokens, 'queue_depth': self._waiting})
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name="instagram"):
+	""" Returns the shared rate limiter for a service ("instagram" or "twitter"), set up from cfg['rate_limits'] on first use. """
+	with _rate_limiters_lock:
+		if name not in _rate_limiters:
+			if name not in cfg['rate_limits']: raise RuntimeError(f"There are no rate limits for `{name}` in cfg['rate_limits'].")
+			_rate_limiters[name] = AdaptiveRateLimiter(name, **cfg['rate_limits'][name])
+		return(_rate_limiters[name])
+
+
+THROTTLING_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def _is_throttled(response, scan=None):
+	""" Returns True if an Instagram response is a sign of throttling: an HTTP 429 or 5xx status or a "something went wrong" page. `scan` is the result of _scan_page for the response, if the caller has it already. """
+	if response.status_code in THROTTLING_STATUS_CODES: return(True)
+	if scan is None: scan = _scan_page(response.content)
+	return(_THROTTLED_MARKER in scan[2])
+
+
+def _is_twitter_throttling(e):
+	""" Returns True if a tweepy error is a rate limit error. """
+	return(getattr(e, 'api_code', None) == 88 or getattr(getattr(e, 'response', None), 'status_code', None) == 429)
+
+
+def _twitter_error_message(e):
+	""" Returns the message of a tweepy error. """
+	try:
+		return(str(e.args[0][0]['message']))
+	except (IndexError, KeyError, TypeError):
+		return(str(e))
+
+
+def _call_twitter(function, *args, **kwargs):
+	""" Calls a tweepy API method through the shared Twitter rate limiter. """
+	limiter = get_rate_limiter("twitter")
+	limiter.acquire()
+	try:
+		result = function(*args, **kwargs)
+	except tweepy.TweepError as e:
+		limiter.report(_is_twitter_throttling(e))
+		raise
+	limiter.success()
+	return(result)
+
+
+def _download_twitter_locked(type, id, download):
+	""" One attempt at downloading a Twitter record, for call_with_retries, holding the record's cache lock for the attempt only (like _download_locked for Instagram). `download` calls the API once and saves the record. Returns the record, or the one another worker has saved in the meantime. """
+	with cache_lock(type, id):
+		data = _cache_get(type, id)
+		if data is not None: return(data)
+		return(download())
+
+
+# Retrying
+
+class ThrottledError(RuntimeError):
+	""" Raised when a service answers with a throttling signal (HTTP 429 or 5xx). Worth retrying later. """
+	pass
+
+
+def _is_retryable(e):
+	""" Returns True if an error is transient (a network failure, a timeout, throttling or a server error) and the call is worth retrying. Anything else (a missing or private record, a page that cannot be parsed, a bug) is fatal. """
+	if isinstance(e, (ThrottledError, ConnectionError, TimeoutError)): return(True)
+	if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)): return(True)
+	if isinstance(e, tweepy.TweepError):
+		status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+		return(_is_twitter_throttling(e) or status_code is None or status_code >= 500)
+	return(False)
+
+
+def _get_backoff(attempt):
+	""" Returns the wait before retry number `attempt`: exponential in the attempt number, capped at cfg['retry_backoff_max'] seconds, with jitter so that workers that failed together do not all retry at the same moment. """
+	wait = min(cfg['retry_backoff_max'], cfg['retry_backoff_base'] * 2 ** (attempt - 1))
+	return(wait / 2 + random.uniform(0, wait / 2))
+
+
+class CircuitBreaker(object):
+	""" Stops all workers from sending requests to a service during an outage.
+
+	After cfg['circuit_breaker_threshold'] retryable failures in a row, the circuit opens and every caller of wait() is held for cfg['circuit_breaker_cooldown'] seconds. Then one caller is let through to probe the service: if it succeeds the circuit closes, if it fails the circuit opens again for twice as long (up to cfg['circuit_breaker_max_cooldown']).
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self._failures = 0
+		self._open_until = None
+		self._probing = False
+		self._cooldown = cfg['circuit_breaker_cooldown']
+		self._condition = threading.Condition()
+
+	@property
+	def state(self):
+		with self._condition:
+			if self._open_until is None: return("closed")
+			if time.monotonic() < self._open_until: return("open")
+			return("half-open")
+
+	def wait(self):
+		""" Blocks while the circuit is open. Returns the number of seconds waited. """
+		start = time.monotonic()
+		with self._condition:
+			while self._open_until is not None:
+				now = time.monotonic()
+				if now < self._open_until:
+					self._condition.wait(self._open_until - now)
+				elif not self._probing:
+					self._probing = True
+					break
+				else:
+					self._condition.wait() # Until the probe has succeeded or failed
+		return(time.monotonic() - start)
+
+	def success(self):
+		with self._condition:
+			if self._open_until is not None: _log(f"{self.name} has recovered. Resuming requests.", 10)
+			self._failures, self._open_until, self._probing = 0, None, False
+			self._cooldown = cfg['circuit_breaker_cooldown']
+			self._condition.notify_all()
+
+	def failure(self):
+		with self._condition:
+			self._failures += 1
+			if self._probing: self._cooldown = min(cfg['circuit_breaker_max_cooldown'], self._cooldown * 2)
+			elif self._open_until is not None or self._failures < cfg['circuit_breaker_threshold']: return
+			self._open_until, self._probing = time.monotonic() + self._cooldown, False
+			self._condition.notify_all()
+		_log(f"Warning: {self.name} seems to be down ({self._failures} failures in a row). Pausing all requests for {self._cooldown} seconds.", 20)
+
+
+_circuit_breakers = {}
+
+
+def get_circuit_breaker(name="instagram"):
+	""" Returns the shared circuit breaker for a service ("instagram" or "twitter"). """
+	with _rate_limiters_lock:
+		if name not in _circuit_breakers: _circuit_breakers[name] = CircuitBreaker(name)
+		return(_circuit_breakers[name])
+
+
+def call_with_retries(function, *args, key=None, service="instagram", **kwargs):
+	""" Calls a function, retrying transient errors (see _is_retryable) up to cfg['max_attempts'] times with exponential backoff, and waiting while the service's circuit breaker is open. Fatal errors are raised straight away.
+
+	With a `key` ((type, shortcode) or (type, shortcode, id)), a call that finally fails is written to the failure records in the manifest, so that retry_failed() can try it again later, and a call that succeeds clears them.
+
+	Example:
+	- call_with_retries(download_json, type="post", shortcode=shortcode, key=("post", shortcode))
+	"""
+	breaker = get_circuit_breaker(service)
+	attempt = 0
+	while True:
+		attempt += 1
+		breaker.wait()
+		try:
+			result = function(*args, **kwargs)
+		except Exception as e:
+			retryable = _is_retryable(e)
+			if retryable: breaker.failure()
+			else: breaker.success() # The service answered
+			if not retryable or attempt >= cfg['max_attempts']:
+				if key is not None: get_cache_manifest().record_failure(*key[0:2], error=f"{e.__class__.__name__}: {e}", retryable=retryable, attempts=attempt, id=key[2] if len(key) > 2 else None)
+				raise
+			wait = _get_backoff(attempt)
+			_log(f"Debug warning: Attempt {attempt} failed ({e.__class__.__name__}: {e}). Retrying in {round(wait, 1)} seconds.", 0)
+			time.sleep(wait)
+		else:
+			breaker.success()
+			if key is not None: get_cache_manifest().clear_failure(*key[0:2])
+			return(result)
+
+
+# HTTP client
+
+_http_sessions = threading.local()
+
+
+def get_http_session():
+	""" Returns the HTTP session of the current thread, which keeps connections to Instagram alive between requests.
+
+	Sessions are kept per thread (requests does not promise that one session is safe to share) and per process (a forked child must not reuse its parent's sockets). Each one pools up to cfg['http_pool_size'] connections per host.
+	"""
+	session = getattr(_http_sessions, 'session', None)
+	if session is None or _http_sessions.pid != os.getpid():
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=cfg['http_pool_size'], pool_maxsize=cfg['http_pool_size'])
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+		session.headers.update({'User-Agent': cfg['http_user_agent'], 'Accept-Encoding': 'gzip, deflate'})
+		_http_sessions.session, _http_sessions.pid = session, os.getpid()
+	return(session)
+
+
+def http_get(url, stream=False, **kwargs):
+	""" Fetches a URL through the pooled session of the current thread, with the connect and read timeouts from cfg. Gzip-compressed responses are decompressed by requests.
+
+	Returns: The requests Response. With `stream`, the body is not read yet: read it with iter_content() or use http_download().
+	"""
+	kwargs.setdefault('timeout', (cfg['http_connect_timeout'], cfg['http_read_timeout']))
+	return(get_http_session().get(url, stream=stream, **kwargs))
+
+
+def http_download(url, path, limiter=None):
+	""" Streams a URL to a file in chunks of cfg['http_chunk_size'], without holding the whole response in memory. The file is written through a temporary file and a rename, so an interrupted download never leaves a partial file behind.
+
+	With a `limiter` (see get_rate_limiter), the download waits for it and reports the response to it.
+
+	Returns: Number of bytes written.
+	"""
+	if limiter is not None: limiter.acquire()
+	path = Path(path)
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temp_path = path.parent / f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+	size = 0
+	with http_get(url, stream=True) as response:
+		if limiter is not None: limiter.report(response.status_code in THROTTLING_STATUS_CODES)
+		if response.status_code != 200: raise RuntimeError(f"Could not download {url} (HTTP status {response.status_code}).")
+		try:
+			with open(temp_path, "wb") as f:
+				for chunk in response.iter_content(chunk_size=cfg['http_chunk_size']):
+					f.write(chunk)
+					size += len(chunk)
+			os.replace(temp_path, path)
+		except BaseException:
+			try: os.remove(temp_path)
+			except OSError: pass
+			raise
+	return(size)
+
+
+def get_json_path(type=None, shortcode=None):
+	""" Returns the path to the local JSON file for the shortcode/type.
+
+	Args:
+		type (str): Set to either "post", "user", or "place" depending on which type of Instagram post you want to return
+		shortcode (str): An Instagram shortcode
+
+	Returns:
+		str: The path to the JSON file for the shortcode/type.
+	"""
+
+	# Verify all settings
+	if type == None: raise SyntaxError('A type must be provided.')
+	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
+	if (type != "post" and 
+		type != "user" and 
+		type != "place" and 
+		type != "tweet" and 
+		type != "tweeter" and
+		type != "twitter-place"): raise SyntaxError('An unknown type format was provided.')
+
+	folder = cfg['cache_folder'] / f"__{type}s"
+	flat_path = folder / f"{shortcode}.json"
+	if cfg['cache_layout'] == "flat": return(flat_path)
+
+	# Sharded layout: while a migration is unfinished, the sharded file wins, but files that have not been migrated yet are still read from the flat directory
+	sharded_path = _get_sharded_json_path(type, shortcode)
+	if _has_flat_files(folder) and not sharded_path.exists() and flat_path.exists(): return(flat_path)
+	return(sharded_path)
+
+
+_flat_cache_folders = {}
+
+
+def _has_flat_files(folder):
+	""" Returns True if a type folder of the cache (e.g. `__posts`) still has files in the flat layout, i.e. it has not been migrated to the sharded layout (completely). Checked once per folder, as the layout only changes through migrate_cache_layout. """
+	folder = str(folder)
+	if folder not in _flat_cache_folders:
+		try:
+			with os.scandir(folder) as entries: _flat_cache_folders[folder] = any(entry.name.endswith(".json") and entry.is_file() for entry in entries)
+		except FileNotFoundError:
+			_flat_cache_folders[folder] = False
+	return(_flat_cache_folders[folder])
+
+
+def _get_shard(shortcode):
+	""" Returns the two shard directory names for a shortcode (the first four hex digits of its MD5 digest, which spreads shortcodes, usernames and tweet IDs evenly). """
+	digest = hashlib.md5(str(shortcode).encode("utf-8")).hexdigest()
+	return(digest[0:2], digest[2:4])
+
+
+def _get_sharded_json_path(type, shortcode):
+	""" Returns the path to the JSON file for the shortcode/type in the sharded cache layout, regardless of whether it exists. """
+	first, second = _get_shard(shortcode)
+	return(cfg['cache_folder'].joinpath(f"__{type}s/{first}/{second}/{shortcode}.json"))
+
+
+def _iter_cache_files(folder, pattern="*"):
+	""" Yields the paths of all cache files in a type folder (e.g. `__posts`), in both the flat and the sharded layout. """
+	folder = cfg['cache_folder'] / folder
+	for path in glob.iglob(os.path.join(folder, pattern)):
+		if os.path.isfile(path): yield(path)
+	for path in glob.iglob(os.path.join(folder, "??", "??", pattern)):
+		yield(path)
+
+
+def _migrate_cache_file(path):
+	""" Moves one flat cache file into the sharded layout. Returns True if the file was moved. """
+	path = Path(path)
+	if path.suffix != ".json": return(False)
+	destination = path.parent / "/".join(_get_shard(path.stem)) / path.name
+	try:
+		if destination.exists():
+			# The sharded file takes priority in get_json_path, so the flat copy is stale
+			os.remove(path)
+			return(False)
+		destination.parent.mkdir(parents=True, exist_ok=True)
+		os.replace(path, destination)
+		return(True)
+	except FileNotFoundError:
+		return(False) # Another migration process got here first
+
+
+def migrate_cache_layout(types=["posts", "users", "places", "tweets", "tweeters", "twitter-places"], workers=cfg['cache_migration_workers'], show_progress=True):
+	""" Moves an existing flat cache into the sharded layout.
+
+	The migration can be interrupted and restarted at any point: every run only looks at the files still left in the flat directories, and each file is moved with an atomic rename. Reads keep working while the migration runs as get_json_path falls back on the flat layout.
+
+	Returns: Number of files moved.
+	"""
+	if isinstance(types, str): types = [types]
+
+	count = 0
+	for type in types:
+		folder = cfg['cache_folder'] / f"__{type}"
+		if not folder.exists():
+			_log(f"Warning: Cache folder {folder} does not exist. Skipping.", 10)
+			continue
+
+		with os.scandir(folder) as entries:
+			files = [entry.path for entry in entries if entry.is_file() and entry.name.endswith(".json")]
+		_log(f"Migrating {len(files)} files in {folder} to the sharded cache layout...", 10)
+
+		if show_progress:
+			i = 0
+			bar = progressbar.ProgressBar(max_value=len(files)).start()
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			for moved in executor.map(_migrate_cache_file, files):
+				if moved: count += 1
+				if show_progress:
+					i += 1
+					bar.update(i)
+
+		if show_progress: bar.finish()
+		_flat_cache_folders.pop(str(folder), None) # Checked again on the next lookup
+
+	return(count)
+
+
+# Record codecs
+
+class RecordCodec(object):
+	""" Interface for the serializers that turn cache records into bytes and back. """
+
+	name = None
+
+	def dumps(self, data):
+		""" Returns the serialized record as bytes. """
+		raise NotImplementedError
+
+	def loads(self, raw):
+		""" Returns the record from its serialized bytes (or a memoryview of them). """
+		raise NotImplementedError
+
+
+class StdlibJSONCodec(RecordCodec):
+	""" JSON through the standard library. Always available. """
+
+	name = "json"
+
+	def dumps(self, data):
+		return(json.dumps(data).encode("utf-8"))
+
+	def loads(self, raw):
+		if isinstance(raw, memoryview): raw = bytes(raw)
+		return(json.loads(raw))
+
+
+class OrjsonCodec(RecordCodec):
+	""" JSON through orjson (needs `pip install orjson`). """
+
+	name = "orjson"
+
+	def dumps(self, data):
+		return(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS))
+
+	def loads(self, raw):
+		return(orjson.loads(raw))
+
+
+class MsgspecCodec(RecordCodec):
+	""" JSON through msgspec (needs `pip install msgspec`). """
+
+	name = "msgspec"
+
+	def __init__(self):
+		self._encoder = msgspec.json.Encoder()
+		self._decoder = msgspec.json.Decoder()
+
+	def dumps(self, data):
+		return(self._encoder.encode(data))
+
+	def loads(self, raw):
+		return(self._decoder.decode(raw))
+
+
+class MsgpackCodec(RecordCodec):
+	""" The binary MessagePack format, through msgspec or msgpack (needs `pip install msgspec` or `pip install msgpack`). Smaller and faster to read than JSON, but the records can no longer be read with a text editor. """
+
+	name = "msgpack"
+
+	def __init__(self):
+		if msgspec is None and msgpack is None: raise RuntimeError("The msgpack record format needs msgspec or msgpack (`pip install msgspec`).")
+		self._encoder, self._decoder = None, None
+		if msgspec is not None: self._encoder, self._decoder = msgspec.msgpack.Encoder(), msgspec.msgpack.Decoder()
+
+	def dumps(self, data):
+		if self._encoder is not None: return(self._encoder.encode(data))
+		return(msgpack.packb(data, use_bin_type=True))
+
+	def loads(self, raw):
+		if self._decoder is not None: return(self._decoder.decode(raw))
+		return(msgpack.unpackb(raw, raw=False, strict_map_key=False))
+
+
+RECORD_CODECS = {
+	'orjson': OrjsonCodec,
+	'msgspec': MsgspecCodec,
+	'json': StdlibJSONCodec,
+	'msgpack': MsgpackCodec,
+}
+
+_AVAILABLE_JSON_CODECS = [name for name, module in [('orjson', orjson), ('msgspec', msgspec), ('json', json)] if module is not None]
+
+_record_codecs = {}
+
+
+def get_record_codec(name=None):
+	""" Returns a record codec by name, or the JSON codec set in cfg['cache_json_codec'] (`auto` picks the fastest one that is installed: orjson, msgspec, then the standard library). """
+	if name is None: name = cfg['cache_json_codec']
+	if name == "auto": name = _AVAILABLE_JSON_CODECS[0]
+	if name not in _record_codecs:
+		if name not in RECORD_CODECS: raise RuntimeError(f"Cannot understand record codec `{name}`. Available codecs: {list(RECORD_CODECS.keys())}.")
+		if name in ['orjson', 'msgspec'] and name not in _AVAILABLE_JSON_CODECS: raise RuntimeError(f"The record codec `{name}` is not installed (`pip install {name}`).")
+		_record_codecs[name] = RECORD_CODECS[name]()
+	return(_record_codecs[name])
+
+
+def _serialize_record(data):
+	""" Serializes a cache record to (uncompressed) bytes in the format set in cfg['cache_record_format']. MessagePack records start with a zero byte and `IM`, which JSON text never starts with. """
+	if cfg['cache_record_format'] == "msgpack": return(_MSGPACK_MAGIC + get_record_codec("msgpack").dumps(data))
+	elif cfg['cache_record_format'] == "json": return(get_record_codec().dumps(data))
+	else: raise RuntimeError(f"Cannot understand cache record format `{cfg['cache_record_format']}`. Use `json` or `msgpack`.")
+
+
+def _deserialize_record(raw):
+	""" Deserializes (uncompressed) record bytes in either format. """
+	if raw[0:3] == _MSGPACK_MAGIC: return(get_record_codec("msgpack").loads(raw[3:]))
+	return(get_record_codec().loads(raw))
+
+
+def _synthetic_post(n):
+	""" Returns a made-up post record shaped like the output of _clean_post, for benchmarks. """
+	words = ["burlesque", "show", "tonight", "new", "york", "stage", "glitter", "costume", "dance", "vintage", "love", "thanks"]
+	rng = random.Random(n)
+	sentence = lambda length: " ".join(rng.choice(words) for _ in range(length))
+	return({
+		'__typename': "GraphImage",
+		'id': str(1900000000000000000 + n),
+		'shortcode': "".join(rng.choice(string.ascii_letters + string.digits + "_-") for _ in range(11)),
+		'dimensions': {'height': 1080, 'width': 1080},
+		'display_url': f"https://scontent.cdninstagram.com/vp/{rng.getrandbits(128):032x}/{n}_n.jpg",
+		'accessibility_caption': sentence(12),
+		'caption_is_edited': False,
+		'comments_disabled': False,
+		'taken_at_timestamp': 1500000000 + rng.randint(0, 10**8),
+		'location': {'id': str(rng.randint(10**6, 10**9)), 'has_public_page': True, 'name': sentence(2), 'slug': "-".join(sentence(2).split())} if rng.random() < 0.4 else None,
+		'is_ad': False,
+		'caption': sentence(rng.randint(5, 60)) + " " + " ".join(f"#{rng.choice(words)}" for _ in range(rng.randint(0, 15))),
+		'owner': f"user_{rng.randint(0, 5000)}",
+		'owner_is_private': False,
+		'comments': [{'created_at': 1500000000 + rng.randint(0, 10**8), 'text': sentence(rng.randint(1, 20)), 'owner': f"user_{rng.randint(0, 5000)}", 'num_liked_by': rng.randint(0, 20)} for _ in range(rng.randint(0, 30))],
+		'num_comments': rng.randint(0, 200),
+		'likes': [f"user_{rng.randint(0, 5000)}" for _ in range(rng.randint(0, 10))],
+		'num_likes': rng.randint(0, 3000),
+		'tagged': [{'username': f"user_{rng.randint(0, 5000)}", 'x': rng.random(), 'y': rng.random()} for _ in range(rng.randint(0, 3))],
+		'sponsor_users': [],
+		'_schema_version': CACHE_SCHEMA_VERSIONS['post'],
+	})
+
+
+def benchmark_codecs(records=2000, repeat=3):
+	""" Compares encode and decode throughput of the installed record codecs on a synthetic corpus of `records` posts shaped like the output of _clean_post.
+
+	Returns: A pandas DataFrame with one row per codec.
+	"""
+	corpus = [_synthetic_post(n) for n in range(records)]
+	json_bytes = sum(len(StdlibJSONCodec().dumps(data)) for data in corpus)
+
+	codecs = list(_AVAILABLE_JSON_CODECS)
+	if msgspec is not None or msgpack is not None: codecs.append("msgpack")
+
+	results = []
+	for name in codecs:
+		codec = get_record_codec(name)
+
+		write_seconds, read_seconds = None, None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			encoded = [codec.dumps(data) for data in corpus]
+			elapsed = time.perf_counter() - start
+			if write_seconds is None or elapsed < write_seconds: write_seconds = elapsed
+
+			start = time.perf_counter()
+			for raw in encoded: codec.loads(raw)
+			elapsed = time.perf_counter() - start
+			if read_seconds is None or elapsed < read_seconds: read_seconds = elapsed
+
+		results.append({
+			'codec': name,
+			'bytes': sum(len(raw) for raw in encoded),
+			'decode_records_per_second': int(records / read_seconds),
+			'decode_mb_per_second': round(json_bytes / read_seconds / 1024 / 1024, 1),
+			'encode_records_per_second': int(records / write_seconds),
+		})
+
+	return(pd.DataFrame(results))
+
+
+# Cache backends
+
+def _encode_record(data, type=None):
+	""" Serializes a cache record to bytes (see _serialize_record), compressing it if cfg['cache_compression'] is set.
+
+	Compressed records start with a header that JSON text can never start with: a zero byte, `IG`, the codec (`z` for zlib, `x` for lzma) and the 8 character ID of the preset dictionary (`00000000` for none). Records below cfg['cache_compression_min_size'] bytes (such as empty records) are always stored as plain JSON.
+	"""
+	raw = _serialize_record(data)
+	if cfg['cache_compression'] is None or len(raw) < cfg['cache_compression_min_size']: return(raw)
+
+	if cfg['cache_compression'] == "zlib":
+		dictionary_id = _get_current_dictionary_id(type)
+		if dictionary_id is None:
+			compressor = zlib.compressobj(cfg['cache_compression_level'])
+			dictionary_id = _NO_DICTIONARY
+		else:
+			compressor = zlib.compressobj(cfg['cache_compression_level'], zdict=_get_compression_dictionary(dictionary_id))
+		return(_COMPRESSION_MAGIC + b"z" + dictionary_id.encode("ascii") + compressor.compress(raw) + compressor.flush())
+	elif cfg['cache_compression'] == "lzma":
+		# The lzma module does not support preset dictionaries
+		return(_COMPRESSION_MAGIC + b"x" + _NO_DICTIONARY.encode("ascii") + lzma.compress(raw, preset=cfg['cache_compression_level']))
+	else:
+		raise RuntimeError(f"Cannot understand cache compression `{cfg['cache_compression']}`. Use None, `zlib` or `lzma`.")
+
+
+def _decode_record(raw):
+	""" Deserializes a cache record from bytes, decompressing it if needed. """
+	if raw[0:3] == _COMPRESSION_MAGIC:
+		codec, dictionary_id, payload = raw[3:4], bytes(raw[4:12]).decode("ascii"), raw[12:]
+		if codec == b"z":
+			if dictionary_id == _NO_DICTIONARY: raw = zlib.decompress(payload)
+			else:
+				decompressor = zlib.decompressobj(zdict=_get_compression_dictionary(dictionary_id))
+				raw = decompressor.decompress(payload) + decompressor.flush()
+		elif codec == b"x":
+			raw = lzma.decompress(payload)
+		else:
+			raise RuntimeError(f"Cannot understand the compression of a cache record (codec `{codec}`).")
+	return(_deserialize_record(raw))
+
+
+# Compression dictionaries
+
+_COMPRESSION_MAGIC = b"\x00IG"
+_MSGPACK_MAGIC = b"\x00IM"
+_NO_DICTIONARY = "00000000"
+_compression_dictionaries = {}
+_current_dictionary_ids = {}
+
+
+def _get_dictionary_folder():
+	return(cfg['cache_folder'] / "__dictionaries")
+
+
+def _get_compression_dictionary(dictionary_id):
+	""" Returns the preset dictionary with the given ID. """
+	if dictionary_id not in _compression_dictionaries:
+		try:
+			with open(_get_dictionary_folder() / f"{dictionary_id}.zdict", "rb") as f: _compression_dictionaries[dictionary_id] = f.read()
+		except FileNotFoundError:
+			raise RuntimeError(f"The compression dictionary {dictionary_id} is missing from {_get_dictionary_folder()}. Records compressed with it cannot be read.") from None
+	return(_compression_dictionaries[dictionary_id])
+
+
+def _get_current_dictionary_id(type=None):
+	""" Returns the ID of the dictionary that new records of a type are compressed with, or None if no dictionary has been trained for the type. """
+	if type is None or not cfg['cache_compression_dictionary']: return(None)
+	if type not in _current_dictionary_ids:
+		try:
+			with open(_get_dictionary_folder() / f"current-{type}", "r") as f: _current_dictionary_ids[type] = f.read().strip()
+		except FileNotFoundError:
+			_current_dictionary_ids[type] = None
+	return(_current_dictionary_ids[type])
+
+
+def _sample_cache_records(type="post", sample=1000):
+	""" Returns a random sample of the non-empty records of a type in the cache, as the bytes that new records are written as (see _serialize_record), before compression. """
+	backend = get_cache_backend()
+	shortcodes = list(backend.iterate(type))
+	if len(shortcodes) > sample: shortcodes = random.sample(shortcodes, sample)
+	records = []
+	for shortcode in shortcodes:
+		data = backend.get(type, shortcode)
+		if data: records.append(_serialize_record(data))
+	return(records)
+
+
+def train_compression_dictionary(type="post", sample=1000, size=32768):
+	""" Trains a zlib preset dictionary on a sample of the records of a type in the cache, and uses it for all new records of the type.
+
+	The dictionary is made up of the fragments (keys with short values, string values, URL prefixes) that occur in the most records, weighted by their length. The most valuable fragments go at the end of the dictionary, where zlib can reach them with the shortest distances. Old dictionaries are kept, as records compressed with them point to them by ID.
+
+	Returns: The ID of the new dictionary.
+	"""
+	if cfg['cache_record_format'] == "msgpack": raise RuntimeError("Compression dictionaries are made of JSON fragments, and do not help with the msgpack record format. Use cfg['cache_record_format'] = 'json' to train one.")
+	records = _sample_cache_records(type=type, sample=sample)
+	if len(records) == 0: raise RuntimeError(f"There are no {type} records in the cache to train a dictionary on.")
+
+	# Keys are followed by a space with the standard library's json, and not with orjson or msgspec
+	fragments = re.compile(rb'"[A-Za-z_]+":\s?(?:true|false|null|\d{1,3}|\[\]|""|\{\})?|https?://[^/"]+/|"[^"\\]{4,120}"')
+	counts = collections.Counter()
+	for record in records:
+		counts.update(set(fragments.findall(record)))
+
+	ranked = sorted([(count * len(fragment), fragment) for fragment, count in counts.items() if count > 1], reverse=True)
+	picked, length = [], 0
+	for _, fragment in ranked:
+		if length + len(fragment) > size: continue
+		picked.append(fragment)
+		length += len(fragment)
+	dictionary = b"".join(reversed(picked))
+
+	dictionary_id = hashlib.sha1(dictionary).hexdigest()[0:8]
+	folder = _get_dictionary_folder()
+	folder.mkdir(parents=True, exist_ok=True)
+	_atomic_write(folder / f"{dictionary_id}.zdict", dictionary)
+	_atomic_write(folder / f"current-{type}", dictionary_id.encode("utf-8"))
+	_compression_dictionaries[dictionary_id] = dictionary
+	_current_dictionary_ids[type] = dictionary_id
+
+	_log(f"Trained compression dictionary {dictionary_id} ({len(dictionary)} bytes) on {len(records)} {type} records.", 10)
+	return(dictionary_id)
+
+
+def benchmark_compression(type="post", sample=500, levels=[1, 6, 9], repeat=3):
+	""" Compares size and read throughput of the cache records of a type across compression settings (none, zlib with and without the trained dictionary, lzma).
+
+	Returns: A pandas DataFrame with one row per setting.
+	"""
+	records = _sample_cache_records(type=type, sample=sample)
+	if len(records) == 0: raise RuntimeError(f"There are no {type} records in the cache to benchmark.")
+	raw_bytes = sum(len(record) for record in records)
+
+	settings = [(None, 0, False)]
+	for level in levels:
+		settings.append(("zlib", level, False))
+		if _get_current_dictionary_id(type) is not None: settings.append(("zlib", level, True))
+		settings.append(("lzma", level, False))
+
+	_cfg = {k: cfg[k] for k in ['cache_compression', 'cache_compression_level', 'cache_compression_dictionary', 'cache_compression_min_size']}
+	results = []
+	try:
+		for compression, level, dictionary in settings:
+			cfg.update({'cache_compression': compression, 'cache_compression_level': level, 'cache_compression_dictionary': dictionary, 'cache_compression_min_size': 0})
+
+			data = [_deserialize_record(record) for record in records]
+			start = time.perf_counter()
+			encoded = [_encode_record(d, type) for d in data]
+			write_seconds = time.perf_counter() - start
+
+			read_seconds = None
+			for _ in range(repeat):
+				start = time.perf_counter()
+				for record in encoded: _decode_record(record)
+				elapsed = time.perf_counter() - start
+				if read_seconds is None or elapsed < read_seconds: read_seconds = elapsed
+
+			size = sum(len(record) for record in encoded)
+			results.append({
+				'compression': compression or "none",
+				'level': level,
+				'dictionary': dictionary,
+				'bytes': size,
+				'ratio': round(raw_bytes / size, 2),
+				'read_records_per_second': int(len(encoded) / read_seconds),
+				'read_mb_per_second': round(raw_bytes / read_seconds / 1024 / 1024, 1),
+				'write_mb_per_second': round(raw_bytes / write_seconds / 1024 / 1024, 1),
+			})
+	finally:
+		cfg.update(_cfg)
+
+	return(pd.DataFrame(results))
+
+
+# Cache locks and durable writes
+
+_thread_locks = {}
+_lock_files = {}
+_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+	""" Holds an exclusive lock on a lock file, shared between all threads and processes that use the same path. Without fcntl (on Windows), only the threads of this process are locked out. """
+	path = Path(path)
+	with _locks_lock:
+		if path not in _thread_locks: _thread_locks[path] = threading.Lock()
+		thread_lock = _thread_locks[path]
+
+	with thread_lock:
+		if fcntl is None:
+			yield
+			return
+
+		# Lock files are opened once per process: after a fork, the parent's file would share its lock with the child
+		key = (os.getpid(), path)
+		with _locks_lock:
+			if key not in _lock_files:
+				path.parent.mkdir(parents=True, exist_ok=True)
+				_lock_files[key] = open(path, "a+b")
+			lock_file = _lock_files[key]
+
+		fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def cache_lock(type, shortcode):
+	""" Returns a lock for one cache record, shared between all threads and processes that use the same cache folder. Downloaders hold it while they check for and download a record, so two processes never download the same record at once.
+
+	Records are spread over cfg['cache_lock_stripes'] lock files in the __locks folder, so the number of lock files stays fixed however large the cache gets. The lock is not re-entrant.
+
+	The sqlite backend and the manifest make writes visible to other processes when their batch is committed, so downloaders that share an sqlite cache should lower cfg['cache_sqlite_batch_size'] to avoid downloading a record twice.
+
+	Example:
+	- with cache_lock("post", shortcode): ...
+	"""
+	stripe = int(hashlib.md5(f"{type}/{shortcode}".encode("utf-8")).hexdigest()[0:8], 16) % cfg['cache_lock_stripes']
+	return(_file_lock(cfg['cache_folder'] / "__locks" / f"{stripe:04x}.lock"))
+
+
+def _fsync_folder(folder):
+	""" Makes a rename or a new file in a folder durable. Not possible (or needed) on Windows. """
+	try:
+		fd = os.open(folder, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+
+def _atomic_write(path, raw, fsync=False):
+	""" Writes bytes to a file through a temporary file in the same folder and a rename, so readers never see a partly written file and concurrent writers never mix their data (the last rename wins).
+
+	With `fsync`, the data and the rename are on disk before the function returns.
+	"""
+	with _atomic_file(path, fsync=fsync) as f: f.write(raw)
+
+
+@contextlib.contextmanager
+def _atomic_file(path, fsync=False):
+	""" Like _atomic_write, for writing a file bit by bit: yields the temporary file (opened for writing bytes), and renames it to `path` when the block ends without an error. """
+	path = Path(path)
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temp_path = path.parent / f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+	try:
+		with open(temp_path, "wb") as f:
+			yield(f)
+			if fsync:
+				f.flush()
+				os.fsync(f.fileno())
+		os.replace(temp_path, path)
+	except BaseException:
+		try: os.remove(temp_path)
+		except OSError: pass
+		raise
+	if fsync: _fsync_folder(path.parent)
+
+
+class CacheBackend(object):
+	""" Interface for cache stores.
+
+	Records are addressed by a type ("post", "user", "place", "tweet", "tweeter" or "twitter-place") and a shortcode, and hold the decoded JSON data. Empty records (posts that were deleted, users that do not exist, etc.) are stored as an empty string.
+	"""
+
+	name = None
+
+	def get(self, type, shortcode):
+		""" Returns the data for a record, or None if the record is not in the cache. """
+		raw = self.get_raw(type, shortcode)
+		if raw is None: return(None)
+		return(_decode_record(raw))
+
+	def put(self, type, shortcode, data):
+		""" Stores the data for a record, replacing any earlier version. Returns the size of the stored record in bytes. """
+		return(self.put_raw(type, shortcode, _encode_record(data, type)))
+
+	def get_raw(self, type, shortcode):
+		""" Returns the stored bytes of a record (as written by _encode_record), or None if the record is not in the cache. """
+		raise NotImplementedError
+
+	def put_raw(self, type, shortcode, raw):
+		""" Stores the bytes of a record (as written by _encode_record). Returns the size of the stored record in bytes. """
+		raise NotImplementedError
+
+	def exists(self, type, shortcode):
+		""" Returns True if the record is in the cache. """
+		raise NotImplementedError
+
+	def delete(self, type, shortcode):
+		""" Removes a record from the cache. Returns True if there was a record to remove. """
+		raise NotImplementedError
+
+	def iterate(self, type):
+		""" Yields the shortcodes of all records of a type. """
+		raise NotImplementedError
+
+	def metadata(self, type, shortcode):
+		""" Returns a dictionary with the `downloaded` timestamp and the `size` in bytes of a record, or None if the record is not in the cache. """
+		raise NotImplementedError
+
+	@contextlib.contextmanager
+	def batch(self):
+		""" Groups the writes made inside the block. Backends that do not support it just write straight away. """
+		yield(self)
+
+	def flush(self):
+		""" Makes sure all writes have reached the disk. """
+		pass
+
+	def close(self):
+		self.flush()
+
+
+class FileSystemBackend(CacheBackend):
+	""" The standard cache store: one JSON file per record, at the location returned by get_json_path.
+
+	Every write goes through a temporary file and a rename, so several processes can share the cache. With cfg['cache_fsync'] set to 'batch', written files are fsynced together at the end of every `batch()` block, every cfg['cache_fsync_batch_size'] writes and on exit.
+	"""
+
+	name = "filesystem"
+
+	def __init__(self):
+		self._unsynced = set()
+		self._batch_depth = 0
+		self._lock = threading.RLock()
+		atexit.register(self.flush)
+
+	def get_raw(self, type, shortcode):
+		path = get_json_path(type=type, shortcode=shortcode)
+		try:
+			with open(path, "rb") as f: return(f.read())
+		except FileNotFoundError:
+			# The file may just have been moved by migrate_cache_layout, so resolve the path again
+			if get_json_path(type=type, shortcode=shortcode) != path: return(self.get_raw(type, shortcode))
+			return(None)
+
+	def put_raw(self, type, shortcode, raw):
+		path = get_json_path(type=type, shortcode=shortcode)
+		_atomic_write(path, raw, fsync=cfg['cache_fsync'] == "always")
+		if cfg['cache_fsync'] == "batch":
+			with self._lock:
+				self._unsynced.add(path)
+				if self._batch_depth == 0 and len(self._unsynced) >= cfg['cache_fsync_batch_size']: self.flush()
+		return(len(raw))
+
+	def exists(self, type, shortcode):
+		return(get_json_path(type=type, shortcode=shortcode).exists())
+
+	def delete(self, type, shortcode):
+		try:
+			os.remove(get_json_path(type=type, shortcode=shortcode))
+			return(True)
+		except FileNotFoundError:
+			return(False)
+
+	def iterate(self, type):
+		for path in _iter_cache_files(f"__{type}s", "*.json"):
+			yield(Path(path).stem)
+
+	def metadata(self, type, shortcode):
+		try:
+			stat = os.stat(get_json_path(type=type, shortcode=shortcode))
+		except FileNotFoundError:
+			return(None)
+		return({'downloaded': stat.st_ctime, 'size': stat.st_size})
+
+	@contextlib.contextmanager
+	def batch(self):
+		with self._lock:
+			self._batch_depth += 1
+		try:
+			yield(self)
+		finally:
+			with self._lock:
+				self._batch_depth -= 1
+				if self._batch_depth == 0: self.flush()
+
+	def flush(self):
+		with self._lock:
+			paths, self._unsynced = self._unsynced, set()
+		for path in paths:
+			try:
+				fd = os.open(path, os.O_RDONLY)
+			except FileNotFoundError:
+				continue
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+		for folder in set(path.parent for path in paths): _fsync_folder(folder)
+
+
+class SQLiteBackend(CacheBackend):
+	""" Keeps the whole cache in one SQLite database file.
+
+	The database runs in WAL mode so readers in other processes are not blocked by a writer. Writes are queued in memory and committed in batches of cfg['cache_sqlite_batch_size'] (and at the end of every `batch()` block and on exit), so a build that downloads many records does not pay for one transaction per record, and other processes writing to the same database only ever wait for one short transaction.
+	"""
+
+	name = "sqlite"
+
+	def __init__(self, path=None, batch_size=None):
+		if path is None: path = cfg['cache_sqlite_path'] or cfg['cache_folder'] / "cache.sqlite"
+		if batch_size is None: batch_size = cfg['cache_sqlite_batch_size']
+
+		self.path = Path(path)
+		self.batch_size = batch_size
+		self._queue = {}
+		self._batch_depth = 0
+		self._lock = threading.RLock()
+
+		self._db = _connect_sqlite(self.path)
+		self._db.execute("""CREATE TABLE IF NOT EXISTS records (
+			type TEXT NOT NULL,
+			shortcode TEXT NOT NULL,
+			data BLOB NOT NULL,
+			downloaded REAL NOT NULL,
+			size INTEGER NOT NULL,
+			PRIMARY KEY (type, shortcode)
+		) WITHOUT ROWID""")
+		self._db.commit()
+		atexit.register(self.flush)
+
+	def get_raw(self, type, shortcode):
+		key = (type, str(shortcode))
+		with self._lock:
+			if key in self._queue: return(self._queue[key][0] if self._queue[key] is not None else None)
+			row = self._db.execute("SELECT data FROM records WHERE type = ? AND shortcode = ?", (type, str(shortcode))).fetchone()
+		if row is None: return(None)
+		return(row[0])
+
+	def put_raw(self, type, shortcode, raw):
+		with self._lock:
+			self._queue[(type, str(shortcode))] = (raw, time.time())
+			self._written()
+		return(len(raw))
+
+	def exists(self, type, shortcode):
+		key = (type, str(shortcode))
+		with self._lock:
+			if key in self._queue: return(self._queue[key] is not None)
+			row = self._db.execute("SELECT 1 FROM records WHERE type = ? AND shortcode = ?", (type, str(shortcode))).fetchone()
+		return(row is not None)
+
+	def delete(self, type, shortcode):
+		with self._lock:
+			existed = self.exists(type, shortcode)
+			self._queue[(type, str(shortcode))] = None
+			self._written()
+		return(existed)
+
+	def iterate(self, type):
+		with self._lock:
+			self.flush()
+			rows = self._db.execute("SELECT shortcode FROM records WHERE type = ?", (type,)).fetchall()
+		for row in rows: yield(row[0])
+
+	def metadata(self, type, shortcode):
+		key = (type, str(shortcode))
+		with self._lock:
+			if key in self._queue:
+				if self._queue[key] is None: return(None)
+				return({'downloaded': self._queue[key][1], 'size': len(self._queue[key][0])})
+			row = self._db.execute("SELECT downloaded, size FROM records WHERE type = ? AND shortcode = ?", (type, str(shortcode))).fetchone()
+		if row is None: return(None)
+		return({'downloaded': row[0], 'size': row[1]})
+
+	@contextlib.contextmanager
+	def batch(self):
+		with self._lock:
+			self._batch_depth += 1
+		try:
+			yield(self)
+		finally:
+			with self._lock:
+				self._batch_depth -= 1
+				if self._batch_depth == 0: self.flush()
+
+	def _written(self):
+		if self._batch_depth == 0 and len(self._queue) >= self.batch_size: self.flush()
+
+	def flush(self):
+		with self._lock:
+			if len(self._queue) == 0: return
+			writes = [(type, shortcode, entry[0], entry[1], len(entry[0])) for (type, shortcode), entry in self._queue.items() if entry is not None]
+			deletes = [key for key, entry in self._queue.items() if entry is None]
+			with self._db:
+				self._db.executemany("INSERT OR REPLACE INTO records (type, shortcode, data, downloaded, size) VALUES (?, ?, ?, ?, ?)", writes)
+				self._db.executemany("DELETE FROM records WHERE type = ? AND shortcode = ?", deletes)
+			self._queue = {}
+
+	def close(self):
+		self.flush()
+		with self._lock: self._db.close()
+
+
+class SegmentBackend(CacheBackend):
+	""" Packs all records into large append-only segment files.
+
+	Every write appends the record to the current segment and an entry to the index, which maps each (type, shortcode) to its (segment, offset, length). The index is read into memory once and records are read through `mmap`, so loading a record costs no open() or stat() calls. Re-downloaded records leave the old copy behind in its segment until `compact()` is run.
+
+	Several processes can write to the same segments folder: appends are serialised by a lock on writer.lock, and every writer first reads the index entries the others have written. compact() is not safe to run while other processes use the folder.
+
+	Layout of the segments folder:
+	- segment-00000.dat, segment-00001.dat, ...: records, each written as a header (magic, lengths of type, shortcode and data) followed by the type, the shortcode and the data.
+	- index.dat: index entries (type, shortcode, segment, offset, length, download time). A length of 0xFFFFFFFF marks a deleted record.
+	"""
+
+	name = "segments"
+
+	_RECORD_MAGIC = b"IGR1"
+	_RECORD_HEADER = struct.Struct("<4sHHI")
+	_INDEX_HEADER = struct.Struct("<HHIQId")
+	_DELETED = 0xFFFFFFFF
+
+	def __init__(self, path=None, segment_size=None):
+		if path is None: path = cfg['cache_segments_folder'] or cfg['cache_folder'] / "__segments"
+		if segment_size is None: segment_size = cfg['cache_segment_size']
+
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.segment_size = segment_size
+		self._lock = threading.RLock()
+		self._index = {}
+		self._maps = {}
+		self._index_position = 0
+
+		self._index_file = open(self.path / "index.dat", "ab")
+		self._refresh_index()
+
+		segments = self._segment_numbers()
+		self._segment_number = segments[-1] if len(segments) > 0 else 0
+		self._segment_file = open(self._segment_path(self._segment_number), "ab")
+
+	def _segment_path(self, number):
+		return(self.path / f"segment-{number:05d}.dat")
+
+	def _segment_numbers(self):
+		return(sorted(int(p.stem.split("-")[1]) for p in self.path.glob("segment-*.dat")))
+
+	def _refresh_index(self):
+		""" Reads the index entries written since the last refresh (by this or another process). """
+		index_path = self.path / "index.dat"
+		size = os.path.getsize(index_path)
+		if size <= self._index_position: return(False)
+
+		with open(index_path, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+				position = self._index_position
+				while position + self._INDEX_HEADER.size <= size:
+					type_length, shortcode_length, segment, offset, length, downloaded = self._INDEX_HEADER.unpack_from(index, position)
+					position += self._INDEX_HEADER.size
+					if position + type_length + shortcode_length > size: break # An entry that is still being written
+					type = index[position:position+type_length].decode("utf-8")
+					position += type_length
+					shortcode = index[position:position+shortcode_length].decode("utf-8")
+					position += shortcode_length
+
+					if length == self._DELETED: self._index.pop((type, shortcode), None)
+					else: self._index[(type, shortcode)] = (segment, offset, length, downloaded)
+				self._index_position = position
+		return(True)
+
+	def _write_index_entry(self, type, shortcode, segment, offset, length, downloaded):
+		_type, _shortcode = type.encode("utf-8"), shortcode.encode("utf-8")
+		entry = self._INDEX_HEADER.pack(len(_type), len(_shortcode), segment, offset, length, downloaded) + _type + _shortcode
+		self._index_file.write(entry)
+		self._index_file.flush()
+		self._index_position += len(entry)
+
+	def _map(self, segment, end):
+		""" Returns a memory map of a segment that covers at least `end` bytes. """
+		_map = self._maps.get(segment)
+		if _map is None or len(_map) < end:
+			if _map is not None: _map.close()
+			with open(self._segment_path(segment), "rb") as f:
+				_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			self._maps[segment] = _map
+		return(_map)
+
+	def _lookup(self, type, shortcode):
+		key = (type, str(shortcode))
+		with self._lock:
+			entry = self._index.get(key)
+			if entry is None and self._refresh_index(): entry = self._index.get(key)
+		return(entry)
+
+	def get_raw(self, type, shortcode):
+		entry = self._lookup(type, shortcode)
+		if entry is None: return(None)
+		segment, offset, length, _ = entry
+		with self._lock:
+			return(self._map(segment, offset + length)[offset:offset+length])
+
+	def _writing(self):
+		""" Returns the lock that writers of the segments folder hold, shared with other processes. """
+		return(_file_lock(self.path / "writer.lock"))
+
+	def _append(self, type, shortcode, raw, downloaded, refresh=True):
+		""" Appends a record to the current segment and the index. Has to be called while holding the lock and the writer lock. """
+		if refresh: self._refresh_index()
+		self._segment_file.seek(0, os.SEEK_END) # Other processes may have appended since our last write
+		if self._segment_file.tell() > 0 and self._segment_file.tell() + len(raw) > self.segment_size:
+			self._segment_file.close()
+			self._segment_number += 1
+			self._segment_file = open(self._segment_path(self._segment_number), "ab")
+
+		_type, _shortcode = type.encode("utf-8"), shortcode.encode("utf-8")
+		header = self._RECORD_HEADER.pack(self._RECORD_MAGIC, len(_type), len(_shortcode), len(raw))
+		offset = self._segment_file.tell() + len(header) + len(_type) + len(_shortcode)
+		self._segment_file.write(header + _type + _shortcode + raw)
+		self._segment_file.flush()
+
+		self._write_index_entry(type, shortcode, self._segment_number, offset, len(raw), downloaded)
+		self._index[(type, shortcode)] = (self._segment_number, offset, len(raw), downloaded)
+		if cfg['cache_fsync'] == "always": self._sync()
+
+	def put_raw(self, type, shortcode, raw):
+		with self._lock, self._writing():
+			self._append(type, str(shortcode), raw, time.time())
+		return(len(raw))
+
+	def exists(self, type, shortcode):
+		return(self._lookup(type, shortcode) is not None)
+
+	def delete(self, type, shortcode):
+		key = (type, str(shortcode))
+		with self._lock, self._writing():
+			self._refresh_index()
+			if self._lookup(*key) is None: return(False)
+			self._write_index_entry(key[0], key[1], 0, 0, self._DELETED, time.time())
+			del(self._index[key])
+		return(True)
+
+	def iterate(self, type):
+		with self._lock:
+			self._refresh_index()
+			shortcodes = [shortcode for (_type, shortcode) in self._index.keys() if _type == type]
+		for shortcode in shortcodes: yield(shortcode)
+
+	def metadata(self, type, shortcode):
+		entry = self._lookup(type, shortcode)
+		if entry is None: return(None)
+		return({'downloaded': entry[3], 'size': entry[2]})
+
+	def stats(self):
+		""" Returns the number of live records, the bytes they take up and the total size of all segments. """
+		with self._lock:
+			self._refresh_index()
+			live_bytes = sum(entry[2] for entry in self._index.values())
+			total_bytes = sum(os.path.getsize(self._segment_path(number)) for number in self._segment_numbers())
+			return({'records': len(self._index), 'live_bytes': live_bytes, 'total_bytes': total_bytes})
+
+	def compact(self):
+		""" Rewrites the live records into new segments and drops the superseded ones (e.g. posts re-downloaded with force_download=True) and deleted ones. Run it while no other process is using the segment cache.
+
+		Returns: Number of bytes freed.
+		"""
+		with self._lock, self._writing():
+			self._refresh_index()
+			before = self.stats()['total_bytes']
+			old_segments = self._segment_numbers()
+			old_index = self._index
+
+			# Start a new segment and a new index, and copy every live record over
+			self._segment_file.close()
+			self._segment_number = old_segments[-1] + 1 if len(old_segments) > 0 else 0
+			self._segment_file = open(self._segment_path(self._segment_number), "ab")
+			self._index_file.close()
+			self._index_file = open(self.path / "index.dat.compacting", "wb")
+			self._index, self._index_position = {}, 0
+
+			for (type, shortcode), (segment, offset, length, downloaded) in old_index.items():
+				raw = self._map(segment, offset + length)[offset:offset+length]
+				self._append(type, shortcode, raw, downloaded, refresh=False)
+
+			self._index_file.close()
+			os.replace(self.path / "index.dat.compacting", self.path / "index.dat")
+			self._index_file = open(self.path / "index.dat", "ab")
+
+			for number in old_segments:
+				if number in self._maps: self._maps.pop(number).close()
+				os.remove(self._segment_path(number))
+
+			freed = before - self.stats()['total_bytes']
+		_log(f"Compacted the segment cache in {self.path}: {freed} bytes freed.", 10)
+		return(freed)
+
+	def _sync(self):
+		for f in [self._segment_file, self._index_file]:
+			f.flush()
+			os.fsync(f.fileno())
+
+	def flush(self):
+		with self._lock:
+			self._segment_file.flush()
+			self._index_file.flush()
+			if cfg['cache_fsync'] is not None: self._sync()
+
+	def close(self):
+		with self._lock:
+			self._segment_file.close()
+			self._index_file.close()
+			for _map in self._maps.values(): _map.close()
+			self._maps = {}
+
+
+CACHE_BACKENDS = {
+	'filesystem': FileSystemBackend,
+	'sqlite': SQLiteBackend,
+	'segments': SegmentBackend,
+}
+
+_cache_backend = None
+
+
+def get_cache_backend():
+	""" Returns the cache backend set in cfg['cache_backend'] (creating it on first use). """
+	global _cache_backend
+	if _cache_backend is None or _cache_backend.name != cfg['cache_backend']:
+		if cfg['cache_backend'] not in CACHE_BACKENDS: raise RuntimeError(f"Cannot understand cache backend `{cfg['cache_backend']}`. Available backends: {list(CACHE_BACKENDS.keys())}.")
+		if _cache_backend is not None: _cache_backend.close()
+		_cache_backend = CACHE_BACKENDS[cfg['cache_backend']]()
+	return(_cache_backend)
+
+
+def copy_cache(to_backend=None, from_backend=None, types=["post", "user", "place", "tweet", "tweeter", "twitter-place"], show_progress=True):
+	""" Copies every record from one cache backend to another, e.g. to fill a new SQLite cache from the JSON files.
+
+	Example:
+	- copy_cache(to_backend="sqlite")
+
+	Returns: Number of records copied.
+	"""
+	if to_backend is None: raise SyntaxError('A backend to copy to must be provided.')
+	if from_backend is None: from_backend = get_cache_backend()
+	if isinstance(from_backend, str): from_backend = CACHE_BACKENDS[from_backend]()
+	if isinstance(to_backend, str): to_backend = CACHE_BACKENDS[to_backend]()
+	if isinstance(types, str): types = [types]
+
+	count = 0
+	for type in types:
+		shortcodes = list(from_backend.iterate(type))
+		_log(f"Copying {len(shortcodes)} {type} records from the {from_backend.name} cache to the {to_backend.name} cache...", 10)
+
+		if show_progress:
+			i = 0
+			bar = progressbar.ProgressBar(max_value=len(shortcodes)).start()
+
+		with to_backend.batch():
+			for shortcode in shortcodes:
+				data = from_backend.get(type, shortcode)
+				if data is not None:
+					to_backend.put(type, shortcode, data)
+					count += 1
+				if show_progress:
+					i += 1
+					bar.update(i)
+
+		if show_progress: bar.finish()
+		get_cache_manifest().copy_entries(type, from_backend.name, to_backend.name) # Keeps the download times
+
+	to_backend.flush()
+	return(count)
+
+
+# Cache manifest
+
+def _connect_sqlite(path):
+	""" Opens an SQLite database in WAL mode that can be shared between threads (callers hold their own lock). """
+	path = Path(path)
+	path.parent.mkdir(parents=True, exist_ok=True)
+	db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute(f"PRAGMA synchronous={'FULL' if cfg['cache_fsync'] == 'always' else 'NORMAL'}")
+	return(db)
+
+
+def _record_status(data):
+	""" Returns the manifest status of a record: `empty` for empty records, `error` for records that store a download error, and `ok` for all others. """
+	if data == "" or data is None: return("empty")
+	if isinstance(data, dict) and 'error' in data: return("error")
+	return("ok")
+
+
+def _record_schema(data):
+	""" Returns the schema version a record was written with. """
+	if isinstance(data, dict): return(data.get('_schema_version', 0))
+	return(None)
+
+
+_SCHEMA_VERSION_PATTERN = re.compile(rb'"_schema_version":\s?(\d+)')
+
+
+def _raw_record_status(raw):
+	""" Returns the manifest status and schema version of a stored record (see _record_status and _record_schema) from its bytes, without decoding plain JSON records: empty records are a plain `""`, a record without an `"error"` anywhere in it cannot have an error key, and the schema version stands as text (keys are never escaped). Compressed and msgpack records, and records that may have an error key, are decoded. """
+	raw = bytes(raw)
+	if raw[0:3] not in [_COMPRESSION_MAGIC, _MSGPACK_MAGIC] and b'"error"' not in raw:
+		if raw.strip() == b'""': return("empty", None)
+		match = _SCHEMA_VERSION_PATTERN.search(raw)
+		return("ok", int(match.group(1)) if match else 0)
+	data = _decode_record(raw)
+	return(_record_status(data), _record_schema(data))
+
+
+class CacheManifest(object):
+	""" Keeps the download time, size, schema version and status (ok, empty or error) of every record in the cache, in one SQLite table.
+
+	The manifest is updated by every write that goes through _cache_put and _cache_delete, and answers cache_exists, is_in_cache, _downloaded, _age and get_empty_cache_files without touching the cache itself. Download times survive copying the cache to another machine or backend, unlike file ctimes.
+
+	Entries are queued in memory and written in batches of cfg['cache_manifest_batch_size'] in one short transaction, so several processes can share the manifest of a shared cache.
+
+	Entries are kept per cache backend: a manifest is opened for one backend (default cfg['cache_backend']), and only sees the entries of that backend. Failure and media records are shared.
+
+	Records that were cached before the manifest existed are added the first time they are looked up, or all at once by rebuild_manifest(). After rebuild_manifest() has run for a type with a cache backend, the manifest is trusted to be complete for that type and backend, and lookups of missing records only check that the record does not exist (a process that stopped before flushing its queue leaves records in the cache that are not in the manifest).
+	"""
+
+	def __init__(self, path=None, batch_size=None, backend=None):
+		if path is None: path = cfg['cache_manifest_path'] or cfg['cache_folder'] / "manifest.sqlite"
+		if batch_size is None: batch_size = cfg['cache_manifest_batch_size']
+		if backend is None: backend = cfg['cache_backend']
+
+		self.path = Path(path)
+		self.batch_size = batch_size
+		self.backend = backend
+		self._queue = {}
+		self._accessed = {}
+		self._lock = threading.RLock()
+
+		self._db = _connect_sqlite(self.path)
+		manifest_table = """CREATE TABLE IF NOT EXISTS manifest (
+			backend TEXT NOT NULL,
+			type TEXT NOT NULL,
+			shortcode TEXT NOT NULL,
+			downloaded REAL NOT NULL,
+			size INTEGER NOT NULL,
+			schema INTEGER,
+			status TEXT NOT NULL,
+			retry_after REAL,
+			accessed REAL,
+			PRIMARY KEY (backend, type, shortcode)
+		) WITHOUT ROWID"""
+		self._db.execute(manifest_table)
+		columns = [row[1] for row in self._db.execute("PRAGMA table_info(manifest)")]
+		for column in ["retry_after", "accessed"]:
+			if column not in columns: self._db.execute(f"ALTER TABLE manifest ADD COLUMN {column} REAL")
+		if "backend" not in columns:
+			# Entries used to be shared by all backends. They are taken to be those of the backend in use now
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				if "backend" not in [row[1] for row in self._db.execute("PRAGMA table_info(manifest)")]: # Another process may have got here first
+					self._db.execute("ALTER TABLE manifest RENAME TO manifest_shared")
+					for index in ["manifest_status", "manifest_downloaded", "manifest_accessed"]: self._db.execute(f"DROP INDEX IF EXISTS {index}")
+					self._db.execute(manifest_table)
+					self._db.execute("INSERT INTO manifest (backend, type, shortcode, downloaded, size, schema, status, retry_after, accessed) SELECT ?, type, shortcode, downloaded, size, schema, status, retry_after, accessed FROM manifest_shared", (self.backend,))
+					self._db.execute("DROP TABLE manifest_shared")
+				self._db.commit()
+			except BaseException:
+				self._db.rollback()
+				raise
+		self._db.execute("CREATE INDEX IF NOT EXISTS manifest_status ON manifest (backend, type, status)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS manifest_downloaded ON manifest (backend, type, downloaded)")
+		if self._db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'manifest_accessed'").fetchone() is None:
+			# Records that were never read count as accessed when they were downloaded, so `accessed` can be indexed for eviction
+			with self._db:
+				self._db.execute("UPDATE manifest SET accessed = downloaded WHERE accessed IS NULL")
+				self._db.execute("CREATE INDEX manifest_accessed ON manifest (backend, type, accessed)")
+		if "backend" not in [row[1] for row in self._db.execute("PRAGMA table_info(complete)")]:
+			# Completeness used to be kept per type only, without knowing which backend it was checked against
+			self._db.execute("DROP TABLE IF EXISTS complete")
+			self._db.execute("CREATE TABLE complete (backend TEXT NOT NULL, type TEXT NOT NULL, PRIMARY KEY (backend, type)) WITHOUT ROWID")
+		self._db.execute("""CREATE TABLE IF NOT EXISTS failures (
+			type TEXT NOT NULL,
+			shortcode TEXT NOT NULL,
+			id TEXT,
+			attempts INTEGER NOT NULL,
+			error TEXT,
+			retryable INTEGER NOT NULL,
+			failed REAL NOT NULL,
+			PRIMARY KEY (type, shortcode)
+		) WITHOUT ROWID""")
+		self._db.execute("CREATE TABLE IF NOT EXISTS protectors (owner TEXT PRIMARY KEY, published REAL NOT NULL)")
+		self._db.execute("CREATE TABLE IF NOT EXISTS protected (owner TEXT NOT NULL, type TEXT NOT NULL, shortcode TEXT NOT NULL, PRIMARY KEY (owner, type, shortcode)) WITHOUT ROWID")
+		self._db.execute("""CREATE TABLE IF NOT EXISTS media (
+			shortcode TEXT PRIMARY KEY,
+			url TEXT,
+			path TEXT NOT NULL,
+			content_type TEXT,
+			size INTEGER NOT NULL,
+			downloaded REAL NOT NULL,
+			sha256 TEXT,
+			phash TEXT
+		) WITHOUT ROWID""")
+		columns = [row[1] for row in self._db.execute("PRAGMA table_info(media)")]
+		for column in ["sha256", "phash"]:
+			if column not in columns: self._db.execute(f"ALTER TABLE media ADD COLUMN {column} TEXT")
+		self._db.commit()
+		self._complete = set(self._db.execute("SELECT backend, type FROM complete").fetchall())
+		self._failed = set(self._db.execute("SELECT type, shortcode FROM failures").fetchall())
+		atexit.register(self.flush)
+
+	_COLUMNS = ['type', 'shortcode', 'downloaded', 'size', 'schema', 'status', 'retry_after', 'accessed']
+	_MEDIA_COLUMNS = ['shortcode', 'url', 'path', 'content_type', 'size', 'downloaded', 'sha256', 'phash']
+
+	def get(self, type, shortcode):
+		""" Returns the manifest entry of a record as a dictionary, or None if the record is not in the manifest. """
+		key = (type, str(shortcode))
+		with self._lock:
+			if key in self._queue: return(self._queued_entry(key))
+			row = self._db.execute(f"SELECT {', '.join(self._COLUMNS)} FROM manifest WHERE backend = ? AND type = ? AND shortcode = ?", (self.backend, type, str(shortcode))).fetchone()
+		if row is None: return(None)
+		return(dict(zip(self._COLUMNS, row)))
+
+	def get_many(self, type, shortcodes):
+		""" Returns a dictionary of the manifest entries of the given records (records that are not in the manifest are left out). """
+		entries = {}
+		shortcodes = [str(shortcode) for shortcode in shortcodes]
+		with self._lock:
+			for i in range(0, len(shortcodes), 500):
+				chunk = shortcodes[i:i+500]
+				rows = self._db.execute(f"SELECT {', '.join(self._COLUMNS)} FROM manifest WHERE backend = ? AND type = ? AND shortcode IN ({','.join('?' * len(chunk))})", [self.backend, type] + chunk).fetchall()
+				for row in rows: entries[row[1]] = dict(zip(self._COLUMNS, row))
+			for shortcode in shortcodes:
+				if (type, shortcode) not in self._queue: continue
+				entry = self._queued_entry((type, shortcode))
+				if entry is None: entries.pop(shortcode, None)
+				else: entries[shortcode] = entry
+		return(entries)
+
+	def _queued_entry(self, key):
+		""" Returns the entry of a record that is queued to be written (or None if it is queued to be removed). """
+		if self._queue[key] is None: return(None)
+		return(dict(zip(self._COLUMNS, self._queue[key] + (self._accessed.get(key, self._queue[key][2]),))))
+
+	def query(self, type=None, status=None, downloaded_before=None, downloaded_after=None):
+		""" Returns the manifest entries that match all the given filters, as a list of dictionaries. """
+		where, values = ["backend = ?"], [self.backend]
+		if type is not None: where.append("type = ?"); values.append(type)
+		if status is not None: where.append("status = ?"); values.append(status)
+		if downloaded_before is not None: where.append("downloaded < ?"); values.append(downloaded_before)
+		if downloaded_after is not None: where.append("downloaded > ?"); values.append(downloaded_after)
+		sql = f"SELECT {', '.join(self._COLUMNS)} FROM manifest WHERE " + " AND ".join(where)
+		with self._lock:
+			self.flush()
+			rows = self._db.execute(sql, values).fetchall()
+		return([dict(zip(self._COLUMNS, row)) for row in rows])
+
+	def summary(self):
+		""" Returns the number of records and their total size per type and status. """
+		with self._lock:
+			self.flush()
+			rows = self._db.execute("SELECT type, status, COUNT(*), SUM(size) FROM manifest WHERE backend = ? GROUP BY type, status", (self.backend,)).fetchall()
+		return([{'type': row[0], 'status': row[1], 'records': row[2], 'bytes': row[3]} for row in rows])
+
+	def empty_records(self, types, default_wait):
+		""" Returns a dictionary of (type, shortcode): retry-after time for all empty records of the given types. Entries without a retry-after time get their download time plus `default_wait` seconds. """
+		with self._lock:
+			self.flush()
+			rows = self._db.execute(f"SELECT type, shortcode, COALESCE(retry_after, downloaded + ?) FROM manifest WHERE backend = ? AND status = 'empty' AND type IN ({','.join('?' * len(types))})", [default_wait, self.backend] + list(types)).fetchall()
+		return({(row[0], row[1]): row[2] for row in rows})
+
+	def record(self, type, shortcode, size, status, schema=None, downloaded=None, retry_after=None):
+		""" Adds or updates the manifest entry of a record. """
+		if downloaded is None: downloaded = time.time()
+		with self._lock:
+			self._queue[(type, str(shortcode))] = (type, str(shortcode), downloaded, size, schema, status, retry_after)
+			self._written()
+
+	def remove(self, type, shortcode):
+		""" Removes the manifest entry of a record. """
+		with self._lock:
+			self._queue[(type, str(shortcode))] = None
+			self._written()
+
+	def is_complete(self, type, backend=None):
+		""" Returns True if the manifest is known to hold every record of the type in a cache backend (default the manifest's own). """
+		if backend is None: backend = self.backend
+		return((backend, type) in self._complete)
+
+	def set_complete(self, type, complete=True, backend=None):
+		if backend is None: backend = self.backend
+		with self._lock:
+			self.flush()
+			if complete:
+				self._db.execute("INSERT OR IGNORE INTO complete (backend, type) VALUES (?, ?)", (backend, type))
+				self._complete.add((backend, type))
+			else:
+				self._db.execute("DELETE FROM complete WHERE backend = ? AND type = ?", (backend, type))
+				self._complete.discard((backend, type))
+			self._db.commit()
+
+	def lookup(self, type, shortcode):
+		""" Returns the manifest entry of a record like get(), but falls back on the cache backend for records cached before the manifest existed, or written by a process that stopped before flushing its manifest entries (and adds them to the manifest). """
+		entry = self.get(type, shortcode)
+		if entry is not None: return(entry)
+
+		backend = get_cache_backend()
+		if self.is_complete(type, backend.name) and not backend.exists(type, shortcode): return(None)
+		metadata = backend.metadata(type, shortcode)
+		if metadata is None: return(None)
+		raw = backend.get_raw(type, shortcode)
+		if raw is None: return(None)
+		status, schema = _raw_record_status(raw)
+		self.record(type, shortcode, metadata['size'], status, schema=schema, downloaded=metadata['downloaded'])
+		return(self.get(type, shortcode))
+
+	def record_failure(self, type, shortcode, error=None, retryable=True, attempts=1, id=None):
+		""" Records that a record could not be downloaded. Attempts add up over runs. """
+		with self._lock:
+			self._db.execute("INSERT INTO failures (type, shortcode, id, attempts, error, retryable, failed) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (type, shortcode) DO UPDATE SET id = COALESCE(excluded.id, id), attempts = attempts + excluded.attempts, error = excluded.error, retryable = excluded.retryable, failed = excluded.failed", (type, str(shortcode), None if id is None else str(id), attempts, error, int(retryable), time.time()))
+			self._db.commit()
+			self._failed.add((type, str(shortcode)))
+
+	def clear_failure(self, type, shortcode):
+		""" Removes the failure record of a record that has now been downloaded. """
+		key = (type, str(shortcode))
+		if key not in self._failed: return
+		with self._lock:
+			self._db.execute("DELETE FROM failures WHERE type = ? AND shortcode = ?", key)
+			self._db.commit()
+			self._failed.discard(key)
+
+	def failures(self, type=None, retryable=None):
+		""" Returns the failure records (type, shortcode, id, attempts, error, retryable, failed), optionally only of one type or only the retryable (or fatal) ones. """
+		where, values = [], []
+		if type is not None: where.append("type = ?"); values.append(type)
+		if retryable is not None: where.append("retryable = ?"); values.append(int(retryable))
+		sql = "SELECT type, shortcode, id, attempts, error, retryable, failed FROM failures"
+		if len(where) > 0: sql += " WHERE " + " AND ".join(where)
+		with self._lock:
+			rows = self._db.execute(sql, values).fetchall()
+		return([{'type': row[0], 'shortcode': row[1], 'id': row[2], 'attempts': row[3], 'error': row[4], 'retryable': bool(row[5]), 'failed': row[6]} for row in rows])
+
+	def media(self, shortcode):
+		""" Returns the media record (url, path, content_type, size, downloaded, sha256, phash) of the photo of a post, or None if it has not been downloaded. The perceptual hash is a hexadecimal string, or "" if the file could not be decoded as an image. """
+		with self._lock:
+			row = self._db.execute(f"SELECT {', '.join(self._MEDIA_COLUMNS)} FROM media WHERE shortcode = ?", (str(shortcode),)).fetchone()
+		if row is None: return(None)
+		return(dict(zip(self._MEDIA_COLUMNS, row)))
+
+	def media_many(self, shortcodes):
+		""" Returns a dictionary of the media records of the given posts (posts without one are left out). """
+		records = {}
+		shortcodes = [str(shortcode) for shortcode in shortcodes]
+		with self._lock:
+			for i in range(0, len(shortcodes), 500):
+				chunk = shortcodes[i:i+500]
+				for row in self._db.execute(f"SELECT {', '.join(self._MEDIA_COLUMNS)} FROM media WHERE shortcode IN ({','.join('?' * len(chunk))})", chunk):
+					records[row[0]] = dict(zip(self._MEDIA_COLUMNS, row))
+		return(records)
+
+	def record_media(self, shortcode, url, path, content_type, size, sha256=None, phash=None, downloaded=None):
+		""" Adds or updates the media record of the photo of a post. """
+		if downloaded is None: downloaded = time.time()
+		with self._lock:
+			with self._db: self._db.execute(f"INSERT OR REPLACE INTO media ({', '.join(self._MEDIA_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (str(shortcode), url, str(path), content_type, size, downloaded, sha256, phash))
+
+	def set_media_hashes(self, hashes):
+		""" Updates the path, SHA-256 and perceptual hash of media records, from a list of (shortcode, path, sha256, phash). """
+		with self._lock:
+			with self._db: self._db.executemany("UPDATE media SET path = ?, sha256 = ?, phash = ? WHERE shortcode = ?", [(str(path), sha256, phash, shortcode) for shortcode, path, sha256, phash in hashes])
+
+	def unhashed_media(self, perceptual=True):
+		""" Returns the media records that have no SHA-256 yet (or, with `perceptual`, no perceptual hash yet). """
+		with self._lock:
+			rows = self._db.execute(f"SELECT {', '.join(self._MEDIA_COLUMNS)} FROM media WHERE sha256 IS NULL" + (" OR phash IS NULL" if perceptual else "")).fetchall()
+		return([dict(zip(self._MEDIA_COLUMNS, row)) for row in rows])
+
+	def media_hashes(self):
+		""" Returns a dictionary of shortcode: perceptual hash (as an integer) of all photos that have one. """
+		with self._lock:
+			rows = self._db.execute("SELECT shortcode, phash FROM media WHERE phash IS NOT NULL AND phash != ''").fetchall()
+		return({row[0]: int(row[1], 16) for row in rows})
+
+	def media_usage(self):
+		""" Returns the number of media records and distinct files, and the bytes the records refer to and the bytes stored. """
+		with self._lock:
+			records, referenced = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media").fetchone()
+			files, stored = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM media GROUP BY COALESCE(sha256, path))").fetchone()
+		return({'records': records, 'files': files, 'referenced_bytes': referenced, 'stored_bytes': stored})
+
+	def touch(self, type, shortcode):
+		""" Records that a record was read. Access times are written in batches, as they are only needed for cache eviction. """
+		with self._lock:
+			self._accessed[(type, str(shortcode))] = time.time()
+			if len(self._accessed) >= self.batch_size: self.flush()
+
+	def usage(self):
+		""" Returns the total size in bytes of the records of each type. """
+		with self._lock:
+			self.flush()
+			rows = self._db.execute("SELECT type, SUM(size) FROM manifest WHERE backend = ? GROUP BY type", (self.backend,)).fetchall()
+		return({row[0]: row[1] for row in rows})
+
+	def eviction_candidates(self, type, order_by="accessed", limit=1000, idle_before=None, after=None):
+		""" Returns (shortcode, size, position) of non-empty records of a type, least recently accessed (`accessed`) or oldest (`downloaded`) first, through an index. With `idle_before`, only records last accessed before that time are returned, whatever the order.
+
+		For the next page, pass the (position, shortcode) of the last record returned as `after`.
+		"""
+		order = "accessed" if order_by == "accessed" else "downloaded"
+		sql = f"SELECT shortcode, size, {order} FROM manifest WHERE backend = ? AND type = ? AND status != 'empty'"
+		values = [self.backend, type]
+		if idle_before is not None:
+			sql += " AND accessed < ?"
+			values.append(idle_before)
+		if after is not None:
+			sql += f" AND ({order}, shortcode) > (?, ?)"
+			values.extend(after)
+		sql += f" ORDER BY {order} ASC, shortcode ASC LIMIT ?"
+		values.append(limit)
+		with self._lock:
+			self.flush()
+			return(self._db.execute(sql, values).fetchall())
+
+	def set_protected(self, owner, keys):
+		""" Replaces the (type, shortcode) keys of the records that a process (`owner`, see _get_worker_name) protects from cache eviction. With no keys, the process no longer protects anything. """
+		with self._lock:
+			with self._db:
+				self._db.execute("DELETE FROM protected WHERE owner = ?", (owner,))
+				if len(keys) == 0:
+					self._db.execute("DELETE FROM protectors WHERE owner = ?", (owner,))
+					return
+				self._db.execute("INSERT OR REPLACE INTO protectors (owner, published) VALUES (?, ?)", (owner, time.time()))
+				self._db.executemany("INSERT OR IGNORE INTO protected (owner, type, shortcode) VALUES (?, ?, ?)", [(owner, type, str(shortcode)) for type, shortcode in keys])
+
+	def protected(self):
+		""" Returns the (type, shortcode) keys of the records protected by processes that are still alive (see _is_worker_alive). The keys of processes that are gone are removed. """
+		with self._lock:
+			owners = self._db.execute("SELECT owner, published FROM protectors").fetchall()
+			gone = [owner for owner, published in owners if not _is_worker_alive(owner, published)]
+			if len(gone) > 0:
+				with self._db:
+					self._db.executemany("DELETE FROM protected WHERE owner = ?", [(owner,) for owner in gone])
+					self._db.executemany("DELETE FROM protectors WHERE owner = ?", [(owner,) for owner in gone])
+			return(set(self._db.execute("SELECT DISTINCT type, shortcode FROM protected").fetchall()))
+
+	def _written(self):
+		if len(self._queue) >= self.batch_size: self.flush()
+
+	def flush(self):
+		with self._lock:
+			if len(self._queue) == 0 and len(self._accessed) == 0: return
+			writes = [entry for entry in self._queue.values() if entry is not None]
+			deletes = [key for key, entry in self._queue.items() if entry is None]
+			with self._db:
+				self._db.executemany("INSERT OR REPLACE INTO manifest (backend, type, shortcode, downloaded, size, schema, status, retry_after, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(self.backend,) + entry + (entry[2],) for entry in writes]) # Writing a record counts as accessing it
+				self._db.executemany("DELETE FROM manifest WHERE backend = ? AND type = ? AND shortcode = ?", [(self.backend,) + key for key in deletes])
+				self._db.executemany("UPDATE manifest SET accessed = ? WHERE backend = ? AND type = ? AND shortcode = ?", [(accessed, self.backend, type, shortcode) for (type, shortcode), accessed in self._accessed.items()])
+			self._queue, self._accessed = {}, {}
+
+	def copy_entries(self, type, from_backend, to_backend):
+		""" Copies the entries of a type from one backend to another (see copy_cache), so download times survive the copy. """
+		with self._lock:
+			self.flush()
+			with self._db: self._db.execute("INSERT OR REPLACE INTO manifest (backend, type, shortcode, downloaded, size, schema, status, retry_after, accessed) SELECT ?, type, shortcode, downloaded, size, schema, status, retry_after, accessed FROM manifest WHERE backend = ? AND type = ?", (to_backend, from_backend, type))
+
+	def close(self):
+		self.flush()
+		with self._lock: self._db.close()
+
+
+_cache_manifest = None
+
+
+def get_cache_manifest():
+	""" Returns the cache manifest of the cache backend set in cfg['cache_backend'] (creating it on first use). """
+	global _cache_manifest
+	if _cache_manifest is None or _cache_manifest.backend != cfg['cache_backend']:
+		if _cache_manifest is not None: _cache_manifest.close()
+		_cache_manifest = CacheManifest()
+	return(_cache_manifest)
+
+
+def _cache_get(type, shortcode):
+	""" Reads a record from the cache backend. Records written with an older schema are migrated and written back (keeping their download time). """
+	data = get_cache_backend().get(type, shortcode)
+	if data is None: return(None)
+	get_cache_manifest().touch(type, shortcode)
+	if _is_outdated(type, data):
+		entry = get_cache_manifest().get(type, shortcode)
+		data = _migrate_record(type, data)
+		_cache_put(type, shortcode, data, downloaded=entry['downloaded'] if entry is not None else None)
+	return(data)
+
+
+def _cache_put(type, shortcode, data, downloaded=None):
+	""" Writes a record to the cache backend, the manifest and the negative cache. """
+	size = get_cache_backend().put(type, shortcode, data)
+	status, retry_after = _record_status(data), None
+	if status == "empty":
+		retry_after = _get_retry_after(get_cache_manifest().get(type, shortcode))
+		get_negative_cache().add(type, shortcode, retry_after)
+	else:
+		get_negative_cache().discard(type, shortcode)
+	get_cache_manifest().record(type, shortcode, size, status, schema=_record_schema(data), downloaded=downloaded, retry_after=retry_after)
+
+
+def _cache_delete(type, shortcode):
+	""" Removes a record from the cache backend, the manifest and the negative cache. """
+	removed = get_cache_backend().delete(type, shortcode)
+	get_cache_manifest().remove(type, shortcode)
+	get_negative_cache().discard(type, shortcode)
+	return(removed)
+
+
+# Record schemas
+
+CACHE_SCHEMA_VERSIONS = {
+	'post': 2,
+	'user': 0,
+	'place': 0,
+	'tweet': 1,
+	'tweeter': 0,
+	'twitter-place': 0,
+}
+
+_schema_migrations = {}
+
+
+def register_schema_migration(type, from_version):
+	""" Decorator that registers a function which migrates a record of a type from `from_version` to `from_version + 1`. The function gets the record data and returns the migrated data.
+
+	Example:
+	- @register_schema_migration("post", 2)
+	  def _migrate_post_2(data): ...
+	  (and raise CACHE_SCHEMA_VERSIONS['post'] to 3)
+	"""
+	def _register(function):
+		_schema_migrations[(type, from_version)] = function
+		return(function)
+	return(_register)
+
+
+def _detect_schema_version(type, data):
+	""" Returns the schema version of a record. Records from before schema versions were stamped are recognised by their shape. """
+	if '_schema_version' in data: return(data['_schema_version'])
+	if type == "post" and (isinstance(data.get('owner'), dict) or 'edge_media_to_comment' in data or 'edge_media_preview_like' in data): return(0) # Raw GraphQL node (cleaned posts can keep an empty edge_media_to_caption)
+	if type == "post": return(1)
+	return(0)
+
+
+def _is_outdated(type, data):
+	""" Returns True if a record was written with an older schema than the current one for its type. Empty and error records have no schema. """
+	return(_record_status(data) == "ok" and isinstance(data, dict) and data.get('_schema_version', 0) < CACHE_SCHEMA_VERSIONS.get(type, 0))
+
+
+def _migrate_record(type, data):
+	""" Runs all registered migrations needed to bring a record up to the current schema for its type, and stamps the version on it. """
+	if not isinstance(data, dict): return(data)
+	version, current = _detect_schema_version(type, data), CACHE_SCHEMA_VERSIONS.get(type, 0)
+	while version < current:
+		if (type, version) not in _schema_migrations: raise RuntimeError(f"There is no schema migration for {type} records from version {version}.")
+		data = _schema_migrations[(type, version)](data)
+		version += 1
+	if current > 0: data['_schema_version'] = current
+	return(data)
+
+
+@register_schema_migration("post", 0)
+def _migrate_post_0(data):
+	""" Raw GraphQL shortcode_media nodes -> the cleaned shape from _clean_post. """
+	return(_clean_post(data))
+
+
+@register_schema_migration("post", 1)
+def _migrate_post_1(data):
+	""" `sponsor_user` (written by _clean_post before it used `sponsor_users`) -> `sponsor_users`, which is the key InstagramPost reads. """
+	if 'sponsor_user' in data: data['sponsor_users'] = data.pop('sponsor_user')
+	elif 'sponsor_users' not in data: data['sponsor_users'] = []
+	return(data)
+
+
+@register_schema_migration("tweet", 0)
+def _migrate_tweet_0(data):
+	""" Full tweepy status -> users and retweeted tweets replaced by their IDs, quoted tweets and `id_str` dropped. """
+	if isinstance(data.get('user'), dict): data['user'] = data['user']['id']
+	if isinstance(data.get('retweeted_status'), dict): data['retweeted_status'] = data['retweeted_status']['id']
+	if isinstance(data.get('quoted_status'), dict): del(data['quoted_status'])
+	if 'id_str' in data: del(data['id_str'])
+	return(data)
+
+
+def _migrate_raw_record(args):
+	""" Process pool worker for migrate_cache_schema: decodes, migrates and re-encodes one record. """
+	type, shortcode, raw = args
+	try:
+		data = _migrate_record(type, _decode_record(raw))
+	except (KeyError, TypeError, ValueError) as e:
+		return(type, shortcode, None, None, str(e))
+	return(type, shortcode, _encode_record(data, type), _record_status(data), _record_schema(data))
+
+
+def _init_worker(_cfg):
+	""" Process pool initializer that copies the settings of the parent process (worker processes may start from a fresh import of the module). """
+	cfg.update(_cfg)
+
+
+def migrate_cache_schema(types=["post", "tweet"], workers=None, chunk=500, show_progress=True):
+	""" Migrates every outdated record in the cache to the current schema.
+
+	Records are read and written by this process and migrated in a process pool. Outdated records are found through the schema versions in the manifest, which is updated (and flushed) after every chunk of `chunk` records, so an interrupted run picks up where it stopped. Each record is written atomically.
+
+	Returns: Number of records migrated.
+	"""
+	if isinstance(types, str): types = [types]
+	backend, manifest = get_cache_backend(), get_cache_manifest()
+
+	count = 0
+	for type in types:
+		if not manifest.is_complete(type): rebuild_manifest(types=type, show_progress=show_progress)
+		current = CACHE_SCHEMA_VERSIONS.get(type, 0)
+		entries = [entry for entry in manifest.query(type=type) if entry['status'] == "ok" and (entry['schema'] or 0) < current]
+		_log(f"Migrating {len(entries)} {type} records to schema version {current}...", 10)
+
+		if show_progress:
+			i = 0
+			bar = progressbar.ProgressBar(max_value=len(entries)).start()
+
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dict(cfg),)) as executor:
+			for start in range(0, len(entries), chunk):
+				jobs, downloaded = [], {}
+				for entry in entries[start:start+chunk]:
+					raw = backend.get_raw(type, entry['shortcode'])
+					if raw is not None: jobs.append((type, entry['shortcode'], raw))
+					downloaded[entry['shortcode']] = entry['downloaded']
+
+				with backend.batch():
+					for _type, shortcode, raw, status, schema in executor.map(_migrate_raw_record, jobs, chunksize=16):
+						if raw is None:
+							_log(f"Could not migrate {_type} record {shortcode}: {schema}", 10)
+							continue
+						size = backend.put_raw(_type, shortcode, raw)
+						manifest.record(_type, shortcode, size, status, schema=schema, downloaded=downloaded[shortcode])
+						count += 1
+						if show_progress:
+							i += 1
+							bar.update(i)
+
+				# Checkpoint
+				backend.flush()
+				manifest.flush()
+
+		if show_progress: bar.finish()
+
+	return(count)
+
+
+# Negative cache
+
+def _get_retry_after(previous=None):
+	""" Returns the time after which a record that was just found to be empty should be downloaded again.
+
+	The first wait is cfg['negative_cache_retry_days']. If the previous manifest entry shows that the record was already empty, the wait is doubled, up to cfg['negative_cache_max_retry_days'].
+	"""
+	now = time.time()
+	wait = cfg['negative_cache_retry_days'] * 86400
+	if previous is not None and previous['status'] == "empty" and previous['retry_after'] is not None:
+		wait = max(wait, 2 * (previous['retry_after'] - previous['downloaded']))
+	return(now + min(wait, cfg['negative_cache_max_retry_days'] * 86400))
+
+
+class NegativeCache(object):
+	""" Keeps the posts, users and places that are known to be empty (deleted, private or unavailable), so they can be skipped without any file I/O.
+
+	The set is loaded from the manifest with one query on first use and kept up to date by _cache_put and _cache_delete. Every entry has a retry-after time: until then the record is known to be empty, after that it should be downloaded again to check whether it has come back.
+	"""
+
+	types = ["post", "user", "place"]
+
+	def __init__(self):
+		self._entries = {}
+		self._lock = threading.Lock()
+		self.load()
+
+	def __len__(self):
+		return(len(self._entries))
+
+	def load(self):
+		""" (Re)loads all empty records from the manifest. Entries without a retry-after time (added by rebuild_manifest) are trusted for cfg['negative_cache_retry_days'] from their download time. """
+		entries = get_cache_manifest().empty_records(self.types, cfg['negative_cache_retry_days'] * 86400)
+		with self._lock: self._entries = entries
+		_log(f"Loaded {len(entries)} known empty records into the negative cache.", 0)
+
+	def add(self, type, shortcode, retry_after):
+		if type not in self.types: return
+		with self._lock: self._entries[(type, str(shortcode))] = retry_after
+
+	def discard(self, type, shortcode):
+		with self._lock: self._entries.pop((type, str(shortcode)), None)
+
+	def is_known_empty(self, type, shortcode):
+		""" Returns True if the record is empty and does not need to be checked again yet. """
+		retry_after = self._entries.get((type, str(shortcode)))
+		return(retry_after is not None and retry_after > time.time())
+
+	def is_due(self, type, shortcode):
+		""" Returns True if the record was empty but is old enough to be checked again. """
+		retry_after = self._entries.get((type, str(shortcode)))
+		return(retry_after is not None and retry_after <= time.time())
+
+	def due(self, type="post"):
+		""" Returns the shortcodes of all empty records of a type that are old enough to be checked again. """
+		now = time.time()
+		with self._lock:
+			return([shortcode for (_type, shortcode), retry_after in self._entries.items() if _type == type and retry_after <= now])
+
+
+_negative_cache = None
+
+
+def get_negative_cache():
+	""" Returns the negative cache (loading it from the manifest on first use). """
+	global _negative_cache
+	if _negative_cache is None: _negative_cache = NegativeCache()
+	return(_negative_cache)
+
+
+def rebuild_manifest(types=["post", "user", "place", "tweet", "tweeter", "twitter-place"], show_progress=True):
+	""" Adds every record in the cache backend to the manifest, and drops manifest entries for records that are no longer in the cache. Download times already in the manifest are kept.
+
+	Returns: Number of records in the manifest.
+	"""
+	if isinstance(types, str): types = [types]
+	backend, manifest = get_cache_backend(), get_cache_manifest()
+
+	count = 0
+	for type in types:
+		shortcodes = set(backend.iterate(type))
+		known = set(entry['shortcode'] for entry in manifest.query(type=type))
+
+		if show_progress:
+			i = 0
+			bar = progressbar.ProgressBar(max_value=len(shortcodes)).start()
+
+		for shortcode in shortcodes:
+			if show_progress:
+				i += 1
+				bar.update(i)
+			metadata = backend.metadata(type, shortcode)
+			raw = backend.get_raw(type, shortcode)
+			if metadata is None or raw is None: continue
+			status, schema = _raw_record_status(raw)
+			downloaded = manifest.get(type, shortcode)['downloaded'] if shortcode in known else metadata['downloaded']
+			manifest.record(type, shortcode, metadata['size'], status, schema=schema, downloaded=downloaded)
+			count += 1
+
+		for shortcode in known - shortcodes: manifest.remove(type, shortcode)
+
+		if show_progress: bar.finish()
+		manifest.flush()
+		manifest.set_complete(type, backend=backend.name)
+
+	if _negative_cache is not None: _negative_cache.load()
+	return(count)
+
+
+# Cache eviction
+
+_active_datasets = weakref.WeakSet()
+
+
+def _protect_dataset(dataset):
+	""" Protects the records of a dataset from cache eviction while it is alive: in this process through _active_datasets, and in other processes (such as the evict-cache command) through the keys published in the manifest. Called again when the dataset changes, as the keys are published as they are at the time. """
+	_active_datasets.add(dataset)
+	keys = set()
+	for _dataset in list(_active_datasets): keys.update(_dataset._cache_keys())
+	get_cache_manifest().set_protected(_get_worker_name(), keys)
+
+
+@atexit.register
+def _unprotect_datasets():
+	""" Takes back the keys this process has published (see _protect_dataset) when it exits. """
+	if _cache_manifest is not None and len(_active_datasets) > 0:
+		try:
+			_cache_manifest.set_protected(_get_worker_name(), [])
+		except sqlite3.Error:
+			pass
+
+
+def _is_worker_alive(owner, published):
+	""" Returns True if the process named `owner` (see _get_worker_name) may still be running: a process on this machine is checked, a process on another machine is taken to be alive until cfg['cache_protection_lease'] seconds after `published`. """
+	host, _, pid = owner.rpartition(":")
+	if host != socket.gethostname(): return(time.time() - published < cfg['cache_protection_lease'])
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return(False)
+	except (PermissionError, ValueError):
+		pass
+	return(True)
+
+
+class CacheEvictor(object):
+	""" Keeps the cache within the byte budgets in cfg['cache_budgets'].
+
+	Records are evicted least recently read first (policy `lru`) or oldest download first (policy `age`), using the download and access times in the manifest. With cfg['cache_max_idle_days'] set, records that have not been read for that long (by their access time, whatever the policy) are evicted whatever the budget. Empty records are never evicted, as they are tiny and keep the negative cache working.
+
+	Records used by an InstagramDataset that is still alive are protected, also from evictors in other processes (such as the evict-cache command): every process publishes the keys of its live datasets in the manifest when they are set up, updated or loaded (see _protect_dataset). Posts that a lazy dataset builds later are only protected in its own process.
+
+	Eviction runs in small steps of cfg['cache_eviction_batch'] records, either by calling step() or run() or in a background thread started with start().
+
+	Example:
+	- cfg['cache_budgets']['user'] = 2 * 1024**3
+	- CacheEvictor().run()
+	"""
+
+	def __init__(self, budgets=None, policy=None, max_idle_days=None, batch=None):
+		self.budgets = budgets if budgets is not None else cfg['cache_budgets']
+		self.policy = policy if policy is not None else cfg['cache_eviction_policy']
+		self.max_idle_days = max_idle_days if max_idle_days is not None else cfg['cache_max_idle_days']
+		self.batch = batch if batch is not None else cfg['cache_eviction_batch']
+		if self.policy not in ["lru", "age"]: raise SyntaxError(f"Cannot understand eviction policy `{self.policy}`. Use `lru` or `age`.")
+
+		self.evicted, self.freed = 0, 0
+		self._thread, self._stop = None, threading.Event()
+
+		for type in self.budgets:
+			if not get_cache_manifest().is_complete(type): _log(f"Warning: The manifest is not complete for {type} records, so cache usage will be underestimated. Run rebuild_manifest() first.", 10)
+
+	def __str__(self):
+		return(f"Cache evictor ({self.policy}) that has evicted {self.evicted} records ({self.freed} bytes).")
+
+	def _protected(self):
+		""" Returns the (type, shortcode) keys of all records used by live datasets, in this process and in others. """
+		protected = get_cache_manifest().protected()
+		for dataset in list(_active_datasets):
+			protected.update(dataset._cache_keys())
+		return(protected)
+
+	def over_budget(self):
+		""" Returns the number of bytes each type is over its budget (types within budget are left out). """
+		usage = get_cache_manifest().usage()
+		return({type: usage.get(type, 0) - budget for type, budget in self.budgets.items() if budget is not None and usage.get(type, 0) > budget})
+
+	def step(self):
+		""" Evicts at most one batch of records. Returns the number of records evicted (0 when the cache is within its budgets). """
+		manifest = get_cache_manifest()
+		order_by = "accessed" if self.policy == "lru" else "downloaded"
+		protected = None
+		evicted = 0
+
+		# Records that have not been read for too long go first, then records over the budgets
+		targets = []
+		if self.max_idle_days is not None:
+			idle_before = time.time() - self.max_idle_days * 86400
+			targets.extend((type, None, idle_before) for type in self.budgets)
+		targets.extend((type, excess, None) for type, excess in self.over_budget().items())
+
+		for type, excess, idle_before in targets:
+			after = None
+			# Page past records that are protected by live datasets, so a page full of them does not stop eviction
+			while evicted < self.batch and (excess is None or excess > 0):
+				candidates = manifest.eviction_candidates(type, order_by=order_by, limit=self.batch * 2, idle_before=idle_before, after=after)
+				if len(candidates) == 0: break
+				if protected is None: protected = self._protected()
+				for shortcode, size, position in candidates:
+					if evicted >= self.batch or (excess is not None and excess <= 0): break
+					after = (position, shortcode)
+					if (type, shortcode) in protected: continue
+					_cache_delete(type, shortcode)
+					evicted += 1
+					self.evicted += 1
+					self.freed += size
+					if excess is not None: excess -= size
+
+		if evicted > 0:
+			get_cache_backend().flush()
+			manifest.flush()
+			_log(f"Evicted {evicted} records from the cache.", 0)
+		return(evicted)
+
+	def run(self, pause=0.1):
+		""" Evicts records step by step until the cache is within its budgets. Returns the number of bytes freed. """
+		freed = self.freed
+		while self.step() > 0:
+			if self._stop.wait(pause): break
+		return(self.freed - freed)
+
+	def start(self, interval=60, pause=0.1):
+		""" Starts evicting in a background thread, checking the budgets every `interval` seconds. """
+		def _loop():
+			while not self._stop.is_set():
+				try:
+					self.run(pause=pause)
+				except Exception as e:
+					_log(f"Warning: Cache eviction failed: {e}", 10)
+				self._stop.wait(interval)
+
+		self._stop.clear()
+		self._thread = threading.Thread(target=_loop, name="CacheEvictor", daemon=True)
+		self._thread.start()
+		return(self)
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None: self._thread.join()
+		self._thread = None
+
+
+def get_instagram_link(type=None, shortcode=None, id=None):
+	""" Returns the link to the Instagram page for the Instagram data. """
+
+	# Verify all settings
+	if type == None: raise SyntaxError('A type must be provided.')
+	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
+	if type is not "post" and type is not "user" and type is not "place": raise SyntaxError('An unknown type format was provided.')
+	if type is "place" and id is None: raise SyntaxError('An ID must be provided together with a shortcode for Instagram places.')
+
+	if type == "post": return(f"{cfg['instagram_base_url']}/p/{shortcode}")
+	elif type == "user": return(f"{cfg['instagram_base_url']}/{shortcode}")
+	elif type == "place": return(f"{cfg['instagram_base_url']}/explore/locations/{id}/{shortcode}")
+
+
+def _save_json(_json=None, type=None, shortcode=None, path=None):
+	""" Internal function for saving JSON data in the cache.
+
+	The old form _save_json(_json, path) is deprecated: it still writes a JSON file to the path, but that file is not in the cache manifest and is not seen by other cache backends.
+	"""
+
+	# Verify all settings
+	if _json == None: raise SyntaxError('JSON data must be provided.')
+	if path is None and shortcode is None and _is_legacy_path(type): path, type = type, None
+	if path is not None:
+		warnings.warn("_save_json(_json, path) is deprecated. Use _save_json(_json, type, shortcode) to save to the cache.", DeprecationWarning, stacklevel=2)
+		try:
+			with open(path, 'w+') as outfile: json.dump(_json, outfile)
+			return(True)
+		except:
+			raise Exception(f'JSON file {path} could not be saved.')
+	if type == None: raise SyntaxError('A type must be provided.')
+	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
+
+	try:
+		_cache_put(type, shortcode, _json)
+		return(True)
+	except:
+		raise Exception(f'JSON data for {type} {shortcode} could not be saved.')
+
+
+# Page extraction
+
+class ExtractionError(RuntimeError):
+	""" Raised when a downloaded Instagram page does not have the layout the extractor expects, e.g. because Instagram changed it. Not retried, as downloading the page again will not help. """
+	pass
+
+
+# The errors a record can fail to download with, once call_with_retries has given up and written them to the failure records. Datasets leave such posts out, and let any other error (a bug) propagate.
+_DOWNLOAD_ERRORS = (ThrottledError, ExtractionError, ConnectionError, TimeoutError, requests.exceptions.RequestException)
+
+
+_SHARED_DATA_MARKER = b"window._sharedData = "
+_SHARED_DATA_END = b";</script>"
+_UNAVAILABLE_MARKERS = [b"link you followed may be broken", b"video is not available in your country"]
+_THROTTLED_MARKER = b"something went wrong" # A temporary error page, not an unavailable record (see _is_throttled)
+_PAGE_MARKERS = re.compile(b"|".join(re.escape(marker) for marker in [_SHARED_DATA_MARKER, _THROTTLED_MARKER] + _UNAVAILABLE_MARKERS))
+_ENTRY_DATA_PAGES = {
+	'post': ("PostPage", "shortcode_media"),
+	'user': ("ProfilePage", "user"),
+	'place': ("LocationsPage", "location"),
+}
+
+
+def extract_shared_data(html, scan=None):
+	""" Returns the `window._sharedData` JSON of an Instagram page, or None if the page says the record is not available.
+
+	The page is scanned once, as bytes, for the shared data and the "not available" messages (messages inside the shared data itself, e.g. in a caption, do not count), and only the shared data is decoded (with the codec from get_record_codec). Raises ExtractionError if there is neither, or if the shared data cannot be decoded. A caller that has scanned the page already (see download_json) passes the result of _scan_page as `scan`.
+	"""
+	if isinstance(html, str): html = html.encode("utf-8")
+
+	start, end, messages = _scan_page(html) if scan is None else scan
+	if any(marker in messages for marker in _UNAVAILABLE_MARKERS): return(None)
+	if start is None: raise ExtractionError("The page has no `window._sharedData`.")
+	if end < 0: raise ExtractionError("The shared data of the page does not end with `;</script>`.")
+
+	try:
+		return(get_record_codec().loads(html[start:end]))
+	except Exception as e:
+		raise ExtractionError(f"The shared data of the page could not be decoded ({e.__class__.__name__}: {e}).") from None
+
+
+def _scan_page(html):
+	""" Scans an Instagram page once for the shared data and the messages in _UNAVAILABLE_MARKERS and _THROTTLED_MARKER, leaving out messages inside the shared data. Returns (start, end, messages) with the offsets of the shared data (None if there is none, end -1 if it does not end) and the set of messages found. """
+	start, end, messages = None, None, set()
+	for match in _PAGE_MARKERS.finditer(html):
+		if end is not None and (end < 0 or match.start() < end): continue # Inside the shared data
+		if match.group() == _SHARED_DATA_MARKER:
+			if start is not None: continue
+			start = match.end()
+			end = html.find(_SHARED_DATA_END, start)
+		else:
+			messages.add(match.group())
+	return(start, end, messages)
+
+
+def _extract_shared_data_with_soup(html):
+	""" The original extraction, through a full BeautifulSoup parse of the page. Only kept as a reference for benchmark_extraction. """
+	_json = None
+	soup = BeautifulSoup(html, 'lxml')
+	if str(html).find("link you followed may be broken") > 0: return(None)
+	elif str(html).find("something went wrong") > 0: return(None)
+	elif str(html).find("video is not available in your country") > 0: return(None)
+	for script in soup.findAll("script"):
+		if str(script).find("shortcode") > 0: _json = json.loads(str(script)[52:-10])
+	return(_json)
+
+
+def _synthetic_page(n):
+	""" Returns a made-up Instagram post page around a synthetic post, for benchmarks. """
+	shared_data = {'config': {'csrf_token': "x" * 32, 'viewer': None}, 'country_code': "US", 'entry_data': {'PostPage': [{'graphql': {'shortcode_media': _synthetic_post(n)}}]}}
+	filler = "".join(f'<link rel="preload" href="/static/bundles/es6/{i:04x}.js" as="script" crossorigin="anonymous" />' for i in range(40))
+	return((f'<!DOCTYPE html><html lang="en" class="no-js not-logged-in client-root"><head><meta charset="utf-8"><title>Instagram</title>{filler}'
+		'<script type="text/javascript">(function() { var html = document.documentElement; html.className = html.className.replace("no-js", "js"); })();</script></head>'
+		f'<body><span id="react-root"></span><script type="text/javascript">window._sharedData = {json.dumps(shared_data)};</script>'
+		'<script type="text/javascript">window.__initialDataLoaded(window._sharedData);</script></body></html>').encode("utf-8"))
+
+
+def benchmark_extraction(folder=None, pages=200, repeat=3):
+	""" Compares extract_shared_data with the original BeautifulSoup extraction, on the saved pages (*.html, optionally gzipped as *.html.gz) in `folder`, or on `pages` synthetic post pages. Checks that both return the same data.
+
+	Returns: A pandas DataFrame with one row per method.
+	"""
+	if folder is not None:
+		html = []
+		for path in sorted(Path(folder).glob("**/*.html*")):
+			with (gzip.open if path.suffix == ".gz" else open)(path, "rb") as f: html.append(f.read())
+		if len(html) == 0: raise RuntimeError(f"There are no saved pages in {folder}.")
+	else:
+		html = [_synthetic_page(n) for n in range(pages)]
+	total_bytes = sum(len(page) for page in html)
+
+	results, outputs = [], {}
+	for name, function in [("beautifulsoup", _extract_shared_data_with_soup), ("extract_shared_data", extract_shared_data)]:
+		seconds = None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			output = [function(page) for page in html]
+			elapsed = time.perf_counter() - start
+			if seconds is None or elapsed < seconds: seconds = elapsed
+		outputs[name] = output
+		results.append({'method': name, 'pages': len(html), 'pages_per_second': int(len(html) / seconds), 'mb_per_second': round(total_bytes / seconds / 1024 / 1024, 1)})
+
+	mismatches = sum(1 for a, b in zip(outputs['beautifulsoup'], outputs['extract_shared_data']) if a != b)
+	if mismatches > 0: _log(f"Warning: The two methods disagree on {mismatches} of {len(html)} pages.", 10)
+	return(pd.DataFrame(results))
+
+
+# Raw page archive
+
+class HtmlArchive(object):
+	""" Keeps the raw Instagram pages that records were extracted from, so the cache can be rebuilt with a changed extraction (see reextract_from_archive) without downloading anything again.
+
+	Pages are stored gzipped and content-addressed: each distinct page is one file, named by the SHA-256 of its bytes, in blobs/ab/cd/ under the archive folder. An SQLite index maps every fetch, keyed by (type, shortcode, fetch time), to its page, so a record that was downloaded several times keeps all its versions.
+	"""
+
+	def __init__(self, path=None):
+		if path is None: path = cfg['html_archive_folder'] or cfg['cache_folder'] / "__html"
+		self.path = Path(path)
+		self._lock = threading.RLock()
+		self._db = _connect_sqlite(self.path / "archive.sqlite")
+		self._db.execute("""CREATE TABLE IF NOT EXISTS pages (
+			type TEXT NOT NULL,
+			shortcode TEXT NOT NULL,
+			fetched REAL NOT NULL,
+			sha256 TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			PRIMARY KEY (type, shortcode, fetched)
+		) WITHOUT ROWID""")
+		self._db.commit()
+
+	def _blob_path(self, sha256):
+		return(self.path / "blobs" / sha256[0:2] / sha256[2:4] / f"{sha256}.html.gz")
+
+	def put(self, type, shortcode, html, fetched=None):
+		""" Archives a page fetched for a record. Returns the SHA-256 of the page. """
+		if fetched is None: fetched = time.time()
+		sha256 = hashlib.sha256(html).hexdigest()
+		blob_path = self._blob_path(sha256)
+		if not blob_path.exists(): _atomic_write(blob_path, gzip.compress(html, compresslevel=cfg['html_archive_level']))
+		with self._lock:
+			with self._db: self._db.execute("INSERT OR REPLACE INTO pages (type, shortcode, fetched, sha256, size) VALUES (?, ?, ?, ?, ?)", (type, str(shortcode), fetched, sha256, len(html)))
+		return(sha256)
+
+	def read(self, sha256):
+		""" Returns the page with the given SHA-256. """
+		with gzip.open(self._blob_path(sha256), "rb") as f: return(f.read())
+
+	def versions(self, type, shortcode):
+		""" Returns the fetches of a record, newest first, as a list of dictionaries with the fetch time, SHA-256 and size of the page. """
+		with self._lock:
+			rows = self._db.execute("SELECT fetched, sha256, size FROM pages WHERE type = ? AND shortcode = ? ORDER BY fetched DESC", (type, str(shortcode))).fetchall()
+		return([{'fetched': row[0], 'sha256': row[1], 'size': row[2]} for row in rows])
+
+	def get(self, type, shortcode):
+		""" Returns the newest archived page of a record, or None if there is none. """
+		versions = self.versions(type, shortcode)
+		if len(versions) == 0: return(None)
+		return(self.read(versions[0]['sha256']))
+
+	def latest(self, type):
+		""" Returns (shortcode, fetch time, blob path) of the newest page of every record of a type. """
+		with self._lock:
+			rows = self._db.execute("SELECT shortcode, MAX(fetched), sha256 FROM pages WHERE type = ? GROUP BY shortcode", (type,)).fetchall()
+		return([(row[0], row[1], str(self._blob_path(row[2]))) for row in rows])
+
+	def stats(self):
+		""" Returns the number of fetches, distinct pages and the bytes of the pages before and after compression. """
+		with self._lock:
+			fetches, pages, raw_bytes = self._db.execute("SELECT COUNT(*), COUNT(DISTINCT sha256), SUM(size) FROM pages").fetchone()
+		stored_bytes = sum(os.path.getsize(path) for path in glob.iglob(os.path.join(self.path, "blobs", "??", "??", "*.html.gz")))
+		return({'fetches': fetches, 'pages': pages, 'raw_bytes': raw_bytes or 0, 'stored_bytes': stored_bytes})
+
+	def close(self):
+		with self._lock: self._db.close()
+
+
+_html_archive = None
+
+
+def get_html_archive():
+	""" Returns the raw page archive (creating it on first use). """
+	global _html_archive
+	if _html_archive is None: _html_archive = HtmlArchive()
+	return(_html_archive)
+
+
+def _reextract_page(args):
+	""" Process pool worker for reextract_from_archive: reads an archived page and extracts its record. """
+	type, shortcode, fetched, blob_path = args
+	try:
+		with gzip.open(blob_path, "rb") as f: html = f.read()
+		return(type, shortcode, fetched, _extract_record(type, shortcode, html), None)
+	except (OSError, ExtractionError) as e:
+		return(type, shortcode, fetched, None, f"{e.__class__.__name__}: {e}")
+
+
+def reextract_from_archive(types=["post", "user", "place"], workers=None, chunk=500, show_progress=True):
+	""" Rebuilds the cache records of the given types from the newest archived page of each record, e.g. after a change to _clean_post. Pages are extracted in a process pool, and records keep the time their page was fetched as their download time.
+
+	Returns: Number of records rebuilt.
+	"""
+	if isinstance(types, str): types = [types]
+	archive, backend = get_html_archive(), get_cache_backend()
+
+	count = 0
+	for type in types:
+		pages = [(type, shortcode, fetched, blob_path) for shortcode, fetched, blob_path in archive.latest(type)]
+		_log(f"Re-extracting {len(pages)} {type} records from the page archive...", 10)
+
+		if show_progress:
+			i = 0
+			bar = progressbar.ProgressBar(max_value=len(pages)).start()
+
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dict(cfg),)) as executor:
+			for start in range(0, len(pages), chunk):
+				with backend.batch():
+					for _type, shortcode, fetched, data, error in executor.map(_reextract_page, pages[start:start+chunk], chunksize=16):
+						if error is not None: _log(f"Warning: Could not re-extract {_type} {shortcode}: {error}", 10)
+						else:
+							_cache_put(_type, shortcode, data, downloaded=fetched)
+							count += 1
+						if show_progress:
+							i += 1
+							bar.update(i)
+				get_cache_manifest().flush()
+
+		if show_progress: bar.finish()
+
+	return(count)
+
+
+# Offline stand-in for Instagram
+
+_STAND_IN_BASE_URL = "__STAND_IN_BASE_URL__" # Replaced by the address of the stand-in when a fixture page is served
+
+
+def _fixture_path(folder, type, key):
+	""" Returns the path of a fixture page (type is 'post', 'user', 'place' or 'hashtag'; places are keyed by their ID). """
+	return(Path(folder) / type / f"{key}.html.gz")
+
+
+def _fixture_html(shared_data=None, body=""):
+	""" Returns an Instagram page around `shared_data` (or around `body` only, for pages without shared data). """
+	script = "" if shared_data is None else f'<script type="text/javascript">window._sharedData = {json.dumps(shared_data)};</script>'
+	return(('<!DOCTYPE html><html lang="en" class="no-js not-logged-in client-root"><head><meta charset="utf-8"><title>Instagram</title></head>'
+		f'<body><span id="react-root">{body}</span>{script}</body></html>').encode("utf-8"))
+
+
+def _fixture_post(n, shortcode, owner, place, hashtags, image):
+	""" Returns a made-up raw GraphQL shortcode_media node, as found on a post page. """
+	words = ["burlesque", "show", "tonight", "new", "york", "stage", "glitter", "costume", "dance", "vintage", "love", "thanks"]
+	rng = random.Random(n)
+	sentence = lambda length: " ".join(rng.choice(words) for _ in range(length))
+	user = lambda username: {'id': str(zlib.crc32(username.encode("utf-8"))), 'profile_pic_url': f"{_STAND_IN_BASE_URL}/media/{username}.jpg", 'username': username}
+	return({
+		'__typename': "GraphImage",
+		'id': str(1900000000000000000 + n),
+		'shortcode': shortcode,
+		'dimensions': {'height': 1080, 'width': 1080},
+		'gating_info': None,
+		'display_url': f"{_STAND_IN_BASE_URL}/media/{image}.jpg",
+		'display_resources': [{'src': f"{_STAND_IN_BASE_URL}/media/{image}.jpg", 'config_width': width, 'config_height': width} for width in [640, 750, 1080]],
+		'accessibility_caption': sentence(12),
+		'is_video': False,
+		'should_log_client_event': False,
+		'tracking_token': f"{rng.getrandbits(128):032x}",
+		'edge_media_to_tagged_user': {'edges': [{'node': {'user': {'username': f"user_{rng.randint(0, 5000)}"}, 'x': rng.random(), 'y': rng.random()}} for _ in range(rng.randint(0, 3))]},
+		'edge_media_to_caption': {'edges': [{'node': {'text': sentence(rng.randint(5, 60)) + "".join(f" #{hashtag}" for hashtag in hashtags)}}]},
+		'caption_is_edited': False,
+		'has_ranked_comments': False,
+		'edge_media_to_comment': {'count': rng.randint(0, 200), 'edges': [{'node': {'id': str(rng.getrandbits(60)), 'text': sentence(rng.randint(1, 20)), 'created_at': 1500000000 + rng.randint(0, 10**8), 'owner': user(f"user_{rng.randint(0, 5000)}"), 'viewer_has_liked': False, 'edge_liked_by': {'count': rng.randint(0, 20)}}} for _ in range(rng.randint(0, 30))]},
+		'comments_disabled': False,
+		'taken_at_timestamp': 1500000000 + rng.randint(0, 10**8),
+		'edge_media_preview_like': {'count': rng.randint(0, 3000), 'edges': [{'node': user(f"user_{rng.randint(0, 5000)}")} for _ in range(rng.randint(0, 10))]},
+		'edge_media_to_sponsor_user': {'edges': []},
+		'location': None if place is None else {'id': place['id'], 'has_public_page': True, 'name': place['name'], 'slug': place['slug']},
+		'viewer_has_liked': False,
+		'viewer_has_saved': False,
+		'viewer_has_saved_to_collection': False,
+		'viewer_can_reshare': True,
+		'owner': dict(user(owner), is_verified=False, blocked_by_viewer=False, followed_by_viewer=False, full_name=owner.replace("_", " ").title(), has_blocked_viewer=False, is_private=False, is_unpublished=False, requested_by_viewer=False),
+		'is_ad': False,
+		'edge_web_media_to_related_media': {'edges': []},
+	})
+
+
+def _fixture_media_edges(shortcodes):
+	""" Returns the first page of a media list on a profile or location page. """
+	return({'count': len(shortcodes), 'page_info': {'has_next_page': len(shortcodes) > 12, 'end_cursor': None}, 'edges': [{'node': {'__typename': "GraphImage", 'shortcode': shortcode, 'display_url': f"{_STAND_IN_BASE_URL}/media/{shortcode}.jpg"}} for shortcode in shortcodes[-12:][::-1]]})
+
+
+def iter_fixture_pages(posts=1000, users=50, places=20, hashtags=5, reposts=0.25, seed=0):
+	""" Yields (type, key, page) for a made-up, self-consistent corpus of Instagram pages: every post has an owner among the users, some have a place among the places, and the user, place and hashtag pages list the posts that belong to them. A share `reposts` of the posts show the photo of an earlier post again: half of them the same file, half of them a slightly changed copy.
+
+	The corpus is the same for the same arguments. Media links point at the stand-in that serves the pages (see InstagramStandIn).
+	"""
+	rng = random.Random(seed)
+	usernames = [f"user_{n}" for n in range(users)]
+	tags = [f"tag{n}" for n in range(hashtags)]
+	_places = [{'id': str(10**6 + n), 'name': f"Place {n}", 'slug': f"place-{n}"} for n in range(places)]
+	user_posts, place_posts, tag_posts = collections.defaultdict(list), collections.defaultdict(list), collections.defaultdict(list)
+	images = []
+
+	for n in range(posts):
+		shortcode = "".join(rng.choice(string.ascii_letters + string.digits + "_-") for _ in range(11))
+		owner = rng.choice(usernames)
+		place = rng.choice(_places) if len(_places) > 0 and rng.random() < 0.4 else None
+		post_tags = rng.sample(tags, rng.randint(0, min(3, len(tags))))
+		user_posts[owner].append(shortcode)
+		if place is not None: place_posts[place['id']].append(shortcode)
+		for tag in post_tags: tag_posts[tag].append(shortcode)
+		if len(images) > 0 and rng.random() < reposts:
+			image = rng.choice(images) + (f"~{n}" if rng.random() < 0.5 else "")
+		else:
+			image = shortcode
+			images.append(image)
+		yield("post", shortcode, _fixture_html({'entry_data': {'PostPage': [{'graphql': {'shortcode_media': _fixture_post(seed * 10**9 + n, shortcode, owner, place, post_tags, image)}}]}}))
+
+	for n, username in enumerate(usernames):
+		user = {'biography': f"Performer number {n}.", 'edge_follow': {'count': rng.randint(0, 2000)}, 'edge_followed_by': {'count': rng.randint(0, 20000)}, 'edge_owner_to_timeline_media': _fixture_media_edges(user_posts[username]), 'external_url': None, 'full_name': username.replace("_", " ").title(), 'id': str(10**9 + n), 'is_business_account': False, 'is_joined_recently': False, 'is_private': False, 'is_verified': False, 'profile_pic_url': f"{_STAND_IN_BASE_URL}/media/{username}.jpg", 'profile_pic_url_hd': f"{_STAND_IN_BASE_URL}/media/{username}.jpg", 'username': username}
+		yield("user", username, _fixture_html({'entry_data': {'ProfilePage': [{'graphql': {'user': user}}]}}))
+
+	for place in _places:
+		location = dict(place, address_json=json.dumps({'street_address': "", 'zip_code': "10001", 'city_name': "New York", 'region_name': "", 'country_code': "US"}), blurb="", edge_location_to_media=_fixture_media_edges(place_posts[place['id']]), has_public_page=True, lat=40.7 + rng.random() / 10, lng=-74.0 + rng.random() / 10, phone="", primary_alias_on_fb="", website="", profile_pic_url=f"{_STAND_IN_BASE_URL}/media/{place['slug']}.jpg")
+		yield("place", place['id'], _fixture_html({'entry_data': {'LocationsPage': [{'graphql': {'location': location}}]}}))
+
+	for tag in tags:
+		shortcodes = tag_posts[tag][::-1]
+		rows = "".join('<div class="Nnq7C weEfm">' + "".join(f'<div class="v1Nh3 kIKUG _bz0w"><a href="/p/{shortcode}/"><img src="{_STAND_IN_BASE_URL}/media/{shortcode}.jpg"></a></div>' for shortcode in shortcodes[i:i+3]) + '</div>' for i in range(0, len(shortcodes), 3))
+		yield("hashtag", tag, _fixture_html(body=rows))
+
+
+def generate_fixtures(folder, posts=1000, users=50, places=20, hashtags=5, reposts=0.25, seed=0):
+	""" Writes a made-up corpus of Instagram pages (see iter_fixture_pages) to `folder`, for InstagramStandIn to serve.
+
+	Returns: Number of pages written per type.
+	"""
+	counts = collections.Counter()
+	for type, key, page in iter_fixture_pages(posts=posts, users=users, places=places, hashtags=hashtags, reposts=reposts, seed=seed):
+		_atomic_write(_fixture_path(folder, type, key), gzip.compress(page, compresslevel=1))
+		counts[type] += 1
+	return(dict(counts))
+
+
+def record_fixtures(folder, types=["post", "user", "place"]):
+	""" Copies the newest archived page of every record (see HtmlArchive) to `folder`, so InstagramStandIn can replay real pages. Places are stored under their slug, so the stand-in finds them by slug too.
+
+	Returns: Number of pages copied.
+	"""
+	archive, count = get_html_archive(), 0
+	for type in types:
+		for shortcode, fetched, blob_path in archive.latest(type):
+			destination = _fixture_path(folder, type, shortcode)
+			destination.parent.mkdir(parents=True, exist_ok=True)
+			shutil.copyfile(blob_path, destination)
+			count += 1
+	return(count)
+
+
+@functools.lru_cache(maxsize=256)
+def _fixture_image(name, pixels=128):
+	""" Returns a made-up greyscale PNG image of `pixels` x `pixels` for a media name: overlaid waves that are the same for the same name. A name like `{name}~{n}` gives the image of `name` with slight noise, like a recompressed repost. """
+	base, _, variant = name.partition("~")
+	rng = random.Random(base)
+	waves = []
+	for _ in range(8):
+		fx, fy, phase, amplitude = rng.uniform(-0.25, 0.25), rng.uniform(-0.25, 0.25), rng.uniform(0, 2 * math.pi), rng.uniform(8, 24)
+		# sin(fx*x + fy*y + phase) = sin(fx*x + phase) cos(fy*y) + cos(fx*x + phase) sin(fy*y)
+		waves.append(([amplitude * math.sin(fx * x + phase) for x in range(pixels)], [amplitude * math.cos(fx * x + phase) for x in range(pixels)], [math.cos(fy * y) for y in range(pixels)], [math.sin(fy * y) for y in range(pixels)]))
+	noise = random.Random(name) if variant != "" else None
+	rows = []
+	for y in range(pixels):
+		values = [128.0] * pixels
+		for sin_x, cos_x, cos_y, sin_y in waves:
+			a, b = cos_y[y], sin_y[y]
+			values = [value + s * a + c * b for value, s, c in zip(values, sin_x, cos_x)]
+		if noise is not None: values = [value + noise.uniform(-6, 6) for value in values]
+		rows.append(b"\x00" + bytes(min(255, max(0, int(value))) for value in values)) # Each row starts with filter type 0
+	chunk = lambda tag, data: struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+	return(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", pixels, pixels, 8, 0, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(b"".join(rows))) + chunk(b"IEND", b""))
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+	""" Request handler of InstagramStandIn. """
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		_log(f"Stand-in: {format % args}", 0)
+
+	def _send(self, status, body, content_type="text/html; charset=utf-8"):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		if status == 429: self.send_header("Retry-After", "1")
+		self.end_headers()
+		if self.command != "HEAD": self.wfile.write(body)
+
+	def _send_media(self, body):
+		""" Sends media, honouring a Range header (`bytes=start-`) like Instagram's media servers. """
+		match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+		if match is None: return(self._send(200, body, content_type="image/png"))
+		start = int(match.group(1))
+		if start >= len(body): return(self._send(416, b"", content_type="image/png"))
+		self.send_response(206)
+		self.send_header("Content-Type", "image/png")
+		self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+		self.send_header("Content-Length", str(len(body) - start))
+		self.end_headers()
+		if self.command != "HEAD": self.wfile.write(body[start:])
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		stand_in = self.server.stand_in
+		outcome = stand_in._outcome()
+		if stand_in.latency > 0: time.sleep(stand_in.latency * (1 + stand_in.jitter * (2 * random.random() - 1)))
+
+		if outcome == "throttled": return(self._send(429, _fixture_html(body="Please wait a few minutes before you try again.")))
+		if outcome == "error": return(self._send(200, _fixture_html(body="Sorry, something went wrong. We're working on getting this fixed as soon as we can.")))
+
+		parts = [unquote(part) for part in urlsplit(self.path).path.split("/") if part != ""]
+		if len(parts) == 2 and parts[0] == "media": return(self._send_media(stand_in.media(parts[1])))
+		if len(parts) == 2 and parts[0] == "p": type, keys = "post", [parts[1]]
+		elif len(parts) >= 3 and parts[0:2] == ["explore", "tags"]: type, keys = "hashtag", [parts[2]]
+		elif len(parts) >= 3 and parts[0:2] == ["explore", "locations"]: type, keys = "place", parts[2:4]
+		elif len(parts) == 1: type, keys = "user", [parts[0]]
+		else: type, keys = None, []
+
+		for key in keys:
+			page = stand_in.page(type, key)
+			if page is not None: return(self._send(200, page))
+		stand_in._count("missing")
+		self._send(404, _fixture_html(body="Sorry, this page isn't available. The link you followed may be broken, or the page may have been removed."))
+
+
+class InstagramStandIn(object):
+	""" A local HTTP server that stands in for Instagram, for testing and benchmarking the download path (download_json, download_photo, check_posts, scrape_shortcodes) without the live site.
+
+	It serves the post, profile, location and hashtag pages in `folder` (see generate_fixtures and record_fixtures) at Instagram's paths, and made-up media under /media/. Pages it does not have get Instagram's "link you followed may be broken" page.
+
+	Parameters:
+	- latency: Seconds added to every response (varied by +/- `jitter` times itself)
+	- error_rate: Share of requests answered with Instagram's "something went wrong" page
+	- throttle_rate: Share of requests answered with HTTP 429
+	- max_rate: Requests per second above which requests are answered with HTTP 429, like Instagram's own rate limit (None for no limit)
+
+	Used as a context manager, it points cfg['instagram_base_url'] at itself until the block ends:
+	- with InstagramStandIn(folder, latency=0.2, max_rate=5): prefetch(shortcodes)
+	"""
+
+	def __init__(self, folder, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, max_rate=None, media_pixels=128, seed=0):
+		self.folder = Path(folder)
+		self.latency, self.jitter, self.error_rate, self.throttle_rate, self.max_rate, self.media_pixels = latency, jitter, error_rate, throttle_rate, max_rate, media_pixels
+		self.counts = collections.Counter()
+		self._lock = threading.Lock()
+		self._rng = random.Random(seed)
+		self._tokens, self._last = (max_rate or 0), time.monotonic()
+		self._server = ThreadingHTTPServer((host, port), _StandInHandler)
+		self._server.daemon_threads = True
+		self._server.stand_in = self
+		self._thread, self._base_url = None, None
+
+	@property
+	def url(self):
+		host, port = self._server.server_address[0:2]
+		return(f"http://{host}:{port}")
+
+	def _count(self, outcome):
+		with self._lock: self.counts[outcome] += 1
+
+	def _outcome(self):
+		""" Decides whether a request is throttled, answered with an error page, or served. """
+		with self._lock:
+			self.counts['requests'] += 1
+			if self.max_rate is not None:
+				now = time.monotonic()
+				self._tokens = min(self.max_rate, self._tokens + (now - self._last) * self.max_rate)
+				self._last = now
+				if self._tokens < 1:
+					self.counts['throttled'] += 1
+					return("throttled")
+				self._tokens -= 1
+			draw = self._rng.random()
+			if draw < self.throttle_rate: outcome = "throttled"
+			elif draw < self.throttle_rate + self.error_rate: outcome = "error"
+			else: outcome = "served"
+			self.counts[outcome] += 1
+			return(outcome)
+
+	def page(self, type, key):
+		""" Returns a fixture page as served (with media links pointing at the stand-in), or None if there is none. """
+		path = _fixture_path(self.folder, type, key)
+		if not path.exists(): return(None)
+		with gzip.open(path, "rb") as f: return(f.read().replace(_STAND_IN_BASE_URL.encode("utf-8"), self.url.encode("utf-8")))
+
+	def media(self, name):
+		""" Returns a made-up PNG image for a media file name (see _fixture_image). """
+		return(_fixture_image(name.split(".")[0], self.media_pixels))
+
+	def start(self):
+		""" Starts serving in a background thread. """
+		self._thread = threading.Thread(target=self._server.serve_forever, name="InstagramStandIn", daemon=True)
+		self._thread.start()
+		_log(f"Instagram stand-in serving {self.folder} at {self.url}.", 0)
+		return(self)
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+		if self._thread is not None: self._thread.join()
+		self._thread = None
+
+	def __enter__(self):
+		if self._thread is None: self.start()
+		self._base_url = cfg['instagram_base_url']
+		cfg['instagram_base_url'] = self.url
+		return(self)
+
+	def __exit__(self, *exc):
+		cfg['instagram_base_url'] = self._base_url
+		self.stop()
+
+
+def download_json(type=None, shortcode=None, id=None):
+	""" Download JSON data from Instagram """
+
+	# Verify all settings
+	if type == None: raise SyntaxError('A type must be provided.')
+	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
+
+	# Get the full link to the Instagram post
+	link = get_instagram_link(type=type, shortcode=shortcode, id=id)
+
+	# Wait
+	wait_for_download()
+
+	# Download HTML
+	_log(f"Attempting to download Instagram post {shortcode}...", 0)
+	response = http_get(link)
+	scan = _scan_page(response.content) # Once, for both the throttling check and the extraction
+	throttled = _is_throttled(response, scan)
+	get_rate_limiter("instagram").report(throttled)
+	if response.status_code in THROTTLING_STATUS_CODES: raise ThrottledError(f"Instagram answered the request for {type} {shortcode} with HTTP status {response.status_code}.")
+	if throttled: raise ThrottledError(f"Instagram answered the request for {type} {shortcode} with a \"something went wrong\" page.") # Not an empty record: retried, and never archived or saved
+
+	if cfg['html_archive']: get_html_archive().put(type, shortcode, response.content)
+	_save_instagram_html(type, shortcode, response.content, scan=scan)
+
+
+def _save_instagram_html(type=None, shortcode=None, html=None, scan=None):
+	""" Extracts the JSON data from a downloaded Instagram page and saves it in the cache (or saves an empty record if the page says the record is not available). """
+	_json = _extract_record(type, shortcode, html, scan=scan)
+	if _json == "": _save_empty_json(type, shortcode) # We found an empty Instagram type here...
+	else: _save_json(_json, type, shortcode)
+
+
+def _extract_record(type, shortcode, html, scan=None):
+	""" Returns the cleaned-up record data in a downloaded Instagram page, or an empty string if the page says the record is not available. Raises ExtractionError if the page does not have the expected layout. `scan` is passed on to extract_shared_data. """
+	shared_data = extract_shared_data(html, scan=scan)
+	if shared_data is None: return("")
+
+	entry_data = shared_data.get("entry_data")
+	if not isinstance(entry_data, dict): raise ExtractionError(f"The page for Instagram {type} {shortcode} has no entry_data in its shared data. Keys: {list(shared_data.keys())}.")
+
+	page, node = _ENTRY_DATA_PAGES[type]
+	if page not in entry_data:
+		if "HttpErrorPage" in entry_data: return("")
+		raise ExtractionError(f"The page for Instagram {type} {shortcode} has no {page}. It has: {list(entry_data.keys())}.")
+
+	try:
+		_json = entry_data[page][0]["graphql"][node]
+	except (IndexError, KeyError, TypeError):
+		raise ExtractionError(f"The {page} for Instagram {type} {shortcode} has no graphql {node}.") from None
+
+	return(_migrate_record(type, _json)) # Cleans up posts and stamps the current schema version
+
+
+
+
+def is_in_cache(type=None, shortcode=None):
+	return(get_cache_manifest().lookup(type, shortcode) is not None)
+
+def in_cache():
+	pass
+
+
+def _download_locked(type, shortcode, id=None, force_download=False):
+	""" One download attempt, for call_with_retries, holding the record's cache lock for the attempt only: the circuit breaker and the backoff between attempts wait outside the lock, so they do not hold up other workers on the same lock stripe. Returns False without downloading if another worker has saved the record in the meantime (unless `force_download`). """
+	with cache_lock(type, shortcode):
+		if not force_download and get_cache_backend().exists(type, shortcode): return(False)
+		download_json(type=type, shortcode=shortcode, id=id)
+	return(True)
+
+
+def _get_instagram_data(type=None, shortcode=None, id=None, force_download=False):
+	""" Fetches the correct JSON from the cache, or redirects to an attempt to download the cache file if it does not already exist. """
+
+	# Settings are not verified here as they are verified in the later steps when they are needed (see get_json_path and download_json functions)
+
+	negative_cache = get_negative_cache()
+
+	# Known empty records are answered without touching the cache, until they are old enough to be checked again
+	if not force_download:
+		if negative_cache.is_known_empty(type, shortcode): return("")
+		if negative_cache.is_due(type, shortcode):
+			_log(f"Checking again whether empty {type} {shortcode} has become available.", 0)
+			force_download = True
+
+	# Records read ahead by a parallel dataset load
+	preloaded = None if force_download else _preloaded_record(type, shortcode)
+	if preloaded is not None: return(preloaded[0])
+	
+	if force_download: call_with_retries(_download_locked, type, shortcode, id, force_download=True, key=(type, shortcode, id))
+	
+	data = _cache_get(type, shortcode)
+	if data is not None: return(data)
+
+	# Another process may download the record while we wait for the lock
+	call_with_retries(_download_locked, type, shortcode, id, key=(type, shortcode, id))
+	data = _cache_get(type, shortcode)
+	if data is None: _log(f"Error: Tried to download but something failed twice with {type} with shortcode {shortcode}.", 20)
+	return(data)
+
+
+# Parallel loading
+
+_preloaded = threading.local()
+
+
+@contextlib.contextmanager
+def _preloaded_records(records):
+	""" Within the block, _get_instagram_data (and _downloaded and _age) answer from `records` in the current thread, where they can: a dictionary of (type, shortcode): (data, manifest entry), as made by load_records. With None, nothing changes. """
+	previous = getattr(_preloaded, 'records', None)
+	_preloaded.records = records
+	try:
+		yield
+	finally:
+		_preloaded.records = previous
+
+
+def _preloaded_record(type, shortcode):
+	""" Returns the preloaded (data, manifest entry) of a record, or None. """
+	records = getattr(_preloaded, 'records', None)
+	if records is None: return(None)
+	return(records.get((type, shortcode)))
+
+
+def load_records(type, shortcodes, readers, parsers):
+	""" Reads the cached records of many shortcodes with the `readers` thread pool and parses them with the `parsers` process pool. Records that are not in the cache are left out (they are downloaded as usual when they are used). Outdated records are migrated as by _cache_get.
+
+	Returns: A dictionary of (type, shortcode): (data, manifest entry).
+	"""
+	backend, manifest = get_cache_backend(), get_cache_manifest()
+	shortcodes = list(shortcodes)
+	raws = list(readers.map(lambda shortcode: backend.get_raw(type, shortcode), shortcodes))
+	present = [(shortcode, raw) for shortcode, raw in zip(shortcodes, raws) if raw is not None]
+	entries = manifest.get_many(type, [shortcode for shortcode, _ in present])
+
+	records = {}
+	for (shortcode, _), data in zip(present, parsers.map(_decode_record, [raw for _, raw in present], chunksize=64)):
+		if _is_outdated(type, data): data = _cache_get(type, shortcode) # Migrates and writes back
+		else: manifest.touch(type, shortcode)
+		records[(type, shortcode)] = (data, entries.get(shortcode))
+	return(records)
+
+
+def _load_post_records(shortcodes, readers, parsers, loaded, mentions=True):
+	""" Loads the records of a chunk of posts and of the users and places they refer to, leaving out users and places in `loaded` (and adding the new ones to it). See InstagramDataset(workers=...). """
+	records = load_records("post", shortcodes, readers, parsers)
+	users, places = set(), set()
+	for data, _ in records.values():
+		if not isinstance(data, dict): continue
+		if data.get('owner'): users.add(data['owner'])
+		if data.get('location') is not None and data['location'].get('slug'): places.add(data['location']['slug'])
+		if mentions and data.get('caption'): users.update(get_mentions(data['caption']))
+	for type, keys in [("user", users), ("place", places)]:
+		keys = [key for key in keys if (type, key) not in loaded]
+		loaded.update((type, key) for key in keys)
+		records.update(load_records(type, keys, readers, parsers))
+	return(records)
+
+
+# Dataset snapshots
+
+DATASET_SNAPSHOT_MAGIC = b"IGDATASET"
+DATASET_SNAPSHOT_VERSION = 2
+
+
+def _folder_fingerprint(path):
+	""" Returns a digest of the names, sizes and modification times of the files in a folder, or None if there is no such folder. """
+	try:
+		entries = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(path))
+	except FileNotFoundError:
+		return(None)
+	return(hashlib.sha256(repr(entries).encode("utf-8")).hexdigest())
+
+
+def _dataset_folders(hashtags, users):
+	""" Returns the folders that get_shortcodes_from_hashtags and get_shortcodes_from_users read the shortcodes of a dataset from. """
+	return([str(cfg['hashtags_datasets'] / hashtag) for hashtag in hashtags] + [str(cfg['users_datasets'] / user / 'feed') for user in users])
+
+
+def _snapshot_records(keys):
+	""" Returns the manifest state of (type, shortcode) records as {type: {shortcode: [downloaded, status, schema]}}, with None for records that are not in the manifest. """
+	manifest, by_type, records = get_cache_manifest(), {}, {}
+	for type, shortcode in keys: by_type.setdefault(type, []).append(shortcode)
+	for type, shortcodes in by_type.items():
+		entries = manifest.get_many(type, shortcodes)
+		records[type] = {shortcode: [entries[shortcode]['downloaded'], entries[shortcode]['status'], entries[shortcode]['schema']] if shortcode in entries else None for shortcode in shortcodes}
+	return(records)
+
+
+def _snapshot_stream(f, mode, compression):
+	""" Returns a file object that (de)compresses a snapshot's dataset to or from the open file `f`. """
+	if compression is None: return(contextlib.nullcontext(f))
+	elif compression == "gzip": return(gzip.GzipFile(fileobj=f, mode=mode, compresslevel=cfg['dataset_snapshot_level']))
+	elif compression == "lzma": return(lzma.LZMAFile(f, mode=mode, preset=cfg['dataset_snapshot_level']))
+	else: raise RuntimeError(f"Cannot understand dataset snapshot compression `{compression}`. Use None, `gzip` or `lzma`.")
+
+
+def _write_snapshot(path, header, dataset):
+	""" Writes a snapshot: the magic bytes, the length of the header, the header (zlib-compressed JSON) and the pickled dataset. """
+	raw_header = zlib.compress(json.dumps(header).encode("utf-8"))
+	with _atomic_file(path) as f:
+		f.write(DATASET_SNAPSHOT_MAGIC + struct.pack(">I", len(raw_header)) + raw_header)
+		with _snapshot_stream(f, "wb", header['compression']) as stream: pickle.dump(dataset, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_snapshot_header(path):
+	""" Reads the header of a snapshot. Returns (header, the offset of the pickled dataset). """
+	with open(path, "rb") as f:
+		if f.read(len(DATASET_SNAPSHOT_MAGIC)) != DATASET_SNAPSHOT_MAGIC: raise RuntimeError(f"{path} is not a dataset snapshot.")
+		length = struct.unpack(">I", f.read(4))[0]
+		return(json.loads(zlib.decompress(f.read(length))), len(DATASET_SNAPSHOT_MAGIC) + 4 + length)
+
+
+def _read_snapshot_dataset(path, header, offset):
+	""" Reads the dataset of a snapshot, or returns None if it cannot be read (from an older version of the snapshots or of this module). """
+	if header['version'] != DATASET_SNAPSHOT_VERSION: return(None)
+	try:
+		with open(path, "rb") as f:
+			f.seek(offset)
+			with _snapshot_stream(f, "rb", header['compression']) as stream: return(pickle.load(stream))
+	except Exception as e:
+		_log(f"Warning: Could not read the dataset in snapshot {path} ({e.__class__.__name__}: {e}).", 10)
+		return(None)
+
+
+# Dataset aggregates
+
+def _aggregate_hashtags(post):
+	return(get_hashtags(post.caption, lower=True) if post.caption else [])
+
+
+def _aggregate_mentions(post):
+	return(get_mentions(post.caption, lower=True) if post.caption else [])
+
+
+def _aggregate_tagged(post):
+	return([t['username'] for t in post.tagged_users or []])
+
+
+def _aggregate_users(post):
+	return([post.user.username] if post.user.ok else [])
+
+
+def _aggregate_likes(post):
+	return([post.num_likes])
+
+
+def _aggregate_countries(post):
+	return([post.location.country] if post.location is not None else [])
 
-	return(list(set(_)))
 
-def get_shortcodes_from_users(users=None):
-	if users == None: raise SyntaxError("You have to provide at least one username (as a string) or a list of usernames containing at least one element.")
-	if isinstance(users, str): users = [users]
-	_ = []
-	for user in users:
-		path = cfg["users_datasets"] / user / 'feed'
-		shortcodes = get_shortcodes_from_path(path)
-		_.extend(shortcodes)
+def _aggregate_no_location(post):
+	return([post.shortcode] if post.location is None else [])
 
-	return(list(set(_)))
 
+def _aggregate_days(post):
+	return([post.date.strftime("%Y-%m-%d")])
 
-def get_shortcodes_from_path(path):
-	p = Path(path)
-	files = listdir_nohidden(p)
-	shortcodes = []
-	
-	for file in files:
-		fp = Path(file).name
 
-		if fp[0:1] == ".": pass # Found a hidden file
+# The aggregators that every dataset counts its posts with (see InstagramDataset.Aggregates)
+DATASET_AGGREGATORS = {
+	"hashtags": _aggregate_hashtags,
+	"mentions": _aggregate_mentions,
+	"tagged": _aggregate_tagged,
+	"users": _aggregate_users,
+	"likes": _aggregate_likes,
+	"countries": _aggregate_countries,
+	"no-location": _aggregate_no_location,
+	"days": _aggregate_days,
+}
 
-		elif fp[0:1] == "_": # Found a cache file!
-			with open(f"{p}/{fp}", "r") as f: shortcodes.extend(f.read().split("\n"))
 
-		else: # Found another file, try to open it and read
-			try:
-				with open(f"{p}/_{fp}", "r") as f: pass # Trying to check whether we have a cache'd version of this one (if so, it takes priority!)
-			except:
-				try:
-					with open(file, "r") as f:
-						content = f.read()
-						g = re.findall(pattern='a href="\/p\/(\S*)\/', string=content) # Sear for "/p/________/"
-						if len(g) > 0:
-							_log(f"Debug: Found {len(g)} shortcodes in {file}.")
-						else:
-							g = re.findall(pattern='a href="\/p\/(\S*)">|\?=\S+"', string=content) # We're now searching for "/p/______"
-							if len(g) > 0:
-								_log(f"Debug: Found {len(g)} shortcodes in {file}.")
-							else:
-								_log(f"Warning: RegEx found no shortcodes ({g}) in file {file}.", 10)
-						
-					with open(f"{p}/_{fp}", "w+") as f:
-						f.write("\n".join(g))
-					shortcodes.extend(g)
-				except Exception as e:
-					print(e)
-					exit()
-					
-	# shortcodes = list(filter(None, shortcodes))
-	
-	return(list(set(shortcodes)))
+def register_aggregator(name, aggregator):
+	""" Adds an aggregator to all datasets that are set up from now on (see InstagramDataset.add_aggregator for a dataset that is already set up): a function that takes an InstagramPost and returns a list of the keys to count the post under. The counts are then in dataset.aggregate(name).
 
+	Register the aggregator before loading snapshots of datasets that use it, so their counts keep changing with the dataset.
+	"""
+	DATASET_AGGREGATORS[name] = aggregator
 
-def listdir_fullpath(d):
-	return [os.path.join(d, f) for f in os.listdir(d)]
 
+# Prefetching
 
-def listdir_nohidden(path):
-	return glob.glob(os.path.join(path, '*'))
+def _prefetch_key(type, shortcode, id, force_download):
+	""" Downloads one record for prefetch(), in a worker thread. Returns False if another process got to it first. """
+	return(call_with_retries(_download_locked, type, shortcode, id, force_download, key=(type, shortcode, id)))
 
 
+async def _prefetch_async(keys, concurrency, bar=None):
+	""" Downloads (type, shortcode, id, force_download) keys with at most `concurrency` requests in flight. Waiting for the rate limiter, fetching, extraction and saving run in a thread pool, off the event loop. """
+	loop = asyncio.get_running_loop()
+	semaphore = asyncio.Semaphore(concurrency)
+	counts = {'downloaded': 0, 'failed': 0, 'done': 0}
 
+	async def fetch(key):
+		async with semaphore:
+			try:
+				if await loop.run_in_executor(executor, _prefetch_key, *key): counts['downloaded'] += 1
+			except Exception as e:
+				# Already written to the failure records by call_with_retries
+				counts['failed'] += 1
+				_log(f"Warning: Could not prefetch {key[0]} {key[1]}: {e}", 10)
+		counts['done'] += 1
+		if bar is not None: bar.update(counts['done'])
 
-### NEW VERSION
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		await asyncio.gather(*(fetch(key) for key in keys))
+	return(counts)
 
-def _save_empty_json(path=None):
-	""" Save an empty JSON file """
 
-	# Verify all settings
-	if path == None: raise SyntaxError('A path must be provided.')
+def _run_coroutine(coroutine):
+	""" Runs a coroutine to completion, also from code that is already inside a running event loop (such as a Jupyter notebook), where it runs in a thread of its own. """
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		return(asyncio.run(coroutine))
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		return(executor.submit(asyncio.run, coroutine).result())
 
-	_json = ""
-	with open(path, 'w+') as outfile: json.dump(_json, outfile)
-
-
-def wait_for_download(min=cfg['downloads_wait_min'], max=cfg['downloads_wait_max'], randomize=True):
-	if not isinstance(min, int):
-		_log(f"Warning: Minimum wait time was set to {min}. Setting to 1 and moving on.", 10)
-		min = 1
-	if not isinstance(max, int):
-		_log(f"Warning: Maximum wait time was set to {max}. Setting to 3 and moving on.", 10)
-		max = 3
-	if randomize:
-		if min < max:
-			wait = randrange(min, max)
-		elif min == max:
-			wait = min
-		elif min > max:
-			wait = randrange(max, min)
-	else:
-		wait = min
-		_log(f"Waiting for set number {wait}.", 0)
-	time.sleep(wait)
 
+def prefetch(shortcodes=[], type="post", expand=False, concurrency=None, force_download=False, show_progress=True):
+	""" Downloads every record in a batch that is not in the cache yet, many at a time, so that loading them afterwards only reads the cache.
 
-def get_json_path(type=None, shortcode=None):
-	""" Returns the path to the local JSON file for the shortcode/type.
+	Records already in the cache and records known to be empty are skipped (unless `force_download`). Known empty records that are due to be checked again are downloaded again.
 
 	Args:
-		type (str): Set to either "post", "user", or "place" depending on which type of Instagram post you want to return
-		shortcode (str): An Instagram shortcode
+		shortcodes: A list of shortcodes of `type`, or of (type, shortcode) / (type, shortcode, id) tuples. Places need an ID.
+		expand: After prefetching posts, also prefetch their users and places (like InstagramPost(s, expand=True) would load them).
+		concurrency: Maximum number of requests in flight (default cfg['prefetch_concurrency']).
 
-	Returns:
-		str: The path to the JSON file for the shortcode/type.
-	"""
+	Example:
+	- prefetch(get_shortcodes_from_hashtags(["burlesque"]), expand=True)
 
-	# Verify all settings
-	if type == None: raise SyntaxError('A type must be provided.')
-	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
-	if (type != "post" and 
-		type != "user" and 
-		type != "place" and 
-		type != "tweet" and 
-		type != "tweeter" and
-		type != "twitter-place"): raise SyntaxError('An unknown type format was provided.')
+	Returns: Number of records downloaded.
+	"""
+	if concurrency is None: concurrency = cfg['prefetch_concurrency']
 
-	return(cfg['cache_folder'].joinpath(f"__{type}s/{shortcode}.json"))
+	backend, negative_cache = get_cache_backend(), get_negative_cache()
 
+	keys, seen = [], set()
+	for key in shortcodes:
+		if isinstance(key, str): key = (type, key)
+		_type, shortcode, id = key[0], key[1], key[2] if len(key) > 2 else None
+		if len(shortcode) == 0 or (_type, shortcode) in seen: continue
+		seen.add((_type, shortcode))
 
-def get_instagram_link(type=None, shortcode=None, id=None):
-	""" Returns the link to the Instagram page for the Instagram data. """
+		if force_download: keys.append((_type, shortcode, id, True))
+		elif negative_cache.is_due(_type, shortcode): keys.append((_type, shortcode, id, True))
+		elif not negative_cache.is_known_empty(_type, shortcode) and not backend.exists(_type, shortcode): keys.append((_type, shortcode, id, False))
 
-	# Verify all settings
-	if type == None: raise SyntaxError('A type must be provided.')
-	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
-	if type is not "post" and type is not "user" and type is not "place": raise SyntaxError('An unknown type format was provided.')
-	if type is "place" and id is None: raise SyntaxError('An ID must be provided together with a shortcode for Instagram places.')
+	_log(f"Prefetching {len(keys)} of {len(seen)} records ({concurrency} at a time, starting at {round(get_rate_limiter('instagram').rate, 3)} requests per second)...", 10)
 
-	if type == "post": return(f"http://www.instagram.com/p/{shortcode}")
-	elif type == "user": return(f"http://www.instagram.com/{shortcode}")
-	elif type == "place": return(f"http://www.instagram.com/explore/locations/{id}/{shortcode}")
+	counts = {'downloaded': 0, 'failed': 0}
+	if len(keys) > 0:
+		bar = progressbar.ProgressBar(max_value=len(keys)).start() if show_progress else None
+		counts = _run_coroutine(_prefetch_async(keys, concurrency, bar=bar))
+		if show_progress: bar.finish()
+		if counts['failed'] > 0: _log(f"Warning: {counts['failed']} records could not be prefetched. See get_cache_manifest().failures() and retry_failed().", 10)
 
+	downloaded = counts['downloaded']
+	if expand:
+		# Users and places are only known once the posts are in the cache
+		related = []
+		for _type, shortcode in seen:
+			if _type != "post": continue
+			data = _cache_get("post", shortcode) # Migrated to the current schema, like the posts that use it
+			if not data: continue
+			if data.get('owner') is not None: related.append(("user", data['owner']))
+			if data.get('location') is not None: related.append(("place", data['location']['slug'], data['location']['id']))
+		downloaded += prefetch(related, concurrency=concurrency, force_download=force_download, show_progress=show_progress)
 
-def _save_json(_json=None, path=None):
-	""" Internal function for saving JSON file to a desired path. """
+	return(downloaded)
 
-	# Verify all settings
-	if _json == None: raise SyntaxError('JSON data must be provided.')
-	if path == None: raise SyntaxError('A path must be provided.')
 
-	try:
-		with open(path, 'w+') as outfile: json.dump(_json, outfile)
-		return(True)
-	except:
-		raise Exception(f'JSON file {path} could not be saved.')
 
+def retry_failed(types=["post", "user", "place"], include_fatal=False, concurrency=None, show_progress=True):
+	""" Downloads the Instagram records in the failure records again (see call_with_retries), e.g. after an outage. Records that failed with a fatal error are only retried with `include_fatal`. Twitter records are downloaded again the next time they are loaded.
 
-def download_json(type=None, shortcode=None, id=None):
-	""" Download JSON data from Instagram """
+	Returns: Number of records downloaded.
+	"""
+	if isinstance(types, str): types = [types]
+	keys = []
+	for type in types:
+		for failure in get_cache_manifest().failures(type=type, retryable=None if include_fatal else True):
+			keys.append((failure['type'], failure['shortcode'], failure['id']))
+	_log(f"Retrying {len(keys)} failed records...", 10)
+	return(prefetch(keys, concurrency=concurrency, show_progress=show_progress))
 
-	# Verify all settings
-	if type == None: raise SyntaxError('A type must be provided.')
-	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
 
-	# Set up standards
-	_json, script = None, None
+# Job queue
 
-	# Get path where JSON should be stored
-	desired_path = get_json_path(type, shortcode)
+JOB_STATES = ["pending", "in-flight", "done", "empty", "failed"]
 
-	# Get the full link to the Instagram post
-	link = get_instagram_link(type=type, shortcode=shortcode, id=id)
 
-	# Wait
-	wait_for_download()
+class JobQueue(object):
+	""" A persistent queue of download jobs in an SQLite database, so that a large download can be interrupted and picked up where it stopped.
 
-	# Download HTML
-	_log(f"Attempting to download Instagram post {shortcode}...", 0)
-	html = requests.get(link).content
+	Every job is a record to download (type, shortcode and, for places, ID) with a priority and a state: pending, in-flight, done, empty (the record does not exist or is not available) or failed. Workers lease jobs (see lease()): leased jobs are in-flight until the worker reports them finished, and go back to pending if the lease runs out, e.g. because the worker crashed. Several processes can drain the same queue.
 
-	# Soupify
-	soup = BeautifulSoup(html, 'lxml')
+	Example:
+	- get_job_queue().add(get_shortcodes_from_hashtags(["burlesque"]))
+	- run_jobs(expand=True)
+	"""
 
-	if str(html).find("link you followed may be broken") > 0: _save_empty_json(desired_path)
-	elif str(html).find("something went wrong") > 0: _save_empty_json(desired_path)
-	elif str(html).find("video is not available in your country") > 0: _save_empty_json(desired_path)
-	else:
-		scripts = soup.findAll("script")
-		for s in scripts:
-			if str(s).find("shortcode") > 0:
-				script = s
-				_json = json.loads(str(script)[52:-10]) # #hard-coded cropping of Javascript here - might need to change in future revisions of Instagram source code
-
-		if _json is not None and "entry_data" in _json:
-			if type == "post": _json = _clean_post(_json["entry_data"]["PostPage"][0]["graphql"]["shortcode_media"])
-			elif type == "user": _json = _json["entry_data"]["ProfilePage"][0]["graphql"]["user"]
-			elif type == "place": _json = _json["entry_data"]["LocationsPage"][0]["graphql"]["location"]
-			_save_json(_json, desired_path)
-		elif _json is None:
-			_save_empty_json(desired_path) # We found an empty Instagram type here...
+	_COLUMNS = ['type', 'shortcode', 'id', 'priority', 'state', 'attempts', 'owner', 'lease_until', 'error', 'added', 'finished']
+
+	def __init__(self, path=None):
+		if path is None: path = cfg['job_queue_path'] or cfg['cache_folder'] / "jobs.sqlite"
+		self.path = Path(path)
+		self._lock = threading.RLock()
+		self._db = _connect_sqlite(self.path)
+		self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+			type TEXT NOT NULL,
+			shortcode TEXT NOT NULL,
+			id TEXT,
+			priority INTEGER NOT NULL DEFAULT 0,
+			state TEXT NOT NULL DEFAULT 'pending',
+			attempts INTEGER NOT NULL DEFAULT 0,
+			owner TEXT,
+			lease_until REAL,
+			error TEXT,
+			added REAL NOT NULL,
+			finished REAL,
+			PRIMARY KEY (type, shortcode)
+		) WITHOUT ROWID""")
+		self._db.execute("CREATE INDEX IF NOT EXISTS jobs_next ON jobs (state, priority DESC, added)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+		self._db.commit()
+
+	def add(self, keys, type="post", priority=0, requeue=False):
+		""" Adds jobs for a list of shortcodes of `type`, or of (type, shortcode) / (type, shortcode, id) tuples. Jobs already in the queue keep their state, unless `requeue` (then they are pending again, with the new priority).
+
+		Returns: Number of jobs added (or requeued).
+		"""
+		rows = []
+		for key in keys:
+			if isinstance(key, str): key = (type, key)
+			if len(str(key[1])) == 0: continue
+			rows.append((key[0], str(key[1]), None if len(key) < 3 or key[2] is None else str(key[2]), priority, time.time()))
+		sql = "INSERT INTO jobs (type, shortcode, id, priority, added) VALUES (?, ?, ?, ?, ?) ON CONFLICT (type, shortcode) DO "
+		if requeue: sql += "UPDATE SET state = 'pending', priority = excluded.priority, owner = NULL, lease_until = NULL, error = NULL, finished = NULL"
+		else: sql += "NOTHING"
+		with self._lock:
+			before = self._db.total_changes
+			with self._db: self._db.executemany(sql, rows)
+			return(self._db.total_changes - before)
+
+	def lease(self, count=10, owner=None, lease_seconds=None, keys=None, type="post"):
+		""" Leases up to `count` jobs to a worker: the pending jobs with the highest priority (oldest first), and in-flight jobs whose lease has run out. With `keys` (shortcodes of `type`, or (type, shortcode) tuples, as for add()), only those jobs are leased.
+
+		Returns: The leased jobs, as a list of dictionaries.
+		"""
+		if owner is None: owner = _get_worker_name()
+		if lease_seconds is None: lease_seconds = cfg['job_lease_seconds']
+		if keys is None: groups = [None]
 		else:
-			raise RuntimeError(f"Fatal error: Instagram {type} with shortcode {shortcode} could not be downloaded. JSON: \n{_json}\n")
-
-
+			keys = [(type, key) if isinstance(key, str) else (key[0], str(key[1])) for key in keys]
+			groups = [keys[i:i + 400] for i in range(0, len(keys), 400)] # Below the SQLite limit on query parameters
+		now = time.time()
+		with self._lock:
+			# BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same job
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				rows = []
+				for group in groups:
+					if len(rows) >= count: break
+					sql, values = f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE (state = 'pending' OR (state = 'in-flight' AND lease_until < ?))", [now]
+					if group is not None:
+						sql += f" AND (type, shortcode) IN (VALUES {', '.join(['(?, ?)'] * len(group))})"
+						values.extend(value for key in group for value in key)
+					rows.extend(self._db.execute(sql + " ORDER BY priority DESC, added LIMIT ?", values + [count - len(rows)]).fetchall())
+				self._db.executemany("UPDATE jobs SET state = 'in-flight', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE type = ? AND shortcode = ?", [(owner, now + lease_seconds, row[0], row[1]) for row in rows])
+				self._db.commit()
+			except BaseException:
+				self._db.rollback()
+				raise
+		jobs = [dict(zip(self._COLUMNS, row)) for row in rows]
+		for job in jobs: job.update({'state': "in-flight", 'owner': owner, 'lease_until': now + lease_seconds})
+		return(jobs)
+
+	def renew(self, jobs, lease_seconds=None):
+		""" Extends the leases of jobs that are still being worked on. """
+		if lease_seconds is None: lease_seconds = cfg['job_lease_seconds']
+		with self._lock:
+			with self._db: self._db.executemany("UPDATE jobs SET lease_until = ? WHERE type = ? AND shortcode = ? AND owner = ? AND state = 'in-flight'", [(time.time() + lease_seconds, job['type'], job['shortcode'], job['owner']) for job in jobs])
+
+	def finish(self, job, state, error=None):
+		""" Reports a leased job as done, empty or failed (or pending, to give it back). Jobs whose lease has gone to another worker are left alone. """
+		if state not in JOB_STATES: raise SyntaxError(f"Unknown job state `{state}`. Use one of {JOB_STATES}.")
+		with self._lock:
+			with self._db: self._db.execute("UPDATE jobs SET state = ?, error = ?, finished = ?, owner = NULL, lease_until = NULL WHERE type = ? AND shortcode = ? AND owner = ?", (state, error, time.time() if state != "pending" else None, job['type'], job['shortcode'], job['owner']))
+
+	def requeue(self, states=["failed"], type=None):
+		""" Puts all jobs in the given states (of one type, or of all types) back in the queue. Returns the number of jobs requeued. """
+		sql = f"UPDATE jobs SET state = 'pending', owner = NULL, lease_until = NULL, error = NULL, finished = NULL WHERE state IN ({','.join('?' * len(states))})"
+		values = list(states)
+		if type is not None:
+			sql += " AND type = ?"
+			values.append(type)
+		with self._lock:
+			with self._db: cursor = self._db.execute(sql, values)
+		return(cursor.rowcount)
+
+	def jobs(self, state=None, type=None, limit=None):
+		""" Returns the jobs in a state (and of a type), as a list of dictionaries. """
+		where, values = [], []
+		if state is not None: where.append("state = ?"); values.append(state)
+		if type is not None: where.append("type = ?"); values.append(type)
+		sql = f"SELECT {', '.join(self._COLUMNS)} FROM jobs"
+		if len(where) > 0: sql += " WHERE " + " AND ".join(where)
+		sql += " ORDER BY priority DESC, added"
+		if limit is not None: sql += f" LIMIT {int(limit)}"
+		with self._lock:
+			rows = self._db.execute(sql, values).fetchall()
+		return([dict(zip(self._COLUMNS, row)) for row in rows])
+
+	def progress(self, window=600):
+		""" Returns the number of jobs in each state, the throughput over the last `window` seconds (jobs finished per minute) and the estimated time left for the pending and in-flight jobs at that pace (in seconds, None when nothing has finished). """
+		with self._lock:
+			counts = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+			finished = self._db.execute("SELECT COUNT(*) FROM jobs WHERE finished > ?", (time.time() - window,)).fetchone()[0]
+		counts = {state: counts.get(state, 0) for state in JOB_STATES}
+		per_minute = finished / window * 60
+		remaining = counts['pending'] + counts['in-flight']
+		return({'states': counts, 'per_minute': round(per_minute, 1), 'eta_seconds': int(remaining / per_minute * 60) if per_minute > 0 else None})
+
+	def close(self):
+		with self._lock: self._db.close()
+
+
+_job_queue = None
+
+
+def get_job_queue():
+	""" Returns the job queue (creating it on first use). """
+	global _job_queue
+	if _job_queue is None: _job_queue = JobQueue()
+	return(_job_queue)
+
+
+def _get_worker_name():
+	""" Returns a name for this worker process that is unique across the machines sharing a queue. """
+	return(f"{socket.gethostname()}:{os.getpid()}")
+
+
+def _run_job(job):
+	""" Downloads the record of a leased job. Returns the state to finish the job with, and the error for failed jobs. """
+	try:
+		_prefetch_key(job['type'], job['shortcode'], job['id'], False)
+	except Exception as e:
+		return("failed", f"{e.__class__.__name__}: {e}")
+	entry = get_cache_manifest().lookup(job['type'], job['shortcode'])
+	if entry is None: return("failed", "The record is not in the cache after downloading.")
+	if entry['status'] == "empty": return("empty", None)
+	if entry['status'] == "error": return("failed", "The record was saved with an error.")
+	return("done", None)
 
 
-def is_in_cache(type=None, shortcode=None):
-	path = get_json_path(type=type, shortcode=shortcode)
-	try:
-		with open(path) as f: data = f.read()
-		return(True)
-	except FileNotFoundError:
-		return(False)
+def _related_jobs(job):
+	""" Returns the keys of the user and place of a downloaded post, so they can be added to the queue. """
+	if job['type'] != "post": return([])
+	data = _cache_get("post", job['shortcode']) # Migrated to the current schema, so owner is a username
+	if not data: return([])
+	keys = []
+	if data.get('owner') is not None: keys.append(("user", data['owner']))
+	if data.get('location') is not None: keys.append(("place", data['location']['slug'], data['location']['id']))
+	return(keys)
 
-def in_cache():
-	pass
 
+def run_jobs(queue=None, concurrency=None, batch=None, max_jobs=None, expand=False, keys=None, show_progress=True):
+	""" Works through the job queue until it is empty (or `max_jobs` jobs are finished): leases jobs in batches of `batch`, downloads them `concurrency` at a time and reports each one back to the queue. Several processes can run this against the same queue at once. The leases of running jobs are renewed every half cfg['job_lease_seconds'].
 
-def _get_instagram_data(type=None, shortcode=None, id=None, force_download=False):
-	""" Fetches the correct JSON from the cache, or redirects to an attempt to download the cache file if it does not already exist. """
+	With `expand`, the users and places of downloaded posts are added to the queue with the same priority. With `keys` (as for JobQueue.add()), only those jobs are run, and the rest of the queue is left alone.
 
-	# Settings are not verified here as they are verified in the later steps when they are needed (see get_json_path and download_json functions)
+	Returns: Number of jobs finished.
+	"""
+	if queue is None: queue = get_job_queue()
+	if concurrency is None: concurrency = cfg['prefetch_concurrency']
+	if batch is None: batch = concurrency * 2
+
+	finished = 0
+	if show_progress:
+		bar = progressbar.ProgressBar(max_value=max_jobs or progressbar.UnknownLength).start()
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		while max_jobs is None or finished < max_jobs:
+			jobs = queue.lease(count=batch if max_jobs is None else min(batch, max_jobs - finished), keys=keys)
+			if len(jobs) == 0: break
+
+			renewed = time.time()
+			pending = {executor.submit(_run_job, job): job for job in jobs}
+			while len(pending) > 0:
+				# Jobs can sit behind retries and the circuit breaker for a while, so the wait wakes up in time to renew their leases even when none finishes
+				done, _ = wait(pending, timeout=cfg['job_lease_seconds'] / 4, return_when=FIRST_COMPLETED)
+				for future in done:
+					job = pending.pop(future)
+					state, error = future.result()
+					queue.finish(job, state, error)
+					if expand and state == "done": queue.add(_related_jobs(job), priority=job['priority'])
+					finished += 1
+					if show_progress: bar.update(finished)
+
+				if len(pending) > 0 and time.time() - renewed > cfg['job_lease_seconds'] / 2:
+					queue.renew(list(pending.values()))
+					renewed = time.time()
+
+			get_cache_manifest().flush()
 
-	data = None
-	path = get_json_path(type=type, shortcode=shortcode)
-	
-	if force_download: download_json(type=type, shortcode=shortcode, id=id)
-	
-	try:
-		with open(path) as json_data: data = json.load(json_data)
-		return(data)
-	except FileNotFoundError:
-		download_json(type=type, shortcode=shortcode, id=id)
-		try:
-			with open(path) as json_data: data = json.load(json_data)
-			return(data)
-		except FileNotFoundError as e:
-			_log(f"Error: Tried to download but something failed twice with {type} with shortcode {shortcode}:\n\n{e}", 20)
-			return(None)
+	if show_progress: bar.finish()
+	return(finished)
 
 
 def _downloaded(type=None, shortcode=None, return_type="readable"):
@@ -1479,7 +5251,9 @@ def _downloaded(type=None, shortcode=None, return_type="readable"):
 	if type == None: raise SyntaxError('A type must be provided.')
 	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
 
-	timestamp = os.path.getctime(get_json_path(type, shortcode))
+	preloaded = _preloaded_record(type, shortcode)
+	entry = preloaded[1] if preloaded is not None and preloaded[1] is not None else get_cache_manifest().lookup(type, shortcode)
+	timestamp = entry['downloaded']
 	if return_type is "readable":
 		return(dt.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'))
 	elif return_type is "timestamp":
@@ -1495,23 +5269,24 @@ def _age(type=None, shortcode=None):
 	if type == None: raise SyntaxError('A type must be provided.')
 	if shortcode == None: raise SyntaxError('A shortcode must be provided.')
 
-	return(int(-((os.path.getctime(get_json_path(type, shortcode)) - time.time()) / 3600) / 24))
+	preloaded = _preloaded_record(type, shortcode)
+	entry = preloaded[1] if preloaded is not None and preloaded[1] is not None else get_cache_manifest().lookup(type, shortcode)
+	return(int(-((entry['downloaded'] - time.time()) / 3600) / 24))
 
 
-def get_empty_cache_files(type="posts"):
-	""" Returns a list of empty cache files (i.e. the ones with a size of 2 bytes). """
+def get_empty_cache_files(type="posts", return_type="path"):
+	""" Returns a list of empty cache files (i.e. the ones with a size of 2 bytes), or with return_type="shortcode", the shortcodes of the empty records. Records in other cache backends than the filesystem have no files, so only shortcodes can be returned for them. """
 
 	if type is not "posts" and type is not "users" and type is not "places": raise SyntaxError('An unknown type format was provided.')
+	if return_type not in ["path", "shortcode"]: raise SyntaxError(f'Could not understand return type {return_type}.')
+	if return_type == "path" and not isinstance(get_cache_backend(), FileSystemBackend): raise RuntimeError(f"Records in the {cfg['cache_backend']} cache backend are not files. Use return_type=\"shortcode\".")
 
-	names = os.listdir(f"{cfg['cache_folder']}__{type}")
-	paths = [os.path.join(f"{cfg['cache_folder']}__{type}", name) for name in names]
-	sizes = [(path, os.stat(path).st_size) for path in paths]
+	manifest = get_cache_manifest()
+	if not manifest.is_complete(type[:-1]): rebuild_manifest(types=type[:-1])
 
-	grouped = collections.defaultdict(list)
-	for path, size in sizes:
-		grouped[size].append(path)
-	size_two = grouped[2]
-	return(size_two)
+	shortcodes = [entry['shortcode'] for entry in manifest.query(type=type[:-1], status="empty")]
+	if return_type == "path": return([str(get_json_path(type=type[:-1], shortcode=shortcode)) for shortcode in shortcodes])
+	return(shortcodes)
 
 
 def delete_file(path):
@@ -1535,22 +5310,24 @@ def clean_cache_from_pattern(type="all", pattern=None):
 	if type is not "all" and type is not "posts" and type is not "users" and type is not "places": raise SyntaxError('An unknown type format was provided.')
 
 	count = 0
-	remove_files = []
-
-	if type is "all":
-		remove_posts = glob.glob(f"{cfg['cache_folder']}__posts/{pattern}")
-		remove_places = glob.glob(f"{cfg['cache_folder']}__places/{pattern}")
-		remove_users = glob.glob(f"{cfg['cache_folder']}__users/{pattern}")
-
-		remove_files.extend(remove_posts)
-		remove_files.extend(remove_places)
-		remove_files.extend(remove_users)
-	else:
-		remove_files = glob.glob(f"{cfg['cache_folder']}__{type}/{pattern}")
 
-	for file in remove_files:
-		delete_file(file)
-		count += 1
+	backend, manifest = get_cache_backend(), get_cache_manifest()
+	types = ["posts", "places", "users"] if type is "all" else [type]
+
+	if not isinstance(backend, FileSystemBackend):
+		# Match the pattern against the file names the records would have had in the filesystem cache
+		for _type in types:
+			for shortcode in list(backend.iterate(_type[:-1])):
+				if fnmatch.fnmatch(f"{shortcode}.json", pattern) and _cache_delete(_type[:-1], shortcode): count += 1
+		backend.flush()
+		return(count)
+
+	for _type in types:
+		remove_files = list(_iter_cache_files(f"__{_type}", pattern))
+		for file in remove_files:
+			delete_file(file)
+			manifest.remove(_type[:-1], Path(file).stem)
+			count += 1
 	return(count)
 
 def shortcodes_from_hashtag(h):
@@ -1884,11 +5661,7 @@ def cache_exists(type=None, shortcode=None):
 		- Returns: bool"""
 	if type != "post" and type != "user" and type != "place" and type != "tweet" and type != "tweeter" and type != "twitter-place": raise RuntimeError(f"Cannot understand type `{type}`.")
 
-	try:
-		_ = os.path.getctime(get_json_path(type, shortcode))
-		return(True)
-	except OSError:
-		return(False)
+	return(get_cache_manifest().lookup(type, shortcode) is not None)
 
 
 
@@ -2014,13 +5787,10 @@ class TweetGeo(object):
 		if special_id: id = special_id
 		else: id = self.id
 
-		if not cache_exists(type="twitter-place", shortcode=id):
-			data = self._download_place(id=id)
+		data = _cache_get("twitter-place", id)
+		if data is None: data = self._download_place(id=id)
 		else:
-			json_path = get_json_path(type="twitter-place", shortcode=id)
-			_log(f"Reading local cache for Tweet place ID {id}\n(DEBUG:\n\tid={self.id})\n\tspecial_id={special_id}\n\tfile={json_path}\n).", 0)
-			with open(json_path, 'r') as cache_file:
-				data = json.load(cache_file)
+			_log(f"Reading local cache for Tweet place ID {id}\n(DEBUG:\n\tid={self.id})\n\tspecial_id={special_id}\n).", 0)
 		return(data)
 
 
@@ -2029,18 +5799,13 @@ class TweetGeo(object):
 
 		_json = {}
 
-		# Get cache path
-		json_path = get_json_path(type="twitter-place", shortcode=id)
-
 		# Setup tweepy API
 		auth = tweepy.OAuthHandler(cfg['TWITTER_consumer_key'], cfg['TWITTER_consumer_secret'])
 		auth.set_access_token(cfg['TWITTER_access_token'], cfg['TWITTER_access_token_secret'])
 		api = tweepy.API(auth,wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
-		# Get place
-		_log(f"Attempting to download Tweet place ID {id}...", 10)
-		try:
-			__place = api.geo_id(id)
+		def download():
+			__place = _call_twitter(api.geo_id, id)
 			_json = {
 				'place_type': __place.place_type,
 				'bounding_box_type': __place.bounding_box.type,
@@ -2060,17 +5825,20 @@ class TweetGeo(object):
 			else: _log(f"Debug warning: __place.contained_within: {__place.contained_within}.", 10)
 
 			# save json
-			_log(f"Saving JSON in {json_path}...", 20)
-			with open(json_path, 'w+') as cache_file:
-				json.dump(_json, cache_file)
+			_log(f"Saving JSON for Tweet place ID {id}...", 20)
+			_cache_put("twitter-place", id, _json)
+
+		# Get place
+		_log(f"Attempting to download Tweet place ID {id}...", 10)
+		try:
+			call_with_retries(_download_twitter_locked, "twitter-place", id, download, key=("twitter-place", id), service="twitter")
 		except tweepy.TweepError as e:
-			_log(f"Error processing tweet location with ID {id}: "+str(e.args[0][0]['message']), 20)
-			with open(json_path, 'w+') as cache_file:
-				_json = {'error': str(e.args[0][0]['message'])}
-				json.dump(_json, cache_file)
+			if _is_retryable(e): raise # Not cached, so it is downloaded again next time
+			_log(f"Error processing tweet location with ID {id}: {_twitter_error_message(e)}", 20)
+			_json = {'error': _twitter_error_message(e)}
+			_cache_put("twitter-place", id, _json)
 		''' Unnecessary step but put here as a control... '''
-		with open(json_path, 'r') as cache_file:
-			data = json.load(cache_file)
+		data = _cache_get("twitter-place", id)
 		return(data)
 
 
@@ -2152,69 +5920,44 @@ class Tweet(object):
 	def _get_twitter_data(self, id=None):
 		if id == None: id = self.id
 
-		if not cache_exists(type="tweet", shortcode=id):
-			data = self._download_tweet(id=self.id)
+		data = _cache_get("tweet", id)
+		if data is None: data = self._download_tweet(id=self.id)
 		else:
 			_log(f"Reading local cache for Tweet ID {id}.")
-			json_path = get_json_path(type="tweet", shortcode=id)
-			with open(json_path, 'r') as cache_file:
-				data = json.load(cache_file)
 		return(data)
 
 	def _download_tweet(self, id=None):
 		if id == None: id = self.id
 
-		# Get cache path
-		json_path = get_json_path(type="tweet", shortcode=id)
-
 		# Setup tweepy API
 		auth = tweepy.OAuthHandler(cfg['TWITTER_consumer_key'], cfg['TWITTER_consumer_secret'])
 		auth.set_access_token(cfg['TWITTER_access_token'], cfg['TWITTER_access_token_secret'])
 		api = tweepy.API(auth,wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
-		# Get tweet
-		_log(f"Attempting to download Tweet ID {id}...")
-		_break = False
-		attempts = 1
-		while _break == False:
-			try:
-				__tweet = api.get_status(id, tweet_mode='extended')
-				_break = True
-			except:
-				wait_for_download()
-				attempts += 1
-				_log(f"Debug warning: Tweet download attempt failed. Attempt number {attempts} commences.")
-				if attempts == cfg["max_attempts"]+1: _break = True
-
-		if __tweet._json['user']['protected'] is True:
-			_log(f"Found a protected tweet and will not download data.", 10)
-			with open(json_path, 'w+') as cache_file:
-					_json = {'error': 'protected user data'}
-					json.dump(_json, cache_file)
-		else:
-			_json = __tweet._json
-
-			# clean tweet here
-			user_id = _json['user']['id']
-			del(_json['user'])
-			_json['user'] = user_id
+		def download():
+			__tweet = _call_twitter(api.get_status, id, tweet_mode='extended')
+			if __tweet._json['user']['protected'] is True:
+				_log(f"Found a protected tweet and will not download data.", 10)
+				_json = {'error': 'protected user data'}
+				_cache_put("tweet", id, _json)
+			else:
+				# clean tweet here
+				_json = _migrate_record("tweet", __tweet._json)
 
-			if 'retweeted_status' in _json and isinstance(_json['retweeted_status'], dict):
-				retweeted_status_id = _json['retweeted_status']['id']
-				del(_json['retweeted_status'])
-				_json['retweeted_status'] = retweeted_status_id
+				# save json
+				_cache_put("tweet", id, _json)
+			return(_json)
 
-			# save json
-			with open(json_path, 'w+') as cache_file:
-				json.dump(_json, cache_file)
-		'''
+		# Get tweet
+		_log(f"Attempting to download Tweet ID {id}...")
+		try:
+			return(call_with_retries(_download_twitter_locked, "tweet", id, download, key=("tweet", id), service="twitter"))
 		except tweepy.TweepError as e:
-			_log(f"Error processing tweet ID {id}: "+str(e.args[0][0]['message']), 10)
-			with open(json_path, 'w+') as cache_file:
-				_json = {'error': str(e.args[0][0]['message'])}
-				json.dump(_json, cache_file)
-		'''
-		return(_json)
+			if _is_retryable(e): raise # Not cached, so it is downloaded again next time
+			_log(f"Error processing tweet ID {id}: {_twitter_error_message(e)}", 10)
+			_json = {'error': _twitter_error_message(e)}
+			_cache_put("tweet", id, _json)
+			return(_json)
 
 
 class TwitterUser(object):
@@ -2238,50 +5981,39 @@ class TwitterUser(object):
 	def _get_twitter_user(self, id=None):
 		if id == None: id = self.id
 
-		if not cache_exists(type="tweeter", shortcode=id):
-			data = self._download_tweet_user(id=id)
+		data = _cache_get("tweeter", id)
+		if data is None: data = self._download_tweet_user(id=id)
 		else:
 			_log(f"Reading local cache for Tweet user with ID {id}.")
-			json_path = get_json_path(type="tweeter", shortcode=id)
-			with open(json_path, 'r') as cache_file:
-				data = json.load(cache_file)
 		return(data)
 
 
 	def _download_tweet_user(self, id=None):
 		if id == None: id = self.id
 
-		# Get cache path
-		json_path = get_json_path(type="tweeter", shortcode=id)
-
 		# Setup tweepy API
 		auth = tweepy.OAuthHandler(cfg['TWITTER_consumer_key'], cfg['TWITTER_consumer_secret'])
 		auth.set_access_token(cfg['TWITTER_access_token'], cfg['TWITTER_access_token_secret'])
 		api = tweepy.API(auth,wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
-		# Get tweet
-		_log(f"Attempting to download Tweet user with ID {id}...")
-
-		# try
-		_break = False
-		attempts = 1
-		while _break == False:
-			try:
-				__tweet = api.get_user(id)
-				_break = True
-			except:
-				wait_for_download()
-				attempts += 1
-				_log(f"Debug warning: Tweet download attempt failed. Attempt number {attempts} commences.")
-				if attempts == cfg["max_attempts"]+1: _break = True
+		def download():
+			_json = _call_twitter(api.get_user, id)._json
 
-		_json = __tweet._json
+			# save json
+			_cache_put("tweeter", id, _json)
+			return(_json)
 
-		# save json
-		with open(json_path, 'w+') as cache_file:
-			json.dump(_json, cache_file)
+		# Get tweet
+		_log(f"Attempting to download Tweet user with ID {id}...")
 
-		return(_json)
+		try:
+			return(call_with_retries(_download_twitter_locked, "tweeter", id, download, key=("tweeter", id), service="twitter"))
+		except tweepy.TweepError as e:
+			if _is_retryable(e): raise # Not cached, so it is downloaded again next time
+			_log(f"Error processing Tweet user with ID {id}: {_twitter_error_message(e)}", 10)
+			_json = {'error': _twitter_error_message(e)}
+			_cache_put("tweeter", id, _json)
+			return(_json)
 
 
 
@@ -2393,7 +6125,8 @@ def _clean_post(data):
 	if 'viewer_in_photo_of_you	' in data: del(data['viewer_in_photo_of_you	'])
 	if 'viewer_can_reshare' in data: del(data['viewer_can_reshare'])
 
-	data['caption'] = ""
+	# Only what is still in raw form is reset, so cleaning a cleaned post again changes nothing
+	if 'edge_media_to_caption' in data or 'caption' not in data: data['caption'] = ""
 	if 'edge_media_to_caption' in data and len(data['edge_media_to_caption']['edges']) > 0:
 		data['caption'] = data['edge_media_to_caption']['edges'][0]['node']['text']
 		del(data['edge_media_to_caption'])
@@ -2405,7 +6138,7 @@ def _clean_post(data):
 		data['owner'] = owner_username
 		data['owner_is_private'] = is_private
 
-	data["comments"] = []
+	if 'edge_media_to_comment' in data or 'comments' not in data: data["comments"] = []
 	if 'edge_media_to_comment' in data and isinstance(data['edge_media_to_comment'], dict):
 		data["num_comments"] = data['edge_media_to_comment']['count']
 		for edge in data['edge_media_to_comment']['edges']:
@@ -2417,7 +6150,7 @@ def _clean_post(data):
 			})
 		del(data['edge_media_to_comment'])
 
-	data['likes'] = []
+	if 'edge_media_preview_like' in data or 'likes' not in data: data['likes'] = []
 	if 'edge_media_preview_like' in data:
 		data["num_likes"] = data['edge_media_preview_like']['count']
 		# del(data['edge_media_preview_like']['count'])
@@ -2425,7 +6158,7 @@ def _clean_post(data):
 			data['likes'].append(edge['node']['username'])
 		del(data['edge_media_preview_like'])
 
-	data["tagged"] = []
+	if 'edge_media_to_tagged_user' in data or 'tagged' not in data: data["tagged"] = []
 	if 'edge_media_to_tagged_user' in data:
 		for edge in data['edge_media_to_tagged_user']['edges']:
 			data['tagged'].append({
@@ -2435,10 +6168,10 @@ def _clean_post(data):
 			})
 		del(data['edge_media_to_tagged_user'])
 
-	data["sponsor_user"] = []
 	if 'edge_media_to_sponsor_user' in data:
+		data["sponsor_users"] = []
 		for edge in data['edge_media_to_sponsor_user']['edges']:
-			data['sponsor_user'].append({
+			data['sponsor_users'].append({
 				'username': edge['node']['sponsor']['username']
 			})
 		del(data['edge_media_to_sponsor_user'])
@@ -2478,12 +6211,7 @@ def check_for_new_posts(username=None, return_val='bool'):
 	
 	for post in user._raw['edge_owner_to_timeline_media']['edges']:
 		if post['node']['shortcode'] is not None:
-			path = get_json_path(type='post', shortcode=post['node']['shortcode'])
-			try:
-				with open(path, "r") as f:
-					contents = f.read()
-					# print(f"{post['node']['shortcode']} ({path}) was already downloaded.")
-			except:
+			if not cache_exists(type='post', shortcode=post['node']['shortcode']):
 				if return_val is "bool": new_content = True
 				elif return_val is "list": new_content.append(post['node']['shortcode'])
 				# print(f"{post['node']['shortcode']} was new!")
@@ -2502,9 +6230,9 @@ def save_new_posts(username=None, dataset_path=cfg['users_datasets']):
 		with open(fp, "w+") as f:
 			f.write("\n".join(new_posts))
 			# print(f"New shortcodes written to {fp}.")
-		for shortcode in new_posts:
-			post = InstagramPost(shortcode)
-			# print(f"Downloaded post {shortcode}.")
+		# Queued first, so that an interrupted run can be finished with run_jobs(). New posts are not in the cache, so jobs that finished before (e.g. for a record evicted since) are queued again
+		get_job_queue().add(new_posts, priority=1, requeue=True)
+		run_jobs(keys=new_posts, show_progress=False)
 	else:
 		print("No new posts found")
 
@@ -2540,10 +6268,7 @@ def check_posts(username=None, return_val='total'):
 		else:
 			for post in user._raw['edge_owner_to_timeline_media']['edges']:
 				if post['node']['shortcode'] is not None:
-					path = get_json_path(type='post', shortcode=post['node']['shortcode'])
-					try:
-						with open(path, "r") as f: contents = f.read()
-					except:
+					if not cache_exists(type='post', shortcode=post['node']['shortcode']):
 						_log(f"New post found: {post['node']['shortcode']}", 0)
 						_.append(post['node']['shortcode'])
 			if len(_) > 0:
@@ -2557,6 +6282,8 @@ def check_posts(username=None, return_val='total'):
 			
 def download_photo(shortcode=None, save_path="./", filename=None):
 	'''
+	Copies the photo of a post to `save_path`, downloading it first if it is not in the media folder yet (see download_media). Without a `filename`, the file is named by the shortcode with the extension of the photo's real format.
+
 	Returns: 
 		- filename if successful download
 	'''
@@ -2564,28 +6291,303 @@ def download_photo(shortcode=None, save_path="./", filename=None):
 
 	p = Path(save_path)
 	p.mkdir(parents=True, exist_ok=True)
-		
-	if filename == None: filename = f'{shortcode}.png'
-	
+
+	if filename is not None and (p / filename).exists():
+		return(p / filename) # File already exists. We could do something else here but we just exit for now
+
+	entry = _download_post_media(shortcode, cfg['media_folder'] or cfg['cache_folder'] / "__media")
+	if entry is None: raise RuntimeError(f"Post {shortcode} has no photo to download.")
+
+	if filename == None: filename = shortcode + Path(entry['path']).suffix
 	filename = p / filename
-	
-	if filename.exists():
-		pass # File already exists. We could do something else here but we just exit for now
-	else:
-		post = _get_instagram_data(type='post', shortcode=shortcode, force_download=True)
+	shutil.copyfile(entry['path'], filename)
 
-		wait_for_download()
-	
-		response = requests.get(post['display_url'], stream=True)
-		with open(filename, 'wb') as out_file:
-			shutil.copyfileobj(response.raw, out_file)
-		del(response)
-	
-		wait_for_download()
-	
 	return(filename)
 	
 	
+# Media
+
+MEDIA_EXTENSIONS = {'image/jpeg': ".jpg", 'image/png': ".png", 'image/webp': ".webp", 'image/gif': ".gif", 'image/heic': ".heic", 'video/mp4': ".mp4"}
+
+
+class MediaUrlError(RuntimeError):
+	""" Raised when a media URL is refused (Instagram's media URLs are signed and expire), so the URL has to be refreshed from the post. """
+	pass
+
+
+def _media_extension(content_type):
+	""" Returns the file extension for a Content-Type header. """
+	content_type = (content_type or "").split(";")[0].strip().lower()
+	return(MEDIA_EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type) or ".bin")
+
+
+def _fetch_media(url, path, limiter=None, lock=None):
+	""" Streams a media URL to `path` + ".part", resuming the partial file that an interrupted download left behind, checks that the whole file arrived and moves it to `path` with the extension of its content type.
+
+	With a `lock` (a function that returns a context manager, such as lambda: cache_lock("media", shortcode)), the .part file is only read, appended to and moved while holding it, so two processes never write to the same file. Waiting for the rate limiter and sending the request happen outside it.
+
+	Returns: (path, content type, size in bytes).
+	"""
+	if lock is None: lock = contextlib.nullcontext
+	part_path = Path(f"{path}.part")
+	part_path.parent.mkdir(parents=True, exist_ok=True)
+	with lock(): offset = part_path.stat().st_size if part_path.exists() else 0
+
+	if limiter is not None: limiter.acquire()
+	with http_get(url, stream=True, headers={'Range': f"bytes={offset}-"} if offset > 0 else {}) as response:
+		if limiter is not None: limiter.report(response.status_code in THROTTLING_STATUS_CODES)
+		if response.status_code in THROTTLING_STATUS_CODES: raise ThrottledError(f"The media server answered the request for {url} with HTTP status {response.status_code}.")
+		if response.status_code == 416: # The partial file does not fit the file on the server (any more)
+			with lock(): part_path.unlink(missing_ok=True)
+			raise ConnectionError(f"The partial download of {url} could not be resumed. Starting over.")
+		if response.status_code not in [200, 206]: raise MediaUrlError(f"Could not download {url} (HTTP status {response.status_code}).")
+		if response.status_code == 200: offset = 0 # The server sent the whole file
+
+		length = response.headers.get("Content-Length")
+		expected = None if length is None else offset + int(length)
+		content_type = response.headers.get("Content-Type")
+		with lock():
+			current = part_path.stat().st_size if part_path.exists() else 0
+			if offset > 0 and current != offset: raise ConnectionError(f"The partial download of {url} was changed by another download. Starting again.")
+			with open(part_path, "ab" if offset > 0 else "wb") as f:
+				for chunk in response.iter_content(chunk_size=cfg['http_chunk_size']): f.write(chunk)
+			size = part_path.stat().st_size
+			if expected is not None and size != expected: raise ConnectionError(f"The download of {url} stopped after {size} of {expected} bytes.")
+			path = Path(path).with_name(Path(path).name + _media_extension(content_type))
+			os.replace(part_path, path)
+	return(path, content_type, size)
+
+
+def _media_blob_path(folder, sha256, extension):
+	""" Returns the path of a media file in the content-addressed store. """
+	return(Path(folder) / "blobs" / sha256[0:2] / sha256[2:4] / f"{sha256}{extension}")
+
+
+def _hash_file(path):
+	""" Returns the SHA-256 of a file. """
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""): sha256.update(chunk)
+	return(sha256.hexdigest())
+
+
+def _store_media_file(path, folder, sha256=None):
+	""" Moves a media file into the content-addressed store (or removes it, if the store already has the same file). Returns (path in the store, SHA-256). """
+	path = Path(path)
+	if sha256 is None: sha256 = _hash_file(path)
+	blob_path = _media_blob_path(folder, sha256, path.suffix)
+	if blob_path == path: return(blob_path, sha256)
+	if blob_path.exists():
+		os.remove(path) # A repost: the store has this file already
+	else:
+		blob_path.parent.mkdir(parents=True, exist_ok=True)
+		os.replace(path, blob_path)
+	return(blob_path, sha256)
+
+
+def _download_post_media(shortcode, folder, force=False):
+	""" Downloads the photo of a post into the content-addressed store in `folder`, unless the media records show it is already there. The display_url is taken from the cached post, which is only downloaded again if the URL has expired.
+
+	Returns: The media record of the post, or None if the post has no media.
+	"""
+	manifest = get_cache_manifest()
+	entry = manifest.media(shortcode)
+	if not force and entry is not None and os.path.exists(entry['path']) and os.path.getsize(entry['path']) == entry['size']: return(entry)
+
+	limiter = get_rate_limiter("media")
+	stem = Path(folder).joinpath("partial", *_get_shard(shortcode)) / shortcode
+	post = _get_instagram_data(type="post", shortcode=shortcode)
+	for refreshed in [False, True]:
+		if not post or not post.get('display_url'): return(None)
+		try:
+			# Another process must not append to the same .part file
+			path, content_type, size = call_with_retries(_fetch_media, post['display_url'], stem, limiter=limiter, lock=lambda: cache_lock("media", shortcode), service="media")
+			break
+		except MediaUrlError:
+			if refreshed: raise
+			_log(f"The media URL of post {shortcode} has expired. Downloading the post again for a new one.", 0)
+			post = _get_instagram_data(type="post", shortcode=shortcode, force_download=True)
+
+	path, sha256 = _store_media_file(path, folder)
+	manifest.record_media(shortcode, post['display_url'], str(path), content_type, size, sha256=sha256)
+	return(manifest.media(shortcode))
+
+
+def download_media(shortcodes, folder=None, concurrency=None, force=False, show_progress=True):
+	""" Downloads the photos of many posts at once, `concurrency` (default cfg['media_concurrency']) at a time, paced by the "media" rate limiter.
+
+	Photos are kept in a content-addressed store in `folder` (default cfg['media_folder'], or __media in the cache folder): each distinct file is stored once, named by its SHA-256 with the extension of its real content type, so a repost of the same file takes no extra space. The media records of the cache manifest (see CacheManifest.media()) map each shortcode to its file, with its URL, content type and size, so photos that are already there are skipped. Downloads go through a .part file that an interrupted run resumes, and are only moved into the store once the whole file has arrived.
+
+	Afterwards the new photos get perceptual hashes (see index_media), if cfg['media_perceptual_hashes'] is set and Pillow is installed.
+
+	Returns: A dictionary with the number of photos downloaded, skipped (already there), missing (posts without a photo) and failed.
+	"""
+	if isinstance(shortcodes, str): shortcodes = [shortcodes]
+	if folder is None: folder = cfg['media_folder'] or cfg['cache_folder'] / "__media"
+	if concurrency is None: concurrency = cfg['media_concurrency']
+	shortcodes = list(dict.fromkeys(shortcode for shortcode in shortcodes if len(shortcode) > 0))
+
+	manifest = get_cache_manifest()
+	known = {} if force else manifest.media_many(shortcodes)
+	todo = [shortcode for shortcode in shortcodes if shortcode not in known or not os.path.exists(known[shortcode]['path'])]
+	counts = {'downloaded': 0, 'skipped': len(shortcodes) - len(todo), 'missing': 0, 'failed': 0}
+	_log(f"Downloading the media of {len(todo)} of {len(shortcodes)} posts ({concurrency} at a time)...", 10)
+
+	if show_progress: bar = progressbar.ProgressBar(max_value=len(todo)).start()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = {executor.submit(_download_post_media, shortcode, folder, force): shortcode for shortcode in todo}
+		for i, future in enumerate(as_completed(futures)):
+			try:
+				counts['downloaded' if future.result() is not None else 'missing'] += 1
+			except Exception as e:
+				_log(f"Warning: Could not download the media of post {futures[future]} ({e.__class__.__name__}: {e}).", 10)
+				counts['failed'] += 1
+			if show_progress: bar.update(i + 1)
+	if show_progress: bar.finish()
+
+	if cfg['media_perceptual_hashes'] and Image is not None and counts['downloaded'] > 0: index_media(folder=folder, show_progress=show_progress)
+
+	return(counts)
+
+
+def _perceptual_hash(path):
+	""" Returns the 64-bit difference hash (dHash) of an image: the image is shrunk to 9x8 grey pixels, and each bit says whether a pixel is darker than its right neighbour. Resized, recompressed or slightly edited copies of an image get the same or a close hash. Returns None if the file cannot be decoded as an image. Needs Pillow. """
+	try:
+		with Image.open(path) as image: pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+	except (OSError, ValueError, Image.DecompressionBombError):
+		return(None)
+	value = 0
+	for row in range(8):
+		for column in range(8): value = value << 1 | (pixels[row * 9 + column] < pixels[row * 9 + column + 1])
+	return(value)
+
+
+def _hash_media(args):
+	""" Process pool worker for index_media: returns the shortcode, SHA-256 and perceptual hash of a media file. """
+	shortcode, path, sha256 = args
+	if sha256 is None: sha256 = _hash_file(path)
+	phash = _perceptual_hash(path)
+	return(shortcode, path, sha256, "" if phash is None else f"{phash:016x}")
+
+
+def index_media(folder=None, workers=None, chunk=500, show_progress=True):
+	""" Computes the SHA-256 and perceptual hash of every downloaded photo that does not have them yet, in a process pool, and moves photos that are not in the content-addressed store yet into it. Photos that cannot be decoded get an empty perceptual hash and are not looked at again.
+
+	Returns: Number of photos hashed.
+	"""
+	if Image is None: raise RuntimeError("Perceptual hashes of media need Pillow, which is not installed.")
+	if folder is None: folder = cfg['media_folder'] or cfg['cache_folder'] / "__media"
+	manifest = get_cache_manifest()
+	records = [(entry['shortcode'], entry['path'], entry['sha256']) for entry in manifest.unhashed_media() if os.path.exists(entry['path'])]
+	if len(records) == 0: return(0)
+	_log(f"Hashing {len(records)} photos...", 0)
+
+	if show_progress: bar = progressbar.ProgressBar(max_value=len(records)).start()
+	count = 0
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dict(cfg),)) as executor:
+		for start in range(0, len(records), chunk):
+			hashes = []
+			for shortcode, path, sha256, phash in executor.map(_hash_media, records[start:start+chunk], chunksize=16):
+				path, sha256 = _store_media_file(path, folder, sha256)
+				hashes.append((shortcode, path, sha256, phash))
+				if phash != "" and _media_index is not None: _media_index.add(int(phash, 16), shortcode)
+			manifest.set_media_hashes(hashes)
+			count += len(hashes)
+			if show_progress: bar.update(count)
+	if show_progress: bar.finish()
+	return(count)
+
+
+def _hamming(a, b):
+	return(bin(a ^ b).count("1"))
+
+
+class BKTree(object):
+	""" A BK-tree: finds all stored 64-bit hashes within a Hamming distance of a hash, without comparing it to every hash. Every node keeps the items with its hash and its children by their distance to it, so a search only follows children whose distance lies within `distance` of the node's own distance to the hash (by the triangle inequality, no other child can hold a match). """
+
+	def __init__(self, items=None):
+		self._root = None # [hash, items, children by distance]
+		self._size = 0
+		if items is not None:
+			for value, item in items: self.add(value, item)
+
+	def __len__(self):
+		return(self._size)
+
+	def add(self, value, item):
+		self._size += 1
+		if self._root is None:
+			self._root = [value, [item], {}]
+			return
+		node = self._root
+		while True:
+			distance = _hamming(value, node[0])
+			if distance == 0:
+				node[1].append(item)
+				return
+			if distance not in node[2]:
+				node[2][distance] = [value, [item], {}]
+				return
+			node = node[2][distance]
+
+	def search(self, value, distance):
+		""" Returns (distance, item) for all items with a hash within `distance` of `value`, closest first. """
+		results, stack = [], [] if self._root is None else [self._root]
+		while len(stack) > 0:
+			node = stack.pop()
+			node_distance = _hamming(value, node[0])
+			if node_distance <= distance: results.extend((node_distance, item) for item in node[1])
+			stack.extend(child for child_distance, child in node[2].items() if node_distance - distance <= child_distance <= node_distance + distance)
+		return(sorted(results, key=itemgetter(0)))
+
+
+_media_index = None
+
+
+def get_media_index():
+	""" Returns a BK-tree of the perceptual hashes of all hashed photos, with their shortcodes as items (built on first use and kept up to date by index_media). """
+	global _media_index
+	if _media_index is None: _media_index = BKTree((phash, shortcode) for shortcode, phash in get_cache_manifest().media_hashes().items())
+	return(_media_index)
+
+
+def similar_media(shortcode, distance=None):
+	""" Returns (distance, shortcode) for the photos that look like the photo of a post (reposts, or near-copies if `distance` is above 0), closest first. The default distance is cfg['media_repost_distance']. """
+	if distance is None: distance = cfg['media_repost_distance']
+	entry = get_cache_manifest().media(shortcode)
+	if entry is None or not entry['phash']: return([])
+	return([(d, other) for d, other in get_media_index().search(int(entry['phash'], 16), distance) if other != shortcode])
+
+
+def find_reposts(shortcodes=None, distance=None):
+	""" Groups posts whose photos look alike (within `distance`, default cfg['media_repost_distance'], bits of their perceptual hashes). Only posts in `shortcodes` are grouped, if it is given.
+
+	Returns: A list of groups of shortcodes (each with at least two posts), largest first.
+	"""
+	if distance is None: distance = cfg['media_repost_distance']
+	hashes = get_cache_manifest().media_hashes()
+	if shortcodes is not None:
+		shortcodes = set(shortcodes)
+		hashes = {shortcode: phash for shortcode, phash in hashes.items() if shortcode in shortcodes}
+	tree = BKTree((phash, shortcode) for shortcode, phash in hashes.items())
+
+	parents = {}
+	def _find(shortcode):
+		while parents.get(shortcode, shortcode) != shortcode:
+			parents[shortcode] = parents.get(parents[shortcode], parents[shortcode])
+			shortcode = parents[shortcode]
+		return(shortcode)
+
+	for shortcode, phash in hashes.items():
+		for _, other in tree.search(phash, distance):
+			a, b = _find(shortcode), _find(other)
+			if a != b: parents[a] = b
+
+	groups = collections.defaultdict(list)
+	for shortcode in hashes: groups[_find(shortcode)].append(shortcode)
+	return(sorted((sorted(group) for group in groups.values() if len(group) > 1), key=len, reverse=True))
+
+
 def get_hashtags_in_cache():
 	""" Returns a list of all the hashtags available in the cache """
 	_list = [Path(dir).name for dir in listdir_nohidden(cfg['hashtags_datasets'])]
@@ -2625,8 +6627,8 @@ def scrape_shortcodes(hashtag=None, user=None, scrolls=10, to_file=None, existin
 
 	# If we are not passed "start_in_place," go to correct page. Otherwise, we can just continue where the passed existing_browser is 
 	if not start_in_place:
-		if hashtag is not None: browser.get(url=f"http://www.instagram.com/explore/tags/{hashtag}/")
-		elif user is not None: browser.get(url=f"http://www.instagram.com/{user}/")
+		if hashtag is not None: browser.get(url=f"{cfg['instagram_base_url']}/explore/tags/{hashtag}/")
+		elif user is not None: browser.get(url=f"{cfg['instagram_base_url']}/{user}/")
 	elif start_in_place:
 		g = re.search("(\S+) hashtag", browser.title)
 		hashtag = g.groups()[0][1:]
@@ -2657,13 +6659,9 @@ def scrape_shortcodes(hashtag=None, user=None, scrolls=10, to_file=None, existin
 		body_text = browser.find_element_by_tag_name(name="body").text
 		body_text = body_text.lower()
 		search = body_text.find("failed to load")
-		if search > 0:
-			wait = round(random.uniform(cfg['downloads_wait_min']*10, cfg['downloads_wait_max']*10), 2)
-			print(f"Waiting {wait} because of a hold-up.") # this should be removed in production
-			time.sleep(wait)
-		else:
-			wait = round(random.uniform(cfg['downloads_wait_min'], cfg['downloads_wait_max']), 2)
-			time.sleep(wait)
+		limiter = get_rate_limiter("instagram")
+		limiter.report(search > 0) # A hold-up slows the limiter down
+		limiter.acquire()
 
 		elems = browser.find_elements_by_class_name(name="Nnq7C")
 		if len(elems) == 0:
@@ -2727,7 +6725,7 @@ class InstagramSpider():
 
 		if login:
 			# Login to Instagram
-			self._window.get("https://www.instagram.com/accounts/login/")
+			self._window.get(f"{cfg['instagram_base_url']}/accounts/login/")
 			login = "kallewesterling" # login = input("Login: ")
 			password = "rFj7XYDZ" # password = input("Password: ")
 
@@ -2758,8 +6756,8 @@ class InstagramSpider():
 	def search(self, hashtag=None, user=None):
 		if hashtag is not None and user is not None: raise RuntimeError("Cannot accept both user and hashtag at once.")
 		
-		if hashtag is not None: self._window.get(f"https://www.instagram.com/explore/tags/{hashtag}/")
-		elif user is not None: self._window.get(f"https://www.instagram.com/{user}/")
+		if hashtag is not None: self._window.get(f"{cfg['instagram_base_url']}/explore/tags/{hashtag}/")
+		elif user is not None: self._window.get(f"{cfg['instagram_base_url']}/{user}/")
 
 	def get_info(self):
 		_hashtag, _user = None, None
@@ -2794,7 +6792,7 @@ class InstagramSpider():
 				if _hashtag == hashtag: on_page = True # we are on the hashtag page!
 			except:
 				pass
-			if not on_page: self._window.get(f"http://www.instagram.com/explore/tags/{hashtag}/")
+			if not on_page: self._window.get(f"{cfg['instagram_base_url']}/explore/tags/{hashtag}/")
 			try:
 				elem = self._window.find_element_by_class_name(name="g47SY")
 				num_posts = int(elem.text.replace(',', ''))
@@ -2809,7 +6807,7 @@ class InstagramSpider():
 				if _user == user: on_page = True # we are on the hashtag page!
 			except:
 				pass
-			if not on_page: self._window.get(f"http://www.instagram.com/{user}/")
+			if not on_page: self._window.get(f"{cfg['instagram_base_url']}/{user}/")
 			else: print("We are on user page already")
 			try:
 				elem = self._window.find_element_by_class_name(name="g47SY")
@@ -2916,8 +6914,186 @@ class InstagramDatasetSample():
 		
 		
 
+def _main(argv=None):
+	""" Command line interface for maintenance tasks on the cache. """
+	parser = argparse.ArgumentParser(prog="instagram.py", description=f"Instagram module version {__version__}.")
+	commands = parser.add_subparsers(dest="command")
+
+	migrate = commands.add_parser("migrate-cache", help="Move a flat cache into the sharded cache layout (can be interrupted and resumed).")
+	migrate.add_argument("--types", nargs="+", default=["posts", "users", "places", "tweets", "tweeters", "twitter-places"])
+	migrate.add_argument("--workers", type=int, default=cfg['cache_migration_workers'])
+
+	copy = commands.add_parser("copy-cache", help="Copy every record from one cache backend to another.")
+	copy.add_argument("--to", dest="to_backend", required=True, choices=list(CACHE_BACKENDS.keys()))
+	copy.add_argument("--from", dest="from_backend", default=cfg['cache_backend'], choices=list(CACHE_BACKENDS.keys()))
+	copy.add_argument("--types", nargs="+", default=["post", "user", "place", "tweet", "tweeter", "twitter-place"])
+
+	commands.add_parser("compact-cache", help="Drop superseded and deleted records from the segment cache.")
+
+	train = commands.add_parser("train-dictionary", help="Train a zlib preset dictionary for compressing cache records.")
+	train.add_argument("--type", default="post")
+	train.add_argument("--sample", type=int, default=1000)
+
+	benchmark_codecs_parser = commands.add_parser("benchmark-codecs", help="Compare decode throughput of the installed record codecs on synthetic posts.")
+	benchmark_codecs_parser.add_argument("--records", type=int, default=2000)
+
+	benchmark_extraction_parser = commands.add_parser("benchmark-extraction", help="Compare the page extractor with the original BeautifulSoup extraction.")
+	benchmark_extraction_parser.add_argument("--folder", default=None, help="A folder of saved pages (synthetic pages are used otherwise).")
+	benchmark_extraction_parser.add_argument("--pages", type=int, default=200)
+
+	benchmark = commands.add_parser("benchmark-compression", help="Compare size and read throughput of cache records across compression settings.")
+	benchmark.add_argument("--type", default="post")
+	benchmark.add_argument("--sample", type=int, default=500)
+
+	rebuild = commands.add_parser("rebuild-manifest", help="Add every record in the cache to the cache manifest.")
+	rebuild.add_argument("--types", nargs="+", default=["post", "user", "place", "tweet", "tweeter", "twitter-place"])
+
+	commands.add_parser("evict-cache", help="Evict records until the cache is within the budgets in cfg['cache_budgets']. Records of datasets that are alive in other processes are left alone.")
+
+	migrate_schema = commands.add_parser("migrate-schema", help="Migrate every outdated cache record to the current schema.")
+	migrate_schema.add_argument("--types", nargs="+", default=["post", "tweet"])
+	migrate_schema.add_argument("--workers", type=int, default=None)
+
+	retry = commands.add_parser("retry-failed", help="Download the records that failed in earlier runs again.")
+	retry.add_argument("--types", nargs="+", default=["post", "user", "place"])
+	retry.add_argument("--include-fatal", action="store_true")
+
+	jobs = commands.add_parser("jobs", help="Manage the persistent download job queue.")
+	job_commands = jobs.add_subparsers(dest="job_command")
+	jobs_add = job_commands.add_parser("add", help="Queue records for download.")
+	jobs_add.add_argument("shortcodes", nargs="*", help="Shortcodes (or usernames) to queue.")
+	jobs_add.add_argument("--type", default="post", choices=["post", "user"])
+	jobs_add.add_argument("--file", help="A file with one shortcode per line.")
+	jobs_add.add_argument("--hashtags", nargs="+", help="Queue all posts of these hashtag datasets.")
+	jobs_add.add_argument("--priority", type=int, default=0)
+	jobs_add.add_argument("--requeue", action="store_true", help="Queue records again even if they were already downloaded.")
+	jobs_work = job_commands.add_parser("work", help="Download queued records until the queue is empty.")
+	jobs_work.add_argument("--concurrency", type=int, default=cfg['prefetch_concurrency'])
+	jobs_work.add_argument("--max-jobs", type=int, default=None)
+	jobs_work.add_argument("--expand", action="store_true", help="Also queue the users and places of downloaded posts.")
+	jobs_status = job_commands.add_parser("status", help="Show queue progress and throughput.")
+	jobs_status.add_argument("--watch", type=int, default=None, metavar="SECONDS", help="Refresh every SECONDS seconds.")
+	jobs_retry = job_commands.add_parser("retry", help="Put failed jobs back in the queue.")
+	jobs_retry.add_argument("--states", nargs="+", default=["failed"], choices=JOB_STATES)
+
+	reextract = commands.add_parser("reextract", help="Rebuild cache records from the raw page archive.")
+	reextract.add_argument("--types", nargs="+", default=["post", "user", "place"])
+	reextract.add_argument("--workers", type=int, default=None)
+
+	fixtures = commands.add_parser("generate-fixtures", help="Write a made-up corpus of Instagram pages for the offline stand-in.")
+	fixtures.add_argument("folder")
+	fixtures.add_argument("--posts", type=int, default=1000)
+	fixtures.add_argument("--users", type=int, default=50)
+	fixtures.add_argument("--places", type=int, default=20)
+	fixtures.add_argument("--hashtags", type=int, default=5)
+	fixtures.add_argument("--reposts", type=float, default=0.25, help="Share of posts that show the photo of an earlier post again.")
+	fixtures.add_argument("--seed", type=int, default=0)
+
+	stand_in = commands.add_parser("stand-in", help="Serve a folder of fixture pages as an offline stand-in for Instagram.")
+	stand_in.add_argument("folder")
+	stand_in.add_argument("--host", default="127.0.0.1")
+	stand_in.add_argument("--port", type=int, default=8000)
+	stand_in.add_argument("--latency", type=float, default=0.0)
+	stand_in.add_argument("--error-rate", type=float, default=0.0)
+	stand_in.add_argument("--throttle-rate", type=float, default=0.0)
+	stand_in.add_argument("--max-rate", type=float, default=None)
+
+	media = commands.add_parser("download-media", help="Download the photos of many posts at once.")
+	media.add_argument("shortcodes", nargs="*")
+	media.add_argument("--file", help="A file with one shortcode per line.")
+	media.add_argument("--hashtags", nargs="+", help="Download the photos of all posts of these hashtag datasets.")
+	media.add_argument("--folder", default=None)
+	media.add_argument("--concurrency", type=int, default=cfg['media_concurrency'])
+	media.add_argument("--force", action="store_true", help="Download photos again even if they are already there.")
+
+	index_media_parser = commands.add_parser("index-media", help="Hash downloaded photos and move them into the content-addressed media store.")
+	index_media_parser.add_argument("--workers", type=int, default=None)
+
+	reposts = commands.add_parser("find-reposts", help="List groups of posts whose photos look alike.")
+	reposts.add_argument("--hashtags", nargs="+", help="Only look at the posts of these hashtag datasets.")
+	reposts.add_argument("--distance", type=int, default=cfg['media_repost_distance'])
+
+	args = parser.parse_args(argv)
+
+	if args.command == "migrate-cache":
+		count = migrate_cache_layout(types=args.types, workers=args.workers)
+		print(f"{count} files moved to the sharded cache layout.")
+	elif args.command == "copy-cache":
+		count = copy_cache(to_backend=args.to_backend, from_backend=args.from_backend, types=args.types)
+		print(f"{count} records copied from the {args.from_backend} cache to the {args.to_backend} cache.")
+	elif args.command == "compact-cache":
+		freed = SegmentBackend().compact()
+		print(f"{freed} bytes freed.")
+	elif args.command == "train-dictionary":
+		dictionary_id = train_compression_dictionary(type=args.type, sample=args.sample)
+		print(f"Trained dictionary {dictionary_id}. New {args.type} records will be compressed with it when cfg['cache_compression'] is set to `zlib`.")
+	elif args.command == "benchmark-codecs":
+		print(benchmark_codecs(records=args.records).to_string())
+	elif args.command == "benchmark-extraction":
+		print(benchmark_extraction(folder=args.folder, pages=args.pages).to_string())
+	elif args.command == "benchmark-compression":
+		print(benchmark_compression(type=args.type, sample=args.sample).to_string())
+	elif args.command == "rebuild-manifest":
+		rebuild_manifest(types=args.types)
+		for row in get_cache_manifest().summary(): print(f"{row['type']}\t{row['status']}\t{row['records']} records\t{row['bytes']} bytes")
+	elif args.command == "migrate-schema":
+		count = migrate_cache_schema(types=args.types, workers=args.workers)
+		print(f"{count} records migrated.")
+	elif args.command == "retry-failed":
+		count = retry_failed(types=args.types, include_fatal=args.include_fatal)
+		print(f"{count} records downloaded, {len(get_cache_manifest().failures())} still failing.")
+	elif args.command == "jobs":
+		queue = get_job_queue()
+		if args.job_command == "add":
+			shortcodes = list(args.shortcodes)
+			if args.file is not None:
+				with open(args.file, "r") as f: shortcodes.extend(line.strip() for line in f)
+			if args.hashtags is not None: shortcodes.extend(get_shortcodes_from_hashtags(args.hashtags))
+			print(f"{queue.add(shortcodes, type=args.type, priority=args.priority, requeue=args.requeue)} jobs added.")
+		elif args.job_command == "work":
+			print(f"{run_jobs(queue=queue, concurrency=args.concurrency, max_jobs=args.max_jobs, expand=args.expand)} jobs finished.")
+		elif args.job_command == "retry":
+			print(f"{queue.requeue(states=args.states)} jobs requeued.")
+		else:
+			while True:
+				progress = queue.progress()
+				eta = "unknown" if progress['eta_seconds'] is None else f"{progress['eta_seconds'] // 3600}h {progress['eta_seconds'] % 3600 // 60}m"
+				print("  ".join(f"{state}: {count}" for state, count in progress['states'].items()) + f"  |  {progress['per_minute']} jobs/minute  |  time left: {eta}")
+				if args.watch is None: break
+				time.sleep(args.watch)
+	elif args.command == "reextract":
+		count = reextract_from_archive(types=args.types, workers=args.workers)
+		print(f"{count} records rebuilt from the page archive.")
+	elif args.command == "generate-fixtures":
+		for type, count in generate_fixtures(args.folder, posts=args.posts, users=args.users, places=args.places, hashtags=args.hashtags, reposts=args.reposts, seed=args.seed).items(): print(f"{count} {type} pages written.")
+	elif args.command == "stand-in":
+		server = InstagramStandIn(args.folder, host=args.host, port=args.port, latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate, max_rate=args.max_rate)
+		print(f"Serving {args.folder} at {server.url} (set cfg['instagram_base_url'] to this). Press Ctrl+C to stop.")
+		try:
+			server._server.serve_forever()
+		except KeyboardInterrupt:
+			print("  ".join(f"{outcome}: {count}" for outcome, count in server.counts.items()))
+	elif args.command == "download-media":
+		shortcodes = list(args.shortcodes)
+		if args.file is not None:
+			with open(args.file, "r") as f: shortcodes.extend(line.strip() for line in f)
+		if args.hashtags is not None: shortcodes.extend(get_shortcodes_from_hashtags(args.hashtags))
+		print("  ".join(f"{outcome}: {count}" for outcome, count in download_media(shortcodes, folder=args.folder, concurrency=args.concurrency, force=args.force).items()))
+	elif args.command == "index-media":
+		print(f"{index_media(workers=args.workers)} photos hashed.")
+		usage = get_cache_manifest().media_usage()
+		print(f"{usage['records']} photos in {usage['files']} files: {usage['stored_bytes']} of {usage['referenced_bytes']} bytes stored.")
+	elif args.command == "find-reposts":
+		for group in find_reposts(shortcodes=None if args.hashtags is None else get_shortcodes_from_hashtags(args.hashtags), distance=args.distance): print(" ".join(group))
+	elif args.command == "evict-cache":
+		freed = CacheEvictor().run()
+		print(f"{freed} bytes freed.")
+	else:
+		print(__author__)
+		print(__version__)
+
+
 if __name__ == "__main__":
-	print(__author__)
-	print(__version__)
+	_main()
 elif __name__ == "instagram": # We're importing!
 	if cfg['level_reporting'] >= 10: print(f"Running Instagram module version {__version__}.")
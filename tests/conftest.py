@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import instagram
+
+
+@pytest.fixture(scope="session")
+def fixture_cache(tmp_path_factory):
+	""" A cache filled from made-up pages (see generate_fixtures) through an InstagramStandIn. Returns the sorted post shortcodes in it. """
+	folder = tmp_path_factory.mktemp("cache")
+	instagram.cfg['cache_folder'] = folder
+	instagram.cfg['hashtags_datasets'] = folder / "hashtags"
+	instagram.cfg['users_datasets'] = folder / "users"
+	instagram.cfg['rate_limits']['instagram'] = {'rate': 1000, 'min_rate': 1, 'max_rate': 5000, 'burst': 100}
+	instagram.generate_fixtures(folder / "fixtures", posts=600, users=60, places=20, hashtags=3)
+	shortcodes = sorted(path.name[:-len(".html.gz")] for path in (folder / "fixtures" / "post").iterdir())
+	with instagram.InstagramStandIn(folder / "fixtures"):
+		instagram.prefetch(shortcodes + ["missing1"], expand=True, show_progress=False)
+	return(shortcodes)
@@ -0,0 +1,173 @@
+""" Checks that bringing a dataset up to date (InstagramDataset.update, and loading an out of date snapshot) gives the same dataset as building it again. """
+
+import contextlib
+
+import pytest
+
+import instagram
+
+
+EXCLUDED = ["user_3", "user_7"]
+
+
+def state(dataset):
+	""" Everything that update() changes in place, in a form that can be compared with a fresh build. """
+	captions, geo, network = dataset.captions, dataset.geo, dataset.network
+	return({
+		'posts': sorted(post.shortcode for post in dataset.posts),
+		'summary': {field: getattr(dataset, field) for field in dataset._SUMMARY_FIELDS},
+		'captions': (captions.captions, {key: sorted(value) for key, value in captions.captions_data.items()}, captions.all_emojis, captions._word_counts, sorted(captions.captured)),
+		'geo': (geo.coordinates, sorted(geo.details)),
+		'network': (network.all(True), sorted(network._nodes)),
+		'rankings': {name: sorted(dataset.aggregate(name)) for name in instagram.DATASET_AGGREGATORS},
+	})
+
+
+def assert_same(dataset, fresh):
+	a, b = state(dataset), state(fresh)
+	for key in a: assert a[key] == b[key], key
+
+
+@contextlib.contextmanager
+def emptied(shortcodes):
+	""" Within the block, the posts look as if they had been downloaded again and turned out empty. """
+	saved = {shortcode: instagram._get_instagram_data("post", shortcode) for shortcode in shortcodes}
+	for shortcode in shortcodes: instagram._cache_put("post", shortcode, "")
+	try:
+		yield
+	finally:
+		for shortcode, data in saved.items():
+			instagram._cache_put("post", shortcode, data)
+			instagram.get_negative_cache().discard("post", shortcode)
+
+
+def set_hashtag(hashtag, shortcodes):
+	""" Writes the shortcodes of a hashtag folder (see get_shortcodes_from_hashtags). """
+	folder = instagram.cfg['hashtags_datasets'] / hashtag
+	folder.mkdir(parents=True, exist_ok=True)
+	(folder / "_shortcodes").write_text("\n".join(shortcodes))
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_update_with_new_shortcodes(fixture_cache, lazy):
+	shortcodes = fixture_cache
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:400] + ["missing1"], exclude_users=EXCLUDED, lazy=lazy)
+	state(dataset) # Sets up the counts, captions, geo, network and rankings, so update() has to change them
+
+	result = dataset.update(shortcodes=shortcodes[400:])
+	assert result['added'] == len(shortcodes) - 400
+
+	fresh = instagram.InstagramDataset(shortcodes=shortcodes + ["missing1"], exclude_users=EXCLUDED)
+	assert_same(dataset, fresh)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_update_takes_out_emptied_posts(fixture_cache, lazy):
+	shortcodes = fixture_cache
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:400], exclude_users=EXCLUDED, lazy=lazy)
+	state(dataset)
+
+	# Posts with captions, locations and tags, and posts by excluded users, so that every remove path is taken
+	posts = list(dataset.posts)
+	gone = [post.shortcode for post in posts if post.location is not None][:3] + [post.shortcode for post in posts if len(post.tagged_users) > 0][:3] + [shortcodes[10], shortcodes[20]]
+	gone = list(dict.fromkeys(gone))
+	with emptied(gone):
+		result = dataset.update(shortcodes=shortcodes[400:])
+		assert result['removed'] >= len(set(gone) & set(post.shortcode for post in posts))
+		fresh = instagram.InstagramDataset(shortcodes=shortcodes, exclude_users=EXCLUDED)
+		assert_same(dataset, fresh)
+
+
+def test_update_follows_hashtag_folders(fixture_cache):
+	shortcodes = fixture_cache
+	set_hashtag("update", shortcodes[:300])
+	dataset = instagram.InstagramDataset(hashtags=["update"], exclude_users=EXCLUDED)
+	state(dataset)
+
+	set_hashtag("update", shortcodes[100:450]) # Posts gone from the folder are taken out, new ones added
+	result = dataset.update()
+	assert result['added'] == 150
+	assert result['removed'] > 0
+
+	fresh = instagram.InstagramDataset(hashtags=["update"], exclude_users=EXCLUDED)
+	assert_same(dataset, fresh)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_snapshot_round_trip(fixture_cache, tmp_path, lazy):
+	shortcodes = fixture_cache
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:300] + ["missing1"], exclude_users=EXCLUDED, lazy=lazy)
+	before = state(dataset)
+	dataset.save(tmp_path / "dataset.igd")
+
+	loaded = instagram.InstagramDataset.load(tmp_path / "dataset.igd", rebuild=False)
+	assert state(loaded) == before
+
+
+def test_snapshot_with_emptied_posts_is_updated(fixture_cache, tmp_path):
+	shortcodes = fixture_cache
+	path = tmp_path / "dataset.igd"
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:300], exclude_users=EXCLUDED)
+	state(dataset)
+	dataset.save(path)
+
+	gone = [post.shortcode for post in dataset.posts][5:8]
+	with emptied(gone):
+		with pytest.raises(RuntimeError):
+			instagram.InstagramDataset.load(path, rebuild=False)
+		loaded = instagram.InstagramDataset.load(path)
+		fresh = instagram.InstagramDataset(shortcodes=shortcodes[:300], exclude_users=EXCLUDED)
+		assert_same(loaded, fresh)
+		assert not any(post.shortcode in gone for post in loaded.posts)
+
+		# The snapshot was saved again, and is up to date now
+		assert_same(instagram.InstagramDataset.load(path, rebuild=False), fresh)
+
+
+def test_snapshot_with_changed_record_is_built_again(fixture_cache, tmp_path):
+	shortcodes = fixture_cache
+	path = tmp_path / "dataset.igd"
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:300], exclude_users=EXCLUDED)
+	state(dataset)
+	dataset.save(path)
+
+	shortcode = [post.shortcode for post in dataset.posts if post.caption][0]
+	data = instagram._get_instagram_data("post", shortcode)
+	changed = dict(data, caption=data['caption'] + " #changedrecord")
+	instagram._cache_put("post", shortcode, changed)
+	try:
+		loaded = instagram.InstagramDataset.load(path)
+		fresh = instagram.InstagramDataset(shortcodes=shortcodes[:300], exclude_users=EXCLUDED)
+		assert_same(loaded, fresh)
+		assert "changedrecord" in dict(loaded.get_all_hashtags())
+	finally:
+		instagram._cache_put("post", shortcode, data)
+
+
+def test_snapshot_with_changed_folder_is_updated(fixture_cache, tmp_path):
+	shortcodes = fixture_cache
+	path = tmp_path / "dataset.igd"
+	set_hashtag("snapshot", shortcodes[:200])
+	dataset = instagram.InstagramDataset(hashtags=["snapshot"], exclude_users=EXCLUDED)
+	state(dataset)
+	dataset.save(path)
+
+	set_hashtag("snapshot", shortcodes[50:300])
+	with pytest.raises(RuntimeError):
+		instagram.InstagramDataset.load(path, rebuild=False)
+	loaded = instagram.InstagramDataset.load(path)
+	fresh = instagram.InstagramDataset(hashtags=["snapshot"], exclude_users=EXCLUDED)
+	assert_same(loaded, fresh)
+
+
+def test_added_aggregator_follows_updates(fixture_cache):
+	shortcodes = fixture_cache
+	captionless = lambda post: ["none"] if not post.caption else []
+	dataset = instagram.InstagramDataset(shortcodes=shortcodes[:300], exclude_users=EXCLUDED)
+	dataset.add_aggregator("captionless", captionless)
+	dataset.update(shortcodes=shortcodes[300:])
+
+	fresh = instagram.InstagramDataset(shortcodes=shortcodes, exclude_users=EXCLUDED)
+	fresh.add_aggregator("captionless", captionless)
+	assert dataset.aggregate("captionless") == fresh.aggregate("captionless")
+	assert len(dataset.posts) == len(fresh.posts)